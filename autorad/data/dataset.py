@@ -10,6 +10,7 @@ from sklearn.model_selection import train_test_split
 
 from autorad.config import config
 from autorad.config.type_definitions import PathLike
+from autorad.data import index
 from autorad.utils import extraction_utils, io, splitting
 from autorad.visualization import matplotlib_utils, plot_volumes
 
@@ -392,6 +393,7 @@ class ImageDataset:
         self.mask_colname = self._check_if_in_df(mask_colname)
         self._set_ID_col(ID_colname)
         self.root_dir = root_dir
+        self.index: Optional[pd.DataFrame] = None
 
     def _check_if_in_df(self, colname: str):
         if colname not in self._df.columns:
@@ -462,6 +464,36 @@ class ImageDataset:
     def ids(self) -> list[str]:
         return self.df[self.ID_colname].to_list()
 
+    def build_index(
+        self,
+        cache_path: Optional[PathLike] = None,
+        n_jobs: Optional[int] = None,
+    ) -> pd.DataFrame:
+        """
+        Check all the cases without reading the images: read the image
+        headers and the masks in parallel, and record the geometry, labels
+        and ROI bounding box of every case in `self.index`.
+
+        Args:
+            cache_path: Parquet file in which the index is saved. Cases
+                whose files have not changed are read from it.
+            n_jobs: number of worker processes. Defaults to the number
+                of CPUs.
+
+        Returns:
+            the index, with one row per case in the order of `self.df`.
+            Cases that cannot be extracted (missing files, mismatched
+            geometry or empty mask) have `valid` set to False.
+        """
+        self.index = index.build_index(
+            self.ids,
+            self.image_paths,
+            self.mask_paths,
+            cache_path=cache_path,
+            n_jobs=n_jobs,
+        )
+        return self.index
+
     def plot_examples(self, n: int = 1, window="soft tissues"):
         if n > len(self.image_paths):
             n = len(self.image_paths)
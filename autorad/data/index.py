@@ -0,0 +1,308 @@
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import SimpleITK as sitk
+
+from autorad.config.type_definitions import PathLike
+from autorad.utils import dicom, io, utils
+
+log = logging.getLogger(__name__)
+
+# Maximum difference in origin (mm), spacing (mm) and direction cosines for
+# an image and its mask to be considered on the same grid
+GEOMETRY_TOLERANCE = 1e-3
+
+# Columns holding (x, y, z) tuples or lists of labels
+_LIST_COLUMNS = [
+    "image_size",
+    "image_spacing",
+    "image_origin",
+    "image_direction",
+    "mask_size",
+    "mask_spacing",
+    "mask_origin",
+    "mask_direction",
+    "mask_labels",
+    "mask_bbox_start",
+    "mask_bbox_end",
+]
+
+INDEX_COLUMNS = [
+    "ID",
+    "image_path",
+    "mask_path",
+    "image_stamp",
+    "mask_stamp",
+    "image_size",
+    "image_spacing",
+    "image_origin",
+    "image_direction",
+    "image_dtype",
+    "mask_size",
+    "mask_spacing",
+    "mask_origin",
+    "mask_direction",
+    "mask_dtype",
+    "mask_labels",
+    "mask_n_voxels",
+    "mask_bbox_start",
+    "mask_bbox_end",
+    "bbox_volume_mm3",
+    "geometry_matches",
+    "valid",
+    "error",
+]
+
+
+def read_image_header(path: PathLike) -> dict:
+    """
+    Read the geometry and pixel type of an image without reading its
+    pixels. For a DICOM series, only the first and last slices are read,
+    and the geometry is the one of the LPS-oriented volume returned by
+    `io.read_dicom_sitk`.
+
+    Returns:
+        size, spacing, origin, direction and dtype of the image
+    """
+    path = Path(path)
+    if not path.exists():
+        raise FileNotFoundError(f"Image not found at {path}")
+    if path.is_dir():
+        return _read_dicom_series_header(path)
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(str(path))
+    reader.ReadImageInformation()
+    return {
+        "size": list(reader.GetSize()),
+        "spacing": list(reader.GetSpacing()),
+        "origin": list(reader.GetOrigin()),
+        "direction": list(reader.GetDirection()),
+        "dtype": sitk.GetPixelIDValueAsString(reader.GetPixelID()),
+    }
+
+
+def _read_dicom_series_header(input_dir: Path) -> dict:
+    file_names = dicom.sort_dicom_series(input_dir)
+    slices = []
+    for file_name in (file_names[0], file_names[-1]):
+        reader = sitk.ImageFileReader()
+        reader.SetFileName(file_name)
+        reader.ReadImageInformation()
+        slices.append(reader)
+    first, last = slices
+    size = [first.GetSize()[0], first.GetSize()[1], len(file_names)]
+    spacing = list(first.GetSpacing())
+    direction = np.array(first.GetDirection()).reshape(3, 3)
+    if len(file_names) > 1:
+        # Slice direction and spacing from the slice positions, as the
+        # series reader does
+        offset = np.array(last.GetOrigin()) - np.array(first.GetOrigin())
+        distance = np.linalg.norm(offset)
+        if distance > 0:
+            spacing[2] = distance / (len(file_names) - 1)
+            direction[:, 2] = offset / distance
+    return {
+        **_orient_lps(size, spacing, first.GetOrigin(), direction),
+        "dtype": sitk.GetPixelIDValueAsString(first.GetPixelID()),
+    }
+
+
+def _orient_lps(size, spacing, origin, direction: np.ndarray) -> dict:
+    """
+    Geometry of an image after `sitk.DICOMOrient(image, "LPS")`: axes are
+    permuted and flipped so that every axis points along its closest
+    patient axis.
+    """
+    new_size, new_spacing = [0] * 3, [0.0] * 3
+    new_direction = np.zeros((3, 3))
+    first_index = np.zeros(3)
+    for axis in range(3):
+        patient_axis = int(np.argmax(np.abs(direction[:, axis])))
+        sign = np.sign(direction[patient_axis, axis])
+        new_size[patient_axis] = size[axis]
+        new_spacing[patient_axis] = spacing[axis]
+        new_direction[:, patient_axis] = direction[:, axis] * sign
+        if sign < 0:
+            first_index[axis] = size[axis] - 1
+    new_origin = np.array(origin) + direction @ (first_index * spacing)
+    return {
+        "size": new_size,
+        "spacing": new_spacing,
+        "origin": new_origin.tolist(),
+        "direction": new_direction.flatten().tolist(),
+    }
+
+
+def _file_stamp(path: PathLike) -> str:
+    """Size and modification time of a file, or of all files in a dir."""
+    path = Path(path)
+    if not path.exists():
+        raise FileNotFoundError(f"File not found at {path}")
+    files = sorted(path.rglob("*")) if path.is_dir() else [path]
+    stats = [f.stat() for f in files if f.is_file()]
+    if not stats:
+        raise FileNotFoundError(f"No files found in {path}")
+    size = sum(stat.st_size for stat in stats)
+    mtime = max(stat.st_mtime_ns for stat in stats)
+    return f"{size}-{mtime}"
+
+
+def index_case(ID, image_path: PathLike, mask_path: PathLike) -> dict:
+    """
+    Read the image header and the mask of one case and check that they can
+    be used for extraction: both exist, they share the same grid and the
+    mask is not empty.
+
+    Returns:
+        the index row of the case (see `INDEX_COLUMNS`)
+    """
+    row = {column: None for column in INDEX_COLUMNS}
+    row.update(
+        {
+            "ID": ID,
+            "image_path": str(image_path),
+            "mask_path": str(mask_path),
+            "geometry_matches": False,
+            "valid": False,
+        }
+    )
+    try:
+        row["image_stamp"] = _file_stamp(image_path)
+        row["mask_stamp"] = _file_stamp(mask_path)
+        header = read_image_header(image_path)
+        for key, value in header.items():
+            row[f"image_{key}"] = value
+        mask = io.read_segmentation_sitk(Path(mask_path))
+    except Exception as e:
+        row["error"] = str(e)
+        return row
+    row.update(
+        {
+            "mask_size": list(mask.GetSize()),
+            "mask_spacing": list(mask.GetSpacing()),
+            "mask_origin": list(mask.GetOrigin()),
+            "mask_direction": list(mask.GetDirection()),
+            "mask_dtype": mask.GetPixelIDTypeAsString(),
+        }
+    )
+    arr = sitk.GetArrayViewFromImage(mask)
+    labels = np.unique(arr)
+    row["mask_labels"] = [int(label) for label in labels if label != 0]
+    nonzero = np.nonzero(arr)
+    row["mask_n_voxels"] = int(len(nonzero[0]))
+    row["bbox_volume_mm3"] = 0.0
+    if row["mask_n_voxels"] > 0:
+        # (x, y, z) indices, end exclusive
+        start = [int(idx.min()) for idx in reversed(nonzero)]
+        end = [int(idx.max()) + 1 for idx in reversed(nonzero)]
+        row["mask_bbox_start"] = start
+        row["mask_bbox_end"] = end
+        row["bbox_volume_mm3"] = float(
+            np.prod(np.subtract(end, start)) * np.prod(mask.GetSpacing())
+        )
+    row["geometry_matches"] = bool(
+        row["image_size"] == row["mask_size"]
+        and all(
+            np.allclose(
+                row[f"image_{key}"],
+                row[f"mask_{key}"],
+                atol=GEOMETRY_TOLERANCE,
+                rtol=0,
+            )
+            for key in ("spacing", "origin", "direction")
+        )
+    )
+    if not row["geometry_matches"]:
+        row["error"] = "Image and mask geometry do not match"
+    elif row["mask_n_voxels"] == 0:
+        row["error"] = "Mask is empty"
+    row["valid"] = row["error"] is None
+    return row
+
+
+def build_index(
+    ids: list,
+    image_paths: list[PathLike],
+    mask_paths: list[PathLike],
+    cache_path: PathLike | None = None,
+    n_jobs: int | None = None,
+) -> pd.DataFrame:
+    """
+    Index the cases of a dataset in parallel, reading only the image
+    headers and the masks.
+    If `cache_path` is given, the index is saved there as a Parquet file
+    (requires pyarrow), and cases whose files have not changed since are
+    taken from it instead of being read again.
+
+    Returns:
+        one row per case, with the columns in `INDEX_COLUMNS`
+    """
+    cached = {}
+    if cache_path is not None and Path(cache_path).exists():
+        cached_df = pd.read_parquet(cache_path)
+        for column in _LIST_COLUMNS:
+            cached_df[column] = cached_df[column].map(
+                lambda value: None if value is None else list(value)
+            )
+        cached = {
+            (row.image_path, row.mask_path): row._asdict()
+            for row in cached_df.itertuples(index=False)
+        }
+    rows = [None] * len(ids)
+    to_index = []
+    for i, (ID, image_path, mask_path) in enumerate(
+        zip(ids, image_paths, mask_paths)
+    ):
+        row = cached.get((str(image_path), str(mask_path)))
+        if row is not None and _is_up_to_date(row):
+            rows[i] = {**row, "ID": ID}
+        else:
+            to_index.append((i, ID, image_path, mask_path))
+    log.info(
+        f"Indexing {len(to_index)} cases "
+        f"({len(ids) - len(to_index)} up to date in the cache)"
+    )
+
+    n_jobs = utils.set_n_jobs(n_jobs) or os.cpu_count()
+    if n_jobs == 1 or len(to_index) <= 1:
+        new_rows = [index_case(*case[1:]) for case in to_index]
+    else:
+        with ProcessPoolExecutor(n_jobs) as executor:
+            new_rows = list(
+                executor.map(
+                    index_case,
+                    *zip(*(case[1:] for case in to_index)),
+                    chunksize=max(1, len(to_index) // (4 * n_jobs)),
+                )
+            )
+    for (i, *_), row in zip(to_index, new_rows):
+        rows[i] = row
+
+    index = pd.DataFrame(rows, columns=INDEX_COLUMNS)
+    if cache_path is not None:
+        _save_index(index, Path(cache_path))
+    for row in index[~index["valid"]].itertuples(index=False):
+        log.warning(f"Invalid case ID={row.ID}: {row.error}")
+    return index
+
+
+def _is_up_to_date(row: dict) -> bool:
+    try:
+        return (
+            _file_stamp(row["image_path"]) == row["image_stamp"]
+            and _file_stamp(row["mask_path"]) == row["mask_stamp"]
+        )
+    except (OSError, ValueError):
+        return False
+
+
+def _save_index(index: pd.DataFrame, cache_path: Path):
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = cache_path.with_name(f".{cache_path.name}.tmp")
+    # IDs may be of mixed types, which Parquet does not support
+    index.astype({"ID": str}).to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, cache_path)
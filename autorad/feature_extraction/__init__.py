@@ -1 +1 @@
-from .extractor import FeatureExtractor
+from .extractor import ExtractionPool, FeatureExtractor
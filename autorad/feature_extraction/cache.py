@@ -0,0 +1,407 @@
+import abc
+import functools
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import radiomics
+import SimpleITK as sitk
+import yaml
+
+from autorad.config.type_definitions import PathLike
+
+log = logging.getLogger(__name__)
+
+
+def hash_file_content(path: PathLike, memo_dir: PathLike | None = None) -> str:
+    """
+    Hash the content of a file, or of all files in a directory
+    (e.g. a DICOM series), in a deterministic order.
+    Hashes are memoized by (path, size, mtime), so the same image used for
+    several masks is only read once.
+
+    Args:
+        memo_dir: directory in which the hashes are also saved, so that
+            other processes and later runs reuse them instead of reading
+            the files again
+    """
+    path = Path(path)
+    if path.is_dir():
+        files = sorted(p for p in path.rglob("*") if p.is_file())
+    else:
+        files = [path]
+    stamps = []
+    for file in files:
+        stat = file.stat()
+        stamps.append((str(file.resolve()), stat.st_size, stat.st_mtime_ns))
+    stamps = tuple(stamps)
+    if memo_dir is None:
+        return _hash_files(stamps)
+
+    memo_dir = Path(memo_dir)
+    memo_key = hashlib.sha256(json.dumps(stamps).encode()).hexdigest()
+    memo_path = memo_dir / memo_key
+    try:
+        digest = memo_path.read_text()
+        if len(digest) == 64:
+            # Bump the modification time, which the cache evicts by
+            os.utime(memo_path)
+            return digest
+    except FileNotFoundError:
+        pass
+    digest = _hash_files(stamps)
+    memo_dir.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=memo_dir, prefix=".tmp_")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(digest)
+        os.replace(tmp_path, memo_path)
+    except OSError as e:
+        log.debug(f"Could not save the hash of {path}: {e}")
+        Path(tmp_path).unlink(missing_ok=True)
+    return digest
+
+
+@functools.lru_cache(maxsize=4096)
+def _hash_files(stamps: tuple[tuple[str, int, int], ...]) -> str:
+    hasher = hashlib.sha256()
+    for file_path, _, _ in stamps:
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def _to_builtin(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"Object of type {type(value)} is not JSON serializable")
+
+
+class DiskCache(abc.ABC):
+    """
+    Size-bounded on-disk store with least-recently-used eviction.
+    Every entry is a single file (or directory) named after its key,
+    and its modification time is bumped on every hit to track recency.
+    Subclasses implement `_read` and `_write` for their type of entry.
+    """
+
+    suffix = ""
+
+    def __init__(self, cache_dir: PathLike, max_size: int | None = None):
+        """
+        Args:
+            cache_dir: directory in which the entries are stored
+            max_size: maximum total size of the entries in bytes.
+                If None, the cache is unbounded.
+        """
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, key: str) -> bool:
+        return self._entry_path(key).exists()
+
+    def __len__(self) -> int:
+        return len(self._entry_paths())
+
+    def get(self, key: str):
+        entry_path = self._entry_path(key)
+        if not entry_path.exists():
+            self.misses += 1
+            return None
+        try:
+            value = self._read(entry_path)
+        except FileNotFoundError:
+            # Evicted or replaced by another process in the meantime
+            self.misses += 1
+            return None
+        except Exception as e:
+            log.warning(f"Dropping unreadable cache entry {key}: {e}")
+            self._remove(entry_path)
+            self.misses += 1
+            return None
+        try:
+            os.utime(entry_path)
+        except FileNotFoundError:
+            pass
+        self.hits += 1
+        return value
+
+    def set(self, key: str, value) -> None:
+        entry_path = self._entry_path(key)
+        # Write to a temporary location first, so that a crash never leaves
+        # a half-written entry behind
+        tmp_path = (
+            Path(tempfile.mkdtemp(dir=self.cache_dir, prefix=".tmp_"))
+            / entry_path.name
+        )
+        try:
+            self._write(tmp_path, value)
+            self._remove(entry_path)
+            os.replace(tmp_path, entry_path)
+        finally:
+            shutil.rmtree(tmp_path.parent, ignore_errors=True)
+        self.evict()
+
+    def invalidate(self, key: str | None = None) -> None:
+        """
+        Remove a single entry, or all of them if `key` is None.
+        """
+        if key is None:
+            for entry_path in self._entry_paths() + self._aux_paths():
+                self._remove(entry_path)
+            log.info(f"Cleared the cache in {self.cache_dir}")
+        else:
+            self._remove(self._entry_path(key))
+
+    def size(self) -> int:
+        """Total size of the entries and auxiliary files in bytes."""
+        return sum(
+            self._entry_size(p)
+            for p in self._entry_paths() + self._aux_paths()
+        )
+
+    def evict(self) -> None:
+        """
+        Remove the least recently used entries and auxiliary files until
+        the cache fits within `max_size`.
+        """
+        if self.max_size is None:
+            return
+        entries = []
+        for entry_path in self._entry_paths() + self._aux_paths():
+            # Entries may be removed by other processes while scanning
+            try:
+                mtime = entry_path.stat().st_mtime_ns
+            except FileNotFoundError:
+                continue
+            entries.append((mtime, self._entry_size(entry_path), entry_path))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, entry_path in sorted(entries, key=lambda e: e[0]):
+            if total_size <= self.max_size:
+                break
+            self._remove(entry_path)
+            total_size -= size
+            log.debug(f"Evicted {entry_path.name} from the cache")
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self),
+            "size": self.size(),
+        }
+
+    def _entry_path(self, key: str) -> Path:
+        return self.cache_dir / f"{key}{self.suffix}"
+
+    def _entry_paths(self) -> list[Path]:
+        return [
+            p
+            for p in self.cache_dir.glob(f"*{self.suffix}")
+            if not p.name.startswith(".")
+        ]
+
+    def _aux_paths(self) -> list[Path]:
+        """
+        Files stored next to the entries (e.g. memoized hashes). They are
+        counted in the size of the cache and evicted like the entries.
+        """
+        return []
+
+    @staticmethod
+    def _entry_size(entry_path: Path) -> int:
+        """Size of an entry, or 0 if it was removed in the meantime."""
+        if not entry_path.is_dir():
+            try:
+                return entry_path.stat().st_size
+            except FileNotFoundError:
+                return 0
+        size = 0
+        for root, _, file_names in os.walk(entry_path):
+            for file_name in file_names:
+                try:
+                    size += os.stat(os.path.join(root, file_name)).st_size
+                except FileNotFoundError:
+                    pass
+        return size
+
+    @staticmethod
+    def _remove(entry_path: Path) -> None:
+        if entry_path.is_dir():
+            shutil.rmtree(entry_path, ignore_errors=True)
+        else:
+            entry_path.unlink(missing_ok=True)
+
+    @abc.abstractmethod
+    def _read(self, entry_path: Path):
+        """Read the value stored at `entry_path`."""
+
+    @abc.abstractmethod
+    def _write(self, entry_path: Path, value) -> None:
+        """Store `value` at `entry_path`, which does not exist yet."""
+
+
+class FeatureCache(DiskCache):
+    """
+    Content-addressed cache of extracted features. The key depends on the
+    image and mask content, the mask label, the extraction parameters and
+    the pyradiomics version, so changing any of them results in a miss.
+    """
+
+    suffix = ".json"
+    # Subdirectory with the hashes of the images and masks
+    hash_dirname = ".file_hashes"
+
+    def make_key(
+        self,
+        image_path: PathLike,
+        mask_path: PathLike,
+        mask_label: int | None,
+        extraction_params: dict,
+    ) -> str:
+        params = yaml.safe_dump(extraction_params, sort_keys=True)
+        hasher = hashlib.sha256()
+        for part in (
+            hash_file_content(image_path, self.cache_dir / self.hash_dirname),
+            hash_file_content(mask_path, self.cache_dir / self.hash_dirname),
+            str(mask_label),
+            params,
+            radiomics.__version__,
+        ):
+            hasher.update(part.encode())
+            hasher.update(b"\0")
+        return hasher.hexdigest()
+
+    def _aux_paths(self) -> list[Path]:
+        return [
+            p
+            for p in (self.cache_dir / self.hash_dirname).glob("*")
+            if not p.name.startswith(".")
+        ]
+
+    def _read(self, entry_path: Path) -> dict:
+        with open(entry_path) as f:
+            return json.load(f)
+
+    def _write(self, entry_path: Path, value: dict) -> None:
+        with open(entry_path, "w") as f:
+            json.dump(value, f, default=_to_builtin)
+
+
+# Settings that are only used when computing features from the filtered
+# images, so changing them must not invalidate the filtered images
+FEATURE_ONLY_SETTINGS = {
+    "additionalInfo",
+    "binCount",
+    "binWidth",
+    "correctMask",
+    "distances",
+    "geometryTolerance",
+    "gldm_a",
+    "label",
+    "label_channel",
+    "minimumROIDimensions",
+    "minimumROISize",
+    "resegmentMode",
+    "resegmentRange",
+    "resegmentShape",
+    "symmetricalGLCM",
+    "voxelArrayShift",
+    "weightingNorm",
+}
+
+
+# Image types whose filter only computes the voxels inside the mask
+MASK_DEPENDENT_IMAGE_TYPES = {"LBP3D"}
+
+
+class FilteredImageCache(DiskCache):
+    """
+    Cache of derived images (e.g. Wavelet, LoG) computed by pyradiomics.
+    Every entry is a directory with one .npy array per derived image,
+    read through a memory map and copied into a SimpleITK image on a hit.
+    The key depends on the content and geometry of the preprocessed
+    (normalized, resampled and cropped) image and on the filter settings,
+    so sweeps over feature-only settings such as binWidth or featureClass
+    skip filtering entirely. The mask is only part of the key when one of
+    the image types depends on it (see `MASK_DEPENDENT_IMAGE_TYPES`).
+    """
+
+    suffix = ".filtered"
+
+    def make_key(
+        self,
+        image: sitk.Image,
+        mask: sitk.Image,
+        image_types: dict,
+        settings: dict,
+    ) -> str:
+        filter_settings = {
+            name: value
+            for name, value in settings.items()
+            if name not in FEATURE_ONLY_SETTINGS
+        }
+        hasher = hashlib.sha256()
+        hasher.update(sitk.GetArrayViewFromImage(image).tobytes())
+        if MASK_DEPENDENT_IMAGE_TYPES.intersection(image_types):
+            hasher.update(b"\0")
+            hasher.update(sitk.GetArrayViewFromImage(mask).tobytes())
+        for part in (
+            str(image.GetPixelIDValue()),
+            str(image.GetSize()),
+            str(image.GetOrigin()),
+            str(image.GetSpacing()),
+            str(image.GetDirection()),
+            yaml.safe_dump(image_types, sort_keys=True),
+            yaml.safe_dump(filter_settings, sort_keys=True),
+            radiomics.__version__,
+        ):
+            hasher.update(part.encode())
+            hasher.update(b"\0")
+        return hasher.hexdigest()
+
+    def _read(self, entry_path: Path) -> list[tuple[sitk.Image, str, str]]:
+        with open(entry_path / "index.json") as f:
+            index = json.load(f)
+        filtered_images = []
+        for i, item in enumerate(index):
+            arr = np.load(entry_path / f"{i}.npy", mmap_mode="r")
+            image = sitk.GetImageFromArray(arr)
+            image.SetOrigin(item["origin"])
+            image.SetSpacing(item["spacing"])
+            image.SetDirection(item["direction"])
+            filtered_images.append(
+                (image, item["image_type_name"], item["image_type"])
+            )
+        return filtered_images
+
+    def _write(
+        self, entry_path: Path, value: list[tuple[sitk.Image, str, str]]
+    ) -> None:
+        entry_path.mkdir()
+        index = []
+        for i, (image, image_type_name, image_type) in enumerate(value):
+            arr = sitk.GetArrayViewFromImage(image)
+            np.save(entry_path / f"{i}.npy", arr)
+            index.append(
+                {
+                    "image_type": image_type,
+                    "image_type_name": image_type_name,
+                    "origin": image.GetOrigin(),
+                    "spacing": image.GetSpacing(),
+                    "direction": image.GetDirection(),
+                }
+            )
+        with open(entry_path / "index.json", "w") as f:
+            json.dump(index, f)
@@ -1,22 +1,484 @@
+import contextlib
+import functools
+import itertools
 import logging
+import os
+import time
+from concurrent.futures import (
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+)
 from pathlib import Path
+from typing import Callable, Iterator, Sequence
 
 import mlflow
+import numpy as np
 import pandas as pd
-from pqdm.processes import pqdm
-from radiomics import featureextractor
+import pywt
+import SimpleITK as sitk
+from radiomics import featureextractor, imageoperations
 from tqdm import tqdm
 
 from autorad.config import config
 from autorad.config.type_definitions import PathLike
 from autorad.data import ImageDataset
-from autorad.utils import io, mlflow_utils, utils
+from autorad.feature_extraction.cache import (
+    MASK_DEPENDENT_IMAGE_TYPES,
+    FeatureCache,
+    FilteredImageCache,
+)
+from autorad.feature_extraction.prefetch import PrefetchingLoader
+from autorad.feature_extraction.writer import ParquetFeatureWriter
+from autorad.utils import io, mlflow_utils, spatial, utils
 
 log = logging.getLogger(__name__)
 
 # Silence the pyRadiomics logger
 logging.getLogger("radiomics").setLevel(logging.WARNING)
 
+# Voxels kept around the region sampled by an interpolator, so that the
+# spline coefficients of a cropped image match those of the full image
+INTERPOLATION_MARGIN = 10
+# Margin around the ROI for the LoG filter, as a multiple of sigma
+LOG_TRUNCATE = 8
+# Image types scaled by statistics of the whole image, which change
+# when the image is cropped
+GLOBAL_IMAGE_TYPES = {"Exponential", "Logarithm", "Square", "SquareRoot"}
+
+
+def _is_multilabel(mask_label) -> bool:
+    return isinstance(mask_label, (list, tuple))
+
+
+def _as_rows(result: dict | list[dict] | None) -> list[dict]:
+    """Feature dicts of a case, for both single and multi-label results."""
+    if isinstance(result, dict):
+        return [result]
+    if isinstance(result, list):
+        return result
+    return []
+
+
+def estimate_case_cost(
+    mask_path: PathLike, mask_label: int | Sequence[int] | None = None
+) -> float:
+    """
+    Cheap estimate of the extraction cost of a case: the physical volume
+    (in mm3) of the bounding box of the ROI, which determines the size of
+    the resampled and filtered region.
+    Returns:
+        the estimated cost, or 0 if the mask cannot be read
+    """
+    try:
+        mask = io.read_segmentation_sitk(Path(mask_path))
+    except Exception as e:
+        log.debug(f"Could not estimate the cost of {mask_path}: {e}")
+        return 0.0
+    arr = sitk.GetArrayViewFromImage(mask)
+    if _is_multilabel(mask_label):
+        roi = np.isin(arr, mask_label)
+    elif mask_label is not None:
+        roi = arr == mask_label
+    else:
+        roi = arr != 0
+    extent = []
+    for axis in range(roi.ndim):
+        other_axes = tuple(a for a in range(roi.ndim) if a != axis)
+        indices = np.flatnonzero(roi.any(axis=other_axes))
+        if indices.size == 0:
+            return 0.0
+        extent.append(indices[-1] - indices[0] + 1)
+    return float(np.prod(extent) * np.prod(mask.GetSpacing()))
+
+
+def _normalize_image(
+    image: sitk.Image, mean: float, sigma: float, settings: dict
+) -> sitk.Image:
+    """
+    Same as imageoperations.normalizeImage, but with the given mean and
+    standard deviation, so that a cropped image is normalized exactly like
+    the full one.
+    """
+    image = sitk.ShiftScale(
+        sitk.Cast(image, sitk.sitkFloat64), -mean, 1 / sigma
+    )
+    outliers = settings.get("removeOutliers")
+    if outliers is not None:
+        arr = sitk.GetArrayFromImage(image)
+        arr[arr > outliers] = outliers
+        arr[arr < -outliers] = -outliers
+        clipped = sitk.GetImageFromArray(arr)
+        clipped.CopyInformation(image)
+        image = clipped
+    return image * settings.get("normalizeScale", 1)
+
+
+def extract_features_for_case(
+    extractor: "PyRadiomicsExtractorWrapper",
+    image_path: PathLike,
+    mask_path: PathLike,
+    ID: str | None = None,
+    mask_label: int | Sequence[int] | None = None,
+    image: sitk.Image | None = None,
+    ID_colname: str = "ID",
+    timeout: float | None = None,
+    timings: list[dict] | None = None,
+    mask: sitk.Image | None = None,
+) -> dict | list[dict] | None:
+    """
+    Extract features for a single image, mask pair.
+    Args:
+        image, mask: already decoded image and mask. If given, they are
+            used instead of reading `image_path` and `mask_path`.
+        timeout: maximum extraction time in seconds, after which
+            the case is skipped
+        timings: if given, a dict with the time in seconds spent in each
+            extraction stage is appended to it
+    Returns:
+        dict with extracted features, a list of such dicts (one per label)
+        if `mask_label` is a list, or None if the extraction failed
+    """
+    image_path = Path(image_path)
+    mask_path = Path(mask_path)
+
+    if image is None and not image_path.exists():
+        log.warning(f"Image not found. Skipping case... (path={image_path}")
+        return None
+    if mask is None and not mask_path.exists():
+        log.warning(f"Mask not found. Skipping case... (path={mask_path}")
+        return None
+    try:
+        with utils.time_limit(timeout):
+            if _is_multilabel(mask_label):
+                features_by_label = extractor.execute_multilabel(
+                    image if image is not None else image_path,
+                    mask if mask is not None else mask_path,
+                    labels=mask_label,
+                )
+                feature_dict = [
+                    {"mask_label": label, **features}
+                    for label, features in features_by_label.items()
+                ]
+            else:
+                feature_dict = extractor.execute(
+                    image if image is not None else image_path,
+                    mask if mask is not None else mask_path,
+                    label=mask_label,
+                )
+    except utils.TimeLimitExceeded:
+        log.error(
+            f"Extraction timed out after {timeout}s. Skipping case... "
+            f"(image={image_path}, mask={mask_path})"
+        )
+        feature_dict = None
+    except Exception as e:
+        error_msg = f"Error extracting features for image, mask pair: {image_path}, {mask_path}"
+        log.error(error_msg)
+        log.error(f"Original error: {e}")
+        feature_dict = None
+    if timings is not None:
+        timings.append({ID_colname: ID, **extractor.timings})
+    if feature_dict is None:
+        return None
+
+    if ID is not None:
+        for row in _as_rows(feature_dict):
+            row[ID_colname] = ID
+
+    return feature_dict
+
+
+def extract_features_for_image(
+    extractor: "PyRadiomicsExtractorWrapper",
+    image_path: PathLike,
+    mask_paths: list[PathLike],
+    IDs: list[str | None],
+    mask_label: int | Sequence[int] | None = None,
+    ID_colname: str = "ID",
+    timeout: float | None = None,
+    timings: list[dict] | None = None,
+    image: sitk.Image | None = None,
+    masks: list[sitk.Image | None] | None = None,
+) -> list[dict | list[dict] | None]:
+    """
+    Extract features for all the masks drawn on the same image,
+    decoding the image only once.
+    Args:
+        image, masks: already decoded (e.g. prefetched) image and masks.
+            Missing ones are read from `image_path` and `mask_paths`.
+        timeout: maximum extraction time per mask in seconds
+        timings: if given, the stage timings of every mask are appended
+            to it, with the image reading time split evenly between them
+    """
+    image_path = Path(image_path)
+    if masks is None:
+        masks = [None] * len(mask_paths)
+    read_time = 0.0
+    if image is None:
+        if not image_path.exists():
+            log.warning(
+                f"Image not found. Skipping {len(IDs)} case(s)... "
+                f"(path={image_path}"
+            )
+            return [None] * len(IDs)
+        start = time.perf_counter()
+        try:
+            image = io.read_image_sitk(image_path)
+        except Exception as e:
+            log.error(f"Error reading image: {image_path}")
+            log.error(f"Original error: {e}")
+            return [None] * len(IDs)
+        read_time = time.perf_counter() - start
+    case_timings: list[dict] = []
+    results = [
+        extract_features_for_case(
+            extractor,
+            image_path,
+            mask_path,
+            ID,
+            mask_label=mask_label,
+            image=image,
+            ID_colname=ID_colname,
+            timeout=timeout,
+            timings=case_timings,
+            mask=mask,
+        )
+        for mask_path, ID, mask in zip(mask_paths, IDs, masks)
+    ]
+    if timings is not None:
+        if read_time:
+            for case_timing in case_timings:
+                case_timing["read_image"] = read_time / len(IDs)
+        timings.extend(case_timings)
+    return results
+
+
+# Extractor of the current ExtractionPool worker process, built once by
+# the pool initializer
+_worker_extractor: "PyRadiomicsExtractorWrapper | None" = None
+
+
+def _init_pool_worker(
+    extraction_params: PathLike | dict,
+    filtered_image_cache_dir: PathLike | None,
+    filtered_image_cache_max_size: int | None,
+    crop_to_roi: bool,
+):
+    global _worker_extractor
+    filtered_image_cache = (
+        FilteredImageCache(
+            filtered_image_cache_dir, max_size=filtered_image_cache_max_size
+        )
+        if filtered_image_cache_dir is not None
+        else None
+    )
+    _worker_extractor = PyRadiomicsExtractorWrapper(
+        extraction_params,
+        filtered_image_cache=filtered_image_cache,
+        crop_to_roi=crop_to_roi,
+    )
+
+
+def _extract_in_pool_worker(
+    image_path: PathLike,
+    mask_paths: list[PathLike],
+    IDs: list[str | None],
+    mask_label: int | Sequence[int] | None,
+    ID_colname: str,
+    timeout: float | None,
+) -> tuple[list[dict | list[dict] | None], float, list[dict]]:
+    start = time.perf_counter()
+    timings: list[dict] = []
+    results = extract_features_for_image(
+        _worker_extractor,
+        image_path,
+        mask_paths,
+        IDs,
+        mask_label=mask_label,
+        ID_colname=ID_colname,
+        timeout=timeout,
+        timings=timings,
+    )
+    return results, time.perf_counter() - start, timings
+
+
+def _extract_groups_in_pool_worker(
+    groups: list[tuple[str, list[str], list[str | None]]],
+    mask_label: int | Sequence[int] | None,
+    ID_colname: str,
+    timeout: float | None,
+    prefetch_max_memory: int | None,
+) -> list[tuple[list[dict | list[dict] | None], float, list[dict]]]:
+    """
+    Extract a chunk of groups, reading the images of the next groups
+    while the current one is being extracted.
+    """
+    if len(groups) == 1:
+        image_path, mask_paths, IDs = groups[0]
+        return [
+            _extract_in_pool_worker(
+                image_path, mask_paths, IDs, mask_label, ID_colname, timeout
+            )
+        ]
+    loader = PrefetchingLoader(
+        groups,
+        n_prefetch=len(groups) - 1,
+        max_memory=prefetch_max_memory,
+        mask_label=None if _is_multilabel(mask_label) else mask_label,
+    )
+    chunk_results = []
+    for (image_path, mask_paths, IDs), image, masks in loader:
+        start = time.perf_counter()
+        timings: list[dict] = []
+        results = extract_features_for_image(
+            _worker_extractor,
+            image_path,
+            mask_paths,
+            IDs,
+            mask_label=mask_label,
+            ID_colname=ID_colname,
+            timeout=timeout,
+            timings=timings,
+            image=image,
+            masks=masks,
+        )
+        chunk_results.append((results, time.perf_counter() - start, timings))
+    return chunk_results
+
+
+class ExtractionPool:
+    """
+    Long-lived pool of worker processes, each holding a
+    PyRadiomicsExtractorWrapper built once from the extraction parameters.
+    Tasks only carry paths, IDs and the mask label, and the same pool can
+    be reused by several FeatureExtractor runs and by the Inferrer.
+    """
+
+    def __init__(
+        self,
+        extraction_params: PathLike | dict,
+        n_jobs: int | None = None,
+        filtered_image_cache_dir: PathLike | None = None,
+        filtered_image_cache_max_size: int | None = None,
+        crop_to_roi: bool = False,
+    ):
+        """
+        Args:
+            extraction_params: path to the pyradiomics parameter file,
+                or the parameters as a dict
+            n_jobs: number of worker processes. Defaults to the number
+                of CPUs.
+            filtered_image_cache_dir: directory of the derived image cache
+                shared by the workers
+            filtered_image_cache_max_size: maximum size of the derived
+                image cache in bytes
+            crop_to_roi: crop the images to the ROI before preprocessing
+                (see PyRadiomicsExtractorWrapper)
+        """
+        if not isinstance(extraction_params, dict):
+            extraction_params = str(extraction_params)
+        self.extraction_params = extraction_params
+        self.crop_to_roi = crop_to_roi
+        self.n_jobs = utils.set_n_jobs(n_jobs) or os.cpu_count()
+        self._executor = ProcessPoolExecutor(
+            self.n_jobs,
+            initializer=_init_pool_worker,
+            initargs=(
+                extraction_params,
+                filtered_image_cache_dir,
+                filtered_image_cache_max_size,
+                crop_to_roi,
+            ),
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def extraction_param_dict(self) -> dict:
+        if isinstance(self.extraction_params, dict):
+            return self.extraction_params
+        return io.load_yaml(self.extraction_params)
+
+    def submit(
+        self,
+        image_path: PathLike,
+        mask_paths: list[PathLike],
+        IDs: list[str | None],
+        mask_label: int | Sequence[int] | None = None,
+        ID_colname: str = "ID",
+        timeout: float | None = None,
+    ) -> Future:
+        """
+        Schedule the extraction for all masks of one image.
+        Args:
+            timeout: maximum extraction time per mask in seconds
+        Returns:
+            future resolving to a list with the features of every mask,
+            the time in seconds the worker spent on the task and the
+            stage timings of every mask
+        """
+        return self._executor.submit(
+            _extract_in_pool_worker,
+            str(image_path),
+            [str(mask_path) for mask_path in mask_paths],
+            list(IDs),
+            mask_label,
+            ID_colname,
+            timeout,
+        )
+
+    def submit_prefetching(
+        self,
+        groups: list[tuple[PathLike, list[PathLike], list[str | None]]],
+        mask_label: int | Sequence[int] | None = None,
+        ID_colname: str = "ID",
+        timeout: float | None = None,
+        prefetch_max_memory: int | None = None,
+    ) -> Future:
+        """
+        Schedule the extraction for several images in one worker, which
+        reads the next images in the background while extracting.
+        Args:
+            groups: (image path, mask paths, IDs) for every image
+            prefetch_max_memory: maximum size in bytes of the images
+                read ahead
+        Returns:
+            future resolving to a list with the same values as `submit`
+            for every group
+        """
+        return self._executor.submit(
+            _extract_groups_in_pool_worker,
+            [
+                (str(image_path), [str(m) for m in mask_paths], list(IDs))
+                for image_path, mask_paths, IDs in groups
+            ],
+            mask_label,
+            ID_colname,
+            timeout,
+            prefetch_max_memory,
+        )
+
+    def extract(
+        self,
+        image_path: PathLike,
+        mask_path: PathLike,
+        mask_label: int | Sequence[int] | None = None,
+    ) -> dict | list[dict] | None:
+        """Extract features for a single case and wait for the result."""
+        results, _, _ = self.submit(
+            image_path, [mask_path], [None], mask_label=mask_label
+        ).result()
+        return results[0]
+
+    def close(self):
+        self._executor.shutdown()
+
 
 class FeatureExtractor:
     def __init__(
@@ -25,6 +487,16 @@ class FeatureExtractor:
         feature_set: str = "pyradiomics",
         extraction_params: PathLike = "CT_Baessler.yaml",
         n_jobs: int | None = None,
+        cache_dir: PathLike | None = None,
+        cache_max_size: int | None = None,
+        filtered_image_cache_dir: PathLike | None = None,
+        filtered_image_cache_max_size: int | None = None,
+        pool: ExtractionPool | None = None,
+        case_timeout: float | None = None,
+        schedule_by_size: bool = True,
+        crop_to_roi: bool = False,
+        prefetch: int = 0,
+        prefetch_max_memory: int | None = None,
     ):
         """
         Args:
@@ -35,6 +507,37 @@ class FeatureExtractor:
                 default extraction parameter directory
                 (autorad.config.pyradiomics_params)
             n_jobs: number of parallel jobs to run
+            cache_dir: directory for the persistent feature cache. If set,
+                cases with unchanged image, mask and parameters are not
+                extracted again.
+            cache_max_size: maximum size of the feature cache in bytes.
+                Least recently used entries are evicted first.
+            filtered_image_cache_dir: directory for the cache of derived
+                images (Wavelet, LoG, ...). If set, changing only
+                feature-related settings (e.g. binWidth, featureClass)
+                does not trigger filtering again.
+            filtered_image_cache_max_size: maximum size of the derived image
+                cache in bytes.
+            pool: ExtractionPool to run the extraction in. It has to use
+                the same extraction parameters. If None and n_jobs > 1,
+                a pool is started on the first run and reused by later
+                runs until `close` is called (or the extractor is used as
+                a context manager).
+            case_timeout: maximum extraction time per case in seconds.
+                Cases taking longer are skipped and logged.
+            schedule_by_size: in parallel runs, submit the cases with
+                the largest ROI first, so that the biggest cases do not
+                end up running alone at the end of the run.
+            crop_to_roi: crop each image to the bounding box of the ROI,
+                plus the margin needed for resampling and filtering, before
+                preprocessing. Gives the same features at a fraction of the
+                time and memory for small ROIs in large images.
+            prefetch: number of images (with their masks) to read ahead in
+                background threads while extracting, to overlap slow
+                reading with computation. In parallel runs, every worker
+                reads ahead within chunks of `prefetch + 1` images.
+            prefetch_max_memory: maximum size in bytes of the images read
+                ahead (per worker in parallel runs).
         Returns:
             None
         """
@@ -45,8 +548,68 @@ class FeatureExtractor:
         )
         log.info(f"Using extraction params from {self.extraction_params}")
         self.n_jobs = utils.set_n_jobs(n_jobs)
+        self.cache = (
+            FeatureCache(cache_dir, max_size=cache_max_size)
+            if cache_dir is not None
+            else None
+        )
+        self.filtered_image_cache = (
+            FilteredImageCache(
+                filtered_image_cache_dir,
+                max_size=filtered_image_cache_max_size,
+            )
+            if filtered_image_cache_dir is not None
+            else None
+        )
+        self.crop_to_roi = crop_to_roi
+        self.prefetch = prefetch
+        self.prefetch_max_memory = prefetch_max_memory
+        if pool is not None and pool.extraction_param_dict != io.load_yaml(
+            self.extraction_params
+        ):
+            raise ValueError(
+                "The pool uses different extraction parameters than "
+                f"{self.extraction_params}."
+            )
+        if pool is not None and pool.crop_to_roi != crop_to_roi:
+            raise ValueError("The pool uses a different crop_to_roi setting.")
+        self.pool = pool
+        self._owns_pool = False
+        self.case_timeout = case_timeout
+        self.schedule_by_size = schedule_by_size
+        self.core_utilization: float | None = None
+        # Time spent in each extraction stage per case in the last run
+        self.timings = pd.DataFrame()
         self._initialize_extractor()
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Shut down the worker pool started by this extractor."""
+        if self._owns_pool and self.pool is not None:
+            self.pool.close()
+            self.pool = None
+            self._owns_pool = False
+
+    def _get_pool(self) -> ExtractionPool:
+        if self.pool is None:
+            cache = self.filtered_image_cache
+            self.pool = ExtractionPool(
+                self.extraction_params,
+                n_jobs=self.n_jobs,
+                filtered_image_cache_dir=cache.cache_dir if cache else None,
+                filtered_image_cache_max_size=cache.max_size
+                if cache
+                else None,
+                crop_to_roi=self.crop_to_roi,
+            )
+            self._owns_pool = True
+        return self.pool
+
     def _get_extraction_param_path(self, extraction_params: PathLike) -> str:
         default_extraction_param_dir = Path(config.PARAM_DIR)
         if Path(extraction_params).is_file():
@@ -60,7 +623,12 @@ class FeatureExtractor:
         return str(result_path)
 
     def run(
-        self, keep_metadata=True, mask_label: int | None = None
+        self,
+        keep_metadata=True,
+        mask_label: int | Sequence[int] | None = None,
+        output_dir: PathLike | None = None,
+        resume: bool = False,
+        log_timings: bool = False,
     ) -> pd.DataFrame:
         """
         Run feature extraction.
@@ -69,15 +637,32 @@ class FeatureExtractor:
                 ImageDataset.df.
             mask_label: label in the mask to extract features from.
                 For default value of None, the `label` value from extraction
-                param file is used. Set this when you have multiple labels in your mask
+                param file is used. Set this when you have multiple labels in your mask.
+                If a list of labels is given, features are extracted for
+                every label, resulting in a long DataFrame with one row per
+                (ID, label) and the label in the `mask_label` column. The
+                features are the same as with one run per label; every
+                case is read once, and also filtered once unless resampling
+                is enabled (the resampling grid depends on the label).
+            output_dir: if set, features are written to Parquet files in
+                this directory as cases finish, instead of being kept
+                in memory until the end of the run.
+            resume: skip the IDs already present in `output_dir`.
+            log_timings: log the time spent in each extraction stage
+                (available in `self.timings`) as an MLflow artifact
+                of the extraction run.
         Returns:
             DataFrame containing extracted features
         """
         log.info("Extracting features")
-        if self.n_jobs is None or self.n_jobs == 1:
-            feature_df = self.get_features(mask_label=mask_label)
+        if self.pool is None and (self.n_jobs is None or self.n_jobs == 1):
+            feature_df = self.get_features(
+                mask_label=mask_label, output_dir=output_dir, resume=resume
+            )
         else:
-            feature_df = self.get_features_parallel(mask_label=mask_label)
+            feature_df = self.get_features_parallel(
+                mask_label=mask_label, output_dir=output_dir, resume=resume
+            )
         if feature_df.empty:
             raise ValueError(
                 "No features extracted. Check the logs and your dataset."
@@ -86,8 +671,12 @@ class FeatureExtractor:
         ID_colname = self.dataset.ID_colname
         # move ID column to front
         feature_df = feature_df.set_index(ID_colname).reset_index()
+        if _is_multilabel(mask_label):
+            feature_df.insert(1, "mask_label", feature_df.pop("mask_label"))
 
-        run_id = self.save_config(mask_label=mask_label)
+        run_id = self.save_config(
+            mask_label=mask_label, log_timings=log_timings
+        )
 
         # add ID for this extraction run
         feature_df.insert(1, "extraction_ID", run_id)
@@ -103,9 +692,11 @@ class FeatureExtractor:
                 raise ValueError("Error concatenating features and metadata.")
         return feature_df
 
-    def save_config(self, mask_label):
+    def save_config(self, mask_label, log_timings: bool = False):
         extraction_param_dict = io.load_yaml(self.extraction_params)
-        if mask_label is not None:
+        if _is_multilabel(mask_label):
+            extraction_param_dict["label"] = list(mask_label)
+        elif mask_label is not None:
             extraction_param_dict["label"] = mask_label
         run_config = {
             "feature_set": self.feature_set,
@@ -116,13 +707,19 @@ class FeatureExtractor:
         mlflow.set_experiment("feature_extraction")
         with mlflow.start_run() as run:
             mlflow_utils.log_dict_as_artifact(run_config, "extraction_config")
+            if log_timings and not self.timings.empty:
+                mlflow_utils.log_dataframe_as_artifact(
+                    self.timings, "stage_timings"
+                )
 
         return run.info.run_id
 
     def _initialize_extractor(self):
         if self.feature_set == "pyradiomics":
             self.extractor = PyRadiomicsExtractorWrapper(
-                str(self.extraction_params)
+                str(self.extraction_params),
+                filtered_image_cache=self.filtered_image_cache,
+                crop_to_roi=self.crop_to_roi,
             )
         else:
             raise ValueError("Feature set not supported")
@@ -134,92 +731,386 @@ class FeatureExtractor:
         image_path: PathLike,
         mask_path: PathLike,
         ID: str | None = None,
-        mask_label: int | None = None,
-    ) -> dict | None:
+        mask_label: int | Sequence[int] | None = None,
+        image: sitk.Image | None = None,
+        timings: list[dict] | None = None,
+    ) -> dict | list[dict] | None:
         """
+        Args:
+            image: already decoded image. If given, it is used instead of
+                reading `image_path` again.
+            timings: if given, the stage timings of the case are
+                appended to it
         Returns:
-            feature_series: dict with extracted features
+            feature_series: dict with extracted features, or a list of
+                such dicts (one per label) if `mask_label` is a list
         """
-        image_path = Path(image_path)
-        mask_path = Path(mask_path)
+        return extract_features_for_case(
+            self.extractor,
+            image_path,
+            mask_path,
+            ID=ID,
+            mask_label=mask_label,
+            image=image,
+            ID_colname=self.dataset.ID_colname,
+            timeout=self.case_timeout,
+            timings=timings,
+        )
 
-        if not image_path.exists():
-            log.warning(
-                f"Image not found. Skipping case... (path={image_path}"
-            )
-            return None
-        if not mask_path.exists():
-            log.warning(f"Mask not found. Skipping case... (path={mask_path}")
-            return None
-        try:
-            feature_dict = self.extractor.execute(
-                image_path, mask_path, label=mask_label
+    def get_features_for_single_image(
+        self,
+        image_path: PathLike,
+        mask_paths: list[PathLike],
+        IDs: list[str],
+        mask_label: int | Sequence[int] | None = None,
+        timings: list[dict] | None = None,
+        image: sitk.Image | None = None,
+        masks: list[sitk.Image | None] | None = None,
+    ) -> list[dict | list[dict] | None]:
+        """
+        Extract features for all the masks drawn on the same image,
+        decoding the image only once.
+        Returns:
+            list with a feature dict (or None if extraction failed) per mask
+        """
+        return extract_features_for_image(
+            self.extractor,
+            image_path,
+            mask_paths,
+            IDs,
+            mask_label=mask_label,
+            ID_colname=self.dataset.ID_colname,
+            timeout=self.case_timeout,
+            timings=timings,
+            image=image,
+            masks=masks,
+        )
+
+    @staticmethod
+    def _group_cases_by_image(
+        cases: list[tuple[str, str, str]]
+    ) -> list[tuple[str, list[str], list[str]]]:
+        """
+        Group the cases sharing the same image, keeping the order
+        in which the images first appear.
+        """
+        groups: dict[str, tuple[list[str], list[str]]] = {}
+        for image_path, mask_path, id_ in cases:
+            mask_paths, ids = groups.setdefault(str(image_path), ([], []))
+            mask_paths.append(mask_path)
+            ids.append(id_)
+        return [
+            (image_path, mask_paths, ids)
+            for image_path, (mask_paths, ids) in groups.items()
+        ]
+
+    def _get_cases(self) -> list[tuple[str, str, str]]:
+        return list(
+            zip(
+                self.dataset.image_paths,
+                self.dataset.mask_paths,
+                self.dataset.ids,
             )
-        except Exception as e:
-            error_msg = f"Error extracting features for image, mask pair: {image_path}, {mask_path}"
-            log.error(error_msg)
-            log.error(f"Original error: {e}")
-            return None
+        )
 
-        if ID is not None:
-            feature_dict[self.dataset.ID_colname] = ID
+    def _lookup_cache(
+        self, cases: list[tuple[str, str, str]], mask_label=None
+    ) -> tuple[list[dict], list[tuple[str, str, str]], dict[str, str]]:
+        """
+        Split the cases into ones with features already in the cache
+        and ones that still need to be extracted.
+        Returns:
+            cached feature dicts, cases to extract, and cache keys by ID
+        """
+        if self.cache is None:
+            return [], cases, {}
+        extraction_param_dict = io.load_yaml(self.extraction_params)
+        cached_feature_dicts, cases_to_extract, keys = [], [], {}
+        for image_path, mask_path, id_ in cases:
+            if not (Path(image_path).exists() and Path(mask_path).exists()):
+                cases_to_extract.append((image_path, mask_path, id_))
+                continue
+            key = self.cache.make_key(
+                image_path, mask_path, mask_label, extraction_param_dict
+            )
+            cached = self.cache.get(key)
+            if cached is None:
+                keys[id_] = key
+                cases_to_extract.append((image_path, mask_path, id_))
+            else:
+                for feature_dict in _as_rows(cached):
+                    feature_dict[self.dataset.ID_colname] = id_
+                    cached_feature_dicts.append(feature_dict)
+        log.info(
+            f"Feature cache: {len(cached_feature_dicts)} hits, "
+            f"{len(cases_to_extract)} cases to extract"
+        )
+        return cached_feature_dicts, cases_to_extract, keys
 
-        return feature_dict
+    def _update_cache(
+        self,
+        cases: list[tuple[str, str, str]],
+        results: list[dict | list[dict] | None],
+        keys: dict[str, str],
+    ):
+        if self.cache is None:
+            return
+        ID_colname = self.dataset.ID_colname
+        for (_, _, id_), result in zip(cases, results):
+            rows = [
+                {
+                    name: value
+                    for name, value in row.items()
+                    if name != ID_colname
+                }
+                for row in _as_rows(result)
+            ]
+            if id_ not in keys or not rows:
+                continue
+            value = rows if isinstance(result, list) else rows[0]
+            self.cache.set(keys[id_], value)
 
-    @utils.time_it
-    def get_features(self, mask_label=None) -> pd.DataFrame:
+    def _extract(
+        self,
+        extract_groups: Callable,
+        mask_label=None,
+        output_dir: PathLike | None = None,
+        resume: bool = False,
+    ) -> pd.DataFrame:
         """
-        Get features for all cases.
+        Extract features for all cases, skipping cached (and, when resuming,
+        already written) cases. Results are either collected in memory or
+        streamed to Parquet files in `output_dir` as groups finish.
+        Args:
+            extract_groups: function taking the cases grouped by image and
+                the mask label, yielding (group, results, stage timings)
+                as groups finish
         """
-        lst_of_feature_dicts = [
-            self.get_features_for_single_case(
-                image_path, mask_path, id_, mask_label=mask_label
+        cases = self._get_cases()
+        writer = None
+        if output_dir is not None:
+            writer = ParquetFeatureWriter(
+                output_dir, self.dataset.ID_colname, resume=resume
             )
-            for image_path, mask_path, id_ in tqdm(
-                list(
-                    zip(
-                        self.dataset.image_paths,
-                        self.dataset.mask_paths,
-                        self.dataset.ids,
-                    )
+            if resume:
+                written_ids = writer.written_ids()
+                cases = [case for case in cases if case[2] not in written_ids]
+                log.info(
+                    f"Resuming extraction: skipping {len(written_ids)} "
+                    "already extracted cases"
                 )
+        cached_feature_dicts, cases, keys = self._lookup_cache(
+            cases, mask_label=mask_label
+        )
+        lst_of_feature_dicts = []
+        save_features = (
+            writer.write if writer is not None else lst_of_feature_dicts.extend
+        )
+        save_features(cached_feature_dicts)
+        groups = self._group_cases_by_image(cases)
+        timing_rows = []
+        for (image_path, mask_paths, ids), results, timings in extract_groups(
+            groups, mask_label
+        ):
+            timing_rows.extend(timings)
+            group_cases = [
+                (image_path, mask_path, id_)
+                for mask_path, id_ in zip(mask_paths, ids)
+            ]
+            self._update_cache(group_cases, results, keys)
+            save_features(
+                [
+                    feature_dict
+                    for result in results
+                    for feature_dict in _as_rows(result)
+                ]
             )
-        ]
-        lst_of_feature_dicts = [
-            feature_dict
-            for feature_dict in lst_of_feature_dicts
-            if feature_dict is not None
-        ]
-        feature_df = pd.DataFrame(lst_of_feature_dicts)
-        return feature_df
+        self._set_timings(timing_rows)
+        if writer is not None:
+            feature_df = writer.read()
+        else:
+            feature_df = pd.DataFrame(lst_of_feature_dicts)
+        return self._sort_by_dataset_order(feature_df)
 
-    @utils.time_it
-    def get_features_parallel(self, mask_label=None) -> pd.DataFrame:
-        lst_of_feature_dicts = pqdm(
-            (
-                {
-                    "image_path": vals[0],
-                    "mask_path": vals[1],
-                    "ID": vals[2],
-                    "mask_label": mask_label,
-                }
-                for vals in zip(
-                    self.dataset.image_paths,
-                    self.dataset.mask_paths,
-                    self.dataset.ids,
+    def _set_timings(self, timing_rows: list[dict]):
+        """
+        Collect the stage timings of the extracted cases in `self.timings`,
+        with one row per case and one column per stage (in seconds).
+        """
+        ID_colname = self.dataset.ID_colname
+        timings = pd.DataFrame(timing_rows)
+        if timings.empty:
+            self.timings = timings
+            return
+        timings = timings.set_index(ID_colname).fillna(0.0).reset_index()
+        self.timings = self._sort_by_dataset_order(timings)
+        total_by_stage = self.timings.drop(columns=ID_colname).sum()
+        log.info(
+            "Time per stage (s): "
+            + ", ".join(
+                f"{stage}={seconds:.2f}"
+                for stage, seconds in total_by_stage.sort_values(
+                    ascending=False
+                ).items()
+            )
+        )
+
+    def _sort_by_dataset_order(self, feature_df: pd.DataFrame) -> pd.DataFrame:
+        if feature_df.empty:
+            return feature_df
+        order = {id_: i for i, id_ in enumerate(self.dataset.ids)}
+        positions = feature_df[self.dataset.ID_colname].map(order)
+        return feature_df.iloc[positions.argsort(kind="stable")].reset_index(
+            drop=True
+        )
+
+    def _extract_groups_serial(
+        self, groups: list[tuple[str, list[str], list[str]]], mask_label
+    ) -> Iterator[tuple[tuple, list, list[dict]]]:
+        if self.prefetch > 0:
+            loaded_groups = PrefetchingLoader(
+                groups,
+                n_prefetch=self.prefetch,
+                max_memory=self.prefetch_max_memory,
+                mask_label=None if _is_multilabel(mask_label) else mask_label,
+            )
+        else:
+            loaded_groups = ((group, None, None) for group in groups)
+        for group, image, masks in tqdm(loaded_groups, total=len(groups)):
+            image_path, mask_paths, ids = group
+            timings: list[dict] = []
+            results = self.get_features_for_single_image(
+                image_path,
+                mask_paths,
+                ids,
+                mask_label=mask_label,
+                timings=timings,
+                image=image,
+                masks=masks,
+            )
+            yield group, results, timings
+
+    def _extract_groups_parallel(
+        self, groups: list[tuple[str, list[str], list[str]]], mask_label
+    ) -> Iterator[tuple[tuple, list, list[dict]]]:
+        pool = self._get_pool()
+        if self.schedule_by_size:
+            groups = self._sort_groups_by_cost(groups, mask_label)
+        # Every task holds `prefetch + 1` groups, so that the worker can
+        # read the next images while extracting. Groups are dealt
+        # round-robin, so that the largest ones (first after sorting) end
+        # up in different tasks instead of queueing on the same worker.
+        n_chunks = -(-len(groups) // (self.prefetch + 1))
+        chunks = [groups[i::n_chunks] for i in range(n_chunks)]
+        start = time.perf_counter()
+        busy_time = 0.0
+        futures = {
+            pool.submit_prefetching(
+                chunk,
+                mask_label=mask_label,
+                ID_colname=self.dataset.ID_colname,
+                timeout=self.case_timeout,
+                prefetch_max_memory=self.prefetch_max_memory,
+            ): chunk
+            for chunk in chunks
+        }
+        progress = tqdm(total=len(groups))
+        for future in as_completed(futures):
+            chunk = futures[future]
+            try:
+                chunk_results = future.result()
+            except Exception as e:
+                ids = [id_ for group in chunk for id_ in group[2]]
+                log.error(f"Extraction failed for IDs {ids}: {e}")
+                chunk_results = [
+                    ([None] * len(group[2]), 0.0, []) for group in chunk
+                ]
+            for group, (results, task_time, timings) in zip(
+                chunk, chunk_results
+            ):
+                busy_time += task_time
+                progress.update()
+                yield group, results, timings
+        progress.close()
+        wall_time = time.perf_counter() - start
+        if groups and wall_time > 0:
+            self.core_utilization = busy_time / (wall_time * pool.n_jobs)
+            log.info(
+                f"Core utilization: {self.core_utilization:.0%} "
+                f"({busy_time:.1f}s of work in {wall_time:.1f}s "
+                f"on {pool.n_jobs} workers)"
+            )
+
+    def _sort_groups_by_cost(
+        self, groups: list[tuple[str, list[str], list[str]]], mask_label
+    ) -> list[tuple[str, list[str], list[str]]]:
+        """
+        Order the groups from the most to the least expensive, based on
+        the bounding box of their masks. The bounding boxes are taken from
+        the dataset index if it was built (see `ImageDataset.build_index`).
+        """
+        mask_paths = [
+            mask_path
+            for _, group_masks, _ in groups
+            for mask_path in group_masks
+        ]
+        costs = {}
+        if self.dataset.index is not None and mask_label is None:
+            costs = dict(
+                zip(
+                    self.dataset.index["mask_path"],
+                    self.dataset.index["bbox_volume_mm3"].fillna(0.0),
                 )
+            )
+        to_estimate = [p for p in mask_paths if str(p) not in costs]
+        estimate = functools.partial(estimate_case_cost, mask_label=mask_label)
+        with ThreadPoolExecutor(self.n_jobs) as executor:
+            costs.update(
+                zip(
+                    map(str, to_estimate),
+                    executor.map(estimate, to_estimate),
+                )
+            )
+        return sorted(
+            groups,
+            key=lambda group: sum(
+                costs[str(mask_path)] for mask_path in group[1]
             ),
-            self.get_features_for_single_case,
-            n_jobs=self.n_jobs,
-            argument_type="kwargs",
-        )
-        lst_of_feature_dicts = [
-            feature_dict
-            for feature_dict in lst_of_feature_dicts
-            if feature_dict is not None
-        ]
-        feature_df = pd.DataFrame(lst_of_feature_dicts)
-        return feature_df
+            reverse=True,
+        )
+
+    @utils.time_it
+    def get_features(
+        self,
+        mask_label=None,
+        output_dir: PathLike | None = None,
+        resume: bool = False,
+    ) -> pd.DataFrame:
+        """
+        Get features for all cases.
+        Cases sharing an image are processed together, so that each image
+        is read only once.
+        """
+        return self._extract(
+            self._extract_groups_serial,
+            mask_label=mask_label,
+            output_dir=output_dir,
+            resume=resume,
+        )
+
+    @utils.time_it
+    def get_features_parallel(
+        self,
+        mask_label=None,
+        output_dir: PathLike | None = None,
+        resume: bool = False,
+    ) -> pd.DataFrame:
+        return self._extract(
+            self._extract_groups_parallel,
+            mask_label=mask_label,
+            output_dir=output_dir,
+            resume=resume,
+        )
 
     def get_pyradiomics_feature_names(self) -> list[str]:
         class_obj = featureextractor.getFeatureClasses()
@@ -233,23 +1124,464 @@ class FeatureExtractor:
 
 
 class PyRadiomicsExtractorWrapper(featureextractor.RadiomicsFeatureExtractor):
-    """Wrapper that filters out extracted metadata"""
+    """
+    Wrapper that reads images with autorad.utils.io and skips the
+    diagnostic metadata. Extraction is split into preprocessing (loading,
+    resampling, filtering) and per-label feature computation, so that one
+    preprocessed case can serve several labels of the same mask.
+    """
 
-    def __init__(self, extraction_params: PathLike, *args, **kwargs):
-        super().__init__(str(extraction_params), *args, **kwargs)
+    def __init__(
+        self,
+        extraction_params: PathLike | dict,
+        *args,
+        filtered_image_cache: FilteredImageCache | None = None,
+        crop_to_roi: bool = False,
+        **kwargs,
+    ):
+        """
+        Args:
+            filtered_image_cache: cache of the derived images
+            crop_to_roi: crop the image to the ROI bounding box, plus the
+                margin needed for resampling and filtering, before any
+                preprocessing. Features match the uncropped extraction up
+                to floating point rounding (e.g. integer images resampled
+                onto the original grid may differ by one grey level).
+        """
+        if not isinstance(extraction_params, dict):
+            extraction_params = str(extraction_params)
+        super().__init__(extraction_params, *args, **kwargs)
+        self.filtered_image_cache = filtered_image_cache
+        self.crop_to_roi = crop_to_roi
+        global_image_types = GLOBAL_IMAGE_TYPES & set(self.enabledImagetypes)
+        if crop_to_roi and not self._resampling_enabled and global_image_types:
+            log.warning(
+                f"Image types {sorted(global_image_types)} depend on the whole "
+                "image. Set resampledPixelSpacing to enable cropping to ROI."
+            )
+        # Time in seconds spent in each stage of the last extraction
+        self.timings: dict[str, float] = {}
+
+    @contextlib.contextmanager
+    def _timed(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[stage] = (
+                self.timings.get(stage, 0.0) + time.perf_counter() - start
+            )
 
     def execute(
         self,
-        image_path: PathLike,
-        mask_path: PathLike,
+        image_path: PathLike | sitk.Image,
+        mask_path: PathLike | sitk.Image,
         label: int | None = None,
     ) -> dict:
-        img = io.read_image_sitk(Path(image_path))
-        mask = io.read_segmentation_sitk(Path(mask_path), label=label)
-        feature_dict = dict(super().execute(img, mask, label=label))
-        feature_dict_without_metadata = {
-            feature_name: feature_dict[feature_name]
-            for feature_name in feature_dict.keys()
-            if "diagnostic" not in feature_name
-        }
-        return feature_dict_without_metadata
+        self.timings = {}
+        img, mask = self._read_inputs(image_path, mask_path, label=label)
+        if label is None:
+            label = self.settings.get("label", 1)
+        preprocessed = self.preprocess(img, mask, [label])
+        return self.compute_label_features(*preprocessed, label=label)
+
+    def execute_multilabel(
+        self,
+        image_path: PathLike | sitk.Image,
+        mask_path: PathLike | sitk.Image,
+        labels: Sequence[int],
+    ) -> dict[int, dict]:
+        """
+        Extract features for several labels of one mask, with the same
+        results as extracting every label separately.
+        The image is read (and normalized) once. It is also resampled and
+        filtered once for all labels, unless the resampling grid or the
+        filters depend on the label (resampling enabled, or LBP3D), in
+        which case that is done for every label.
+        Returns:
+            dict mapping each label found in the mask to its features
+        """
+        self.timings = {}
+        img, mask = self._read_inputs(image_path, mask_path)
+        mask_labels = np.unique(sitk.GetArrayViewFromImage(mask))
+        present_labels = [label for label in labels if label in mask_labels]
+        for label in labels:
+            if label not in present_labels:
+                log.warning(f"Label {label} not present in mask. Skipping.")
+        if not present_labels:
+            raise ValueError(f"None of the labels {labels} found in mask.")
+        settings = None
+        if self._filtering_depends_on_label:
+            settings = self.settings.copy()
+            if settings.get("normalize", False):
+                with self._timed("preprocess"):
+                    img = imageoperations.normalizeImage(img, **settings)
+                settings["normalize"] = False
+            label_groups = [[label] for label in present_labels]
+        else:
+            label_groups = [present_labels]
+        result = {}
+        for label_group in label_groups:
+            try:
+                preprocessed = self.preprocess(
+                    img, mask, label_group, settings=settings
+                )
+            except ValueError as e:
+                log.error(f"Error preprocessing labels {label_group}: {e}")
+                continue
+            for label in label_group:
+                try:
+                    result[label] = self.compute_label_features(
+                        *preprocessed, label=label
+                    )
+                except ValueError as e:
+                    log.error(
+                        f"Error extracting features for label {label}: {e}"
+                    )
+        return result
+
+    @property
+    def _filtering_depends_on_label(self) -> bool:
+        """
+        Whether the preprocessed and filtered images of a label depend on
+        the label: the resampling grid is cropped around it, and LBP3D
+        only filters inside the mask.
+        """
+        return self._resampling_enabled or bool(
+            MASK_DEPENDENT_IMAGE_TYPES & set(self.enabledImagetypes)
+        )
+
+    def _read_inputs(
+        self,
+        image_path: PathLike | sitk.Image,
+        mask_path: PathLike | sitk.Image,
+        label: int | None = None,
+    ) -> tuple[sitk.Image, sitk.Image]:
+        if isinstance(image_path, sitk.Image):
+            img = image_path
+        else:
+            with self._timed("read_image"):
+                img = io.read_image_sitk(Path(image_path))
+        if isinstance(mask_path, sitk.Image):
+            mask = mask_path
+        else:
+            with self._timed("read_mask"):
+                mask = io.read_segmentation_sitk(Path(mask_path), label=label)
+        return img, mask
+
+    def preprocess(
+        self,
+        img: sitk.Image,
+        mask: sitk.Image,
+        labels: Sequence[int],
+        settings: dict | None = None,
+    ) -> tuple[sitk.Image, sitk.Image, list, dict]:
+        """
+        Normalize, resample and filter the image, following the steps of
+        RadiomicsFeatureExtractor.execute.
+        Args:
+            labels: labels whose union defines the resampling grid
+            settings: settings to use instead of `self.settings`
+        Returns:
+            preprocessed image, label map on the same grid,
+            list of (filtered image, image type name, settings)
+            and the settings used
+        """
+        settings = (self.settings if settings is None else settings).copy()
+        if featureextractor.geometryTolerance != settings.get(
+            "geometryTolerance"
+        ):
+            self._setTolerance()
+        with self._timed("preprocess"):
+            mask = imageoperations.getMask(
+                mask, **{**settings, "label": labels[0]}
+            )
+            # Binary mask with the union of the labels, which defines
+            # the region used for resampling and cropping
+            roi_arr = np.isin(sitk.GetArrayViewFromImage(mask), labels)
+            roi = sitk.GetImageFromArray(roi_arr.astype(np.uint32))
+            roi.CopyInformation(mask)
+            roi_settings = {**settings, "label": 1}
+            if self.crop_to_roi:
+                img, mask, roi, roi_settings = self._crop_to_roi(
+                    img, mask, roi, roi_settings
+                )
+            image, roi = self.loadImage(img, roi, **roi_settings)
+            mask = sitk.Resample(
+                mask,
+                image,
+                sitk.Transform(),
+                sitk.sitkNearestNeighbor,
+                0,
+                mask.GetPixelID(),
+            )
+        filtered_images = self.get_filtered_images(image, roi, roi_settings)
+        return image, mask, filtered_images, settings
+
+    @property
+    def _resampling_enabled(self) -> bool:
+        return (
+            self.settings.get("interpolator") is not None
+            and self.settings.get("resampledPixelSpacing") is not None
+        )
+
+    def _crop_to_roi(
+        self,
+        img: sitk.Image,
+        mask: sitk.Image,
+        roi: sitk.Image,
+        settings: dict,
+    ) -> tuple[sitk.Image, sitk.Image, sitk.Image, dict]:
+        """
+        Crop the image to the bounding box of the ROI plus the margin read
+        by resampling, or by the filters if there is no resampling, so that
+        the rest of the volume is never normalized, resampled or filtered.
+        Normalization uses the statistics of the full image.
+        If the image cannot be cropped without changing the features, the
+        inputs are returned unchanged.
+        """
+        box_start, box_end = spatial.generate_spatial_bounding_box(
+            sitk.GetArrayViewFromImage(roi)[np.newaxis]
+        )
+        if box_start == box_end:
+            return img, mask, roi, settings
+        # generate_spatial_bounding_box works on numpy arrays, in (z, y, x)
+        roi_lower = np.array(box_start[::-1])
+        roi_upper = np.array(box_end[::-1]) - 1
+        if self._resampling_enabled:
+            region = self._resampling_region(img, mask, roi_lower, roi_upper)
+        else:
+            region = self._filtering_region(img, mask, roi_lower, roi_upper)
+        if region is None:
+            return img, mask, roi, settings
+        index, size = region
+
+        if settings.get("normalize", False):
+            stats = sitk.StatisticsImageFilter()
+            stats.Execute(img)
+            img = sitk.RegionOfInterest(img, size, index)
+            img = _normalize_image(
+                img, stats.GetMean(), stats.GetSigma(), settings
+            )
+            settings = {**settings, "normalize": False}
+        else:
+            img = sitk.RegionOfInterest(img, size, index)
+        if not self._resampling_enabled:
+            mask = sitk.RegionOfInterest(mask, size, index)
+            roi = sitk.RegionOfInterest(roi, size, index)
+        return img, mask, roi, settings
+
+    def _resampling_region(
+        self,
+        img: sitk.Image,
+        mask: sitk.Image,
+        roi_lower: np.ndarray,
+        roi_upper: np.ndarray,
+    ) -> tuple[list[int], list[int]] | None:
+        """
+        Region of the image (index and size) that the resampling grid of
+        imageoperations.resampleImage covers, plus the interpolation margin.
+        The mask is not cropped, as the grid is aligned to it.
+        """
+        mask_spacing = np.array(mask.GetSpacing())
+        new_spacing = np.array(self.settings["resampledPixelSpacing"], float)
+        new_spacing = np.where(new_spacing == 0, mask_spacing, new_spacing)
+        pad_distance = self.settings.get("padDistance", 5)
+        # Padding of the resampling grid around the ROI, in mask voxels
+        pad = (pad_distance + 1) * new_spacing / mask_spacing + 1
+        corners = itertools.product(*zip(roi_lower - pad, roi_upper + pad))
+        image_indices = np.array(
+            [
+                img.TransformPhysicalPointToContinuousIndex(
+                    mask.TransformContinuousIndexToPhysicalPoint(
+                        [float(i) for i in corner]
+                    )
+                )
+                for corner in corners
+            ]
+        )
+        margin = INTERPOLATION_MARGIN
+        lower = np.floor(image_indices.min(axis=0) - margin)
+        upper = np.ceil(image_indices.max(axis=0) + margin)
+        lower = np.maximum(lower, 0).astype(int)
+        upper = np.minimum(upper, np.array(img.GetSize()) - 1).astype(int)
+        if np.any(upper < lower):
+            return None
+        return lower.tolist(), (upper - lower + 1).tolist()
+
+    def _filtering_region(
+        self,
+        img: sitk.Image,
+        mask: sitk.Image,
+        roi_lower: np.ndarray,
+        roi_upper: np.ndarray,
+    ) -> tuple[list[int], list[int]] | None:
+        """
+        Region of the image (index and size) with the ROI and the voxels
+        read by the filters of the enabled image types.
+        Image and mask are cropped together, so they must share a grid.
+        """
+        if GLOBAL_IMAGE_TYPES & set(self.enabledImagetypes):
+            return None
+        tolerance = self.settings.get("geometryTolerance") or 1e-6
+        same_grid = img.GetSize() == mask.GetSize() and all(
+            np.allclose(a, b, atol=tolerance)
+            for a, b in (
+                (img.GetOrigin(), mask.GetOrigin()),
+                (img.GetSpacing(), mask.GetSpacing()),
+                (img.GetDirection(), mask.GetDirection()),
+            )
+        )
+        if not same_grid:
+            return None
+        margin = self._filter_margin(np.array(img.GetSpacing()))
+        lower = np.maximum(roi_lower - margin, 0)
+        upper = np.minimum(roi_upper + margin, np.array(img.GetSize()) - 1)
+        return lower.tolist(), (upper - lower + 1).tolist()
+
+    def _filter_margin(self, spacing: np.ndarray) -> np.ndarray:
+        """Voxels around the ROI read by the enabled filters, per axis."""
+        margin = np.zeros(len(spacing), dtype=int)
+        for image_type, custom_kwargs in self.enabledImagetypes.items():
+            kwargs = {**self.settings, **custom_kwargs}
+            if image_type == "LoG":
+                sigma = max(kwargs.get("sigma", []), default=0)
+                type_margin = np.ceil(LOG_TRUNCATE * sigma / spacing)
+            elif image_type == "Wavelet":
+                wavelet = pywt.Wavelet(kwargs.get("wavelet", "coif1"))
+                n_levels = kwargs.get("start_level", 0) + kwargs.get(
+                    "level", 1
+                )
+                type_margin = (wavelet.dec_len - 1) * n_levels
+            elif image_type == "Gradient":
+                type_margin = 2
+            elif image_type == "LBP2D":
+                type_margin = np.ceil(kwargs.get("lbp2DRadius", 1)) + 1
+            elif image_type == "LBP3D":
+                type_margin = (
+                    np.ceil(kwargs.get("lbp3DIcosphereRadius", 1))
+                    + INTERPOLATION_MARGIN
+                )
+            else:
+                type_margin = 0
+            margin = np.maximum(margin, type_margin).astype(int)
+        return margin
+
+    def get_filtered_images(
+        self, image: sitk.Image, roi: sitk.Image, settings: dict
+    ) -> list[tuple[sitk.Image, str, dict]]:
+        """
+        Compute the images of all enabled image types, or load them from
+        the filtered image cache.
+        Returns:
+            list of (filtered image, image type name, settings)
+        """
+        cache = self.filtered_image_cache
+        if cache is not None:
+            key = cache.make_key(image, roi, self.enabledImagetypes, settings)
+            with self._timed("load_filtered_images"):
+                cached = cache.get(key)
+            if cached is not None:
+                return [
+                    (img, name, {**settings, **self.enabledImagetypes[type_]})
+                    for img, name, type_ in cached
+                ]
+        filtered_images, image_types = [], []
+        for image_type, custom_kwargs in self.enabledImagetypes.items():
+            get_images = getattr(imageoperations, f"get{image_type}Image")
+            with self._timed(f"filter_{image_type}"):
+                for filtered_image in get_images(
+                    image, roi, **{**settings, **custom_kwargs}
+                ):
+                    filtered_images.append(filtered_image)
+                    image_types.append(image_type)
+        if cache is not None:
+            with self._timed("save_filtered_images"):
+                cache.set(
+                    key,
+                    [
+                        (img, name, type_)
+                        for (img, name, _), type_ in zip(
+                            filtered_images, image_types
+                        )
+                    ],
+                )
+        return filtered_images
+
+    def compute_label_features(
+        self,
+        image: sitk.Image,
+        mask: sitk.Image,
+        filtered_images: list,
+        settings: dict,
+        label: int,
+    ) -> dict:
+        """
+        Compute shape features and features of every filtered image
+        for a single label of a preprocessed case.
+        """
+        settings = {**settings, "label": label}
+        bounding_box, corrected_mask = imageoperations.checkMask(
+            image, mask, **settings
+        )
+        if corrected_mask is not None:
+            mask = corrected_mask
+        resegmented_mask = None
+        if settings.get("resegmentRange") is not None:
+            resegmented_mask = imageoperations.resegmentMask(
+                image, mask, **settings
+            )
+            bounding_box, _ = imageoperations.checkMask(
+                image, resegmented_mask, **settings
+            )
+        if settings.get("resegmentShape") and resegmented_mask is not None:
+            mask = resegmented_mask
+        with self._timed("features_shape"):
+            feature_dict = dict(
+                self.computeShape(image, mask, bounding_box, **settings)
+            )
+        if resegmented_mask is not None:
+            mask = resegmented_mask
+        for filtered_image, image_type_name, kwargs in filtered_images:
+            cropped_image, cropped_mask = imageoperations.cropToTumorMask(
+                filtered_image, mask, bounding_box
+            )
+            feature_dict.update(
+                self.computeFeatures(
+                    cropped_image,
+                    cropped_mask,
+                    image_type_name,
+                    **{**kwargs, "label": label},
+                )
+            )
+        return feature_dict
+
+    def computeFeatures(
+        self,
+        image: sitk.Image,
+        mask: sitk.Image,
+        imageTypeName: str,
+        **kwargs,
+    ) -> dict:
+        """
+        Same as RadiomicsFeatureExtractor.computeFeatures, but records
+        the time spent in each feature class.
+        """
+        feature_dict = {}
+        feature_classes = featureextractor.getFeatureClasses()
+        for class_name, feature_names in self.enabledFeatures.items():
+            if class_name.startswith("shape"):
+                continue
+            if class_name not in feature_classes:
+                continue
+            with self._timed(f"features_{class_name}"):
+                feature_class = feature_classes[class_name](
+                    image, mask, **kwargs
+                )
+                for feature_name in feature_names or []:
+                    feature_class.enableFeatureByName(feature_name)
+                for name, value in feature_class.execute().items():
+                    feature_dict[
+                        f"{imageTypeName}_{class_name}_{name}"
+                    ] = value
+        return feature_dict
@@ -0,0 +1,148 @@
+import json
+import logging
+import os
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import SimpleITK as sitk
+
+from autorad.config.type_definitions import PathLike
+
+log = logging.getLogger(__name__)
+
+
+class FeatureMapStore:
+    """
+    On-disk store of voxel-based feature maps, with one memory-mapped .npy
+    array per feature and the geometry of every map in `index.json`.
+    Maps are filled tile by tile as they are computed, so only the pages
+    being written are held in memory, and exported to NIfTI on demand.
+    """
+
+    def __init__(self, store_dir: PathLike):
+        """
+        Args:
+            store_dir: directory in which the maps are stored
+        """
+        self.store_dir = Path(store_dir)
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+        self._index_path = self.store_dir / "index.json"
+        if self._index_path.exists():
+            with open(self._index_path) as f:
+                self._index = json.load(f)
+        else:
+            self._index = {}
+        self._open_maps: dict[str, np.memmap] = {}
+
+    def __contains__(self, feature_name: str) -> bool:
+        return feature_name in self._index
+
+    @property
+    def feature_names(self) -> list[str]:
+        return list(self._index)
+
+    def create(
+        self, feature_name: str, reference: sitk.Image, fill_value: float = 0
+    ) -> None:
+        """
+        Create an empty map on the grid of `reference`, replacing any
+        existing map with the same name.
+        """
+        self._open_maps.pop(feature_name, None)
+        arr = np.lib.format.open_memmap(
+            self._map_path(feature_name),
+            mode="w+",
+            dtype=float,
+            shape=reference.GetSize()[::-1],
+        )
+        arr[:] = fill_value
+        self._open_maps[feature_name] = arr
+        self._index[feature_name] = {
+            "origin": reference.GetOrigin(),
+            "spacing": reference.GetSpacing(),
+            "direction": reference.GetDirection(),
+        }
+        self._save_index()
+
+    def write(
+        self, feature_name: str, coords: np.ndarray, values: np.ndarray
+    ) -> None:
+        """
+        Write the values of the voxels at `coords` ((z, y, x) indices of
+        shape (3, n_voxels)).
+        """
+        if feature_name not in self._open_maps:
+            self._open_maps[feature_name] = np.load(
+                self._map_path(feature_name), mmap_mode="r+"
+            )
+        self._open_maps[feature_name][tuple(coords)] = values
+
+    def flush(self) -> None:
+        """Write the pending changes to disk and release the open maps."""
+        for arr in self._open_maps.values():
+            arr.flush()
+        self._open_maps = {}
+
+    def read(self, feature_name: str) -> np.memmap:
+        """Read-only, memory-mapped (z, y, x) array of a map."""
+        if feature_name not in self._index:
+            raise KeyError(
+                f"No feature map {feature_name} in {self.store_dir}"
+            )
+        return np.load(self._map_path(feature_name), mmap_mode="r")
+
+    def to_image(self, feature_name: str) -> sitk.Image:
+        image = sitk.GetImageFromArray(self.read(feature_name))
+        geometry = self._index[feature_name]
+        image.SetOrigin(geometry["origin"])
+        image.SetSpacing(geometry["spacing"])
+        image.SetDirection(geometry["direction"])
+        return image
+
+    def export_nifti(
+        self,
+        output_dir: PathLike,
+        feature_names: list[str] | None = None,
+    ) -> list[Path]:
+        """
+        Save maps as `{feature_name}.nii.gz` in `output_dir`, one at a time.
+        Every map is written to a temporary file that is then moved into
+        place, so that readers polling for the map (e.g.
+        `FeaturePlotter.refresh`) never load a partially written file.
+
+        Args:
+            output_dir: directory in which the NIfTI files are saved
+            feature_names: maps to export. If None, all maps are exported.
+
+        Returns:
+            paths to the saved files
+        """
+        self.flush()
+        if feature_names is None:
+            feature_names = self.feature_names
+        output_dir = Path(output_dir)
+        saved_paths = []
+        for feature_name in feature_names:
+            save_path = output_dir / f"{feature_name}.nii.gz"
+            fd, tmp_path = tempfile.mkstemp(
+                dir=output_dir, prefix=".tmp_", suffix=".nii.gz"
+            )
+            os.close(fd)
+            try:
+                sitk.WriteImage(self.to_image(feature_name), tmp_path)
+                os.replace(tmp_path, save_path)
+            finally:
+                Path(tmp_path).unlink(missing_ok=True)
+            saved_paths.append(save_path)
+        log.debug(f"Exported {len(saved_paths)} feature maps to {output_dir}")
+        return saved_paths
+
+    def _map_path(self, feature_name: str) -> Path:
+        return self.store_dir / f"{feature_name}.npy"
+
+    def _save_index(self) -> None:
+        tmp_path = self._index_path.with_name(f".{self._index_path.name}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self._index, f)
+        os.replace(tmp_path, self._index_path)
@@ -0,0 +1,135 @@
+import collections
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Iterable, Iterator
+
+import SimpleITK as sitk
+
+from autorad.config.type_definitions import PathLike
+from autorad.utils import io
+
+log = logging.getLogger(__name__)
+
+
+def image_nbytes(image: sitk.Image | None) -> int:
+    if image is None:
+        return 0
+    return (
+        image.GetNumberOfPixels()
+        * image.GetNumberOfComponentsPerPixel()
+        * image.GetSizeOfPixelComponent()
+    )
+
+
+class PrefetchingLoader:
+    """
+    Iterates over cases grouped by image, reading the images and masks of
+    the next cases in background threads while the current one is being
+    processed, so that reading from slow (e.g. network) storage overlaps
+    with feature computation.
+    """
+
+    def __init__(
+        self,
+        groups: Iterable[tuple[PathLike, list[PathLike], list]],
+        n_prefetch: int = 1,
+        max_memory: int | None = None,
+        mask_label: int | None = None,
+        n_threads: int = 2,
+    ):
+        """
+        Args:
+            groups: (image path, mask paths, IDs) for every image
+            n_prefetch: number of images to read ahead
+            max_memory: maximum size in bytes of the images and masks read
+                ahead. The next image is always read, even if it alone
+                exceeds the budget.
+            mask_label: label passed to the DICOM-SEG reader
+            n_threads: number of reading threads
+        """
+        self.groups = groups
+        self.n_prefetch = n_prefetch
+        self.max_memory = max_memory
+        self.mask_label = mask_label
+        self.n_threads = n_threads
+        self._lock = threading.Lock()
+        # Bytes read ahead and not yet handed out
+        self._loaded_bytes = 0
+        self._n_reading = 0
+        self._n_loaded = 0
+        self._total_loaded_bytes = 0
+
+    def __iter__(
+        self,
+    ) -> Iterator[tuple[tuple, sitk.Image | None, list[sitk.Image | None]]]:
+        """
+        Yields:
+            the group, its image and its masks. Images or masks that could
+            not be read are None, so that the caller can handle the error.
+        """
+        groups = iter(self.groups)
+        pending: collections.deque[tuple[tuple, Future]] = collections.deque()
+        with ThreadPoolExecutor(self.n_threads) as executor:
+
+            def fill(n_cases: int):
+                while len(pending) < n_cases and (
+                    not pending or self._within_budget()
+                ):
+                    group = next(groups, None)
+                    if group is None:
+                        return
+                    with self._lock:
+                        self._n_reading += 1
+                    pending.append((group, executor.submit(self._load, group)))
+
+            fill(self.n_prefetch + 1)
+            while pending:
+                group, future = pending.popleft()
+                image, masks = future.result()
+                with self._lock:
+                    self._loaded_bytes -= image_nbytes(image) + sum(
+                        image_nbytes(mask) for mask in masks
+                    )
+                # Read ahead while the caller processes this case
+                fill(self.n_prefetch)
+                yield group, image, masks
+                fill(self.n_prefetch + 1)
+
+    def _within_budget(self) -> bool:
+        if self.max_memory is None:
+            return True
+        with self._lock:
+            # Cases still being read are assumed to be of average size
+            average_size = self._total_loaded_bytes / max(self._n_loaded, 1)
+            expected = self._loaded_bytes + average_size * self._n_reading
+        return expected < self.max_memory
+
+    def _load(
+        self, group: tuple[PathLike, list[PathLike], list]
+    ) -> tuple[sitk.Image | None, list[sitk.Image | None]]:
+        image_path, mask_paths, _ = group
+        image = self._read(io.read_image_sitk, image_path)
+        masks = [
+            self._read(
+                io.read_segmentation_sitk, mask_path, label=self.mask_label
+            )
+            for mask_path in mask_paths
+        ]
+        size = image_nbytes(image) + sum(image_nbytes(mask) for mask in masks)
+        with self._lock:
+            self._n_reading -= 1
+            self._loaded_bytes += size
+            self._total_loaded_bytes += size
+            self._n_loaded += 1
+        return image, masks
+
+    @staticmethod
+    def _read(read_fn, path: PathLike, **kwargs) -> sitk.Image | None:
+        try:
+            return read_fn(Path(path), **kwargs)
+        except Exception as e:
+            # Reading is retried and the error reported by the extraction
+            log.debug(f"Prefetching {path} failed: {e}")
+            return None
@@ -1,13 +1,46 @@
+import copy
+import hashlib
+import json
 import logging
+import os
 import shutil
+import time
+from concurrent.futures import (
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+)
 from pathlib import Path
+from typing import Callable, Collection
 
+import numpy as np
+import pandas as pd
 import radiomics
 import SimpleITK as sitk
+import yaml
+from radiomics import featureextractor, imageoperations
+from tqdm import tqdm
 
 from autorad.config import config
 from autorad.config.type_definitions import PathLike
-from autorad.utils import io
+from autorad.data import ImageDataset
+from autorad.feature_extraction.cache import hash_file_content
+from autorad.feature_extraction.map_store import FeatureMapStore
+from autorad.utils import io, utils
+
+log = logging.getLogger(__name__)
+
+# Side of the (cubic) tiles in voxels of the preprocessed image
+DEFAULT_TILE_SIZE = 16
+# Side of the blocks of voxels that share a value in previews
+DEFAULT_PREVIEW_STRIDE = 3
+PREVIEW_DIRNAME = "preview"
+
+# Set in every worker process by `_init_map_worker`
+_worker_inputs: list | None = None
+# Set in every worker process by `_init_dataset_worker`
+_worker_extractor: featureextractor.RadiomicsFeatureExtractor | None = None
 
 
 def extract_feature_maps(
@@ -16,7 +49,48 @@ def extract_feature_maps(
     save_dir: PathLike,
     extraction_params: dict | None = None,
     copy_inputs: bool = True,
-):
+    n_jobs: int | None = None,
+    tile_size: int = DEFAULT_TILE_SIZE,
+    export_nifti: bool = True,
+    feature_names: list[str] | None = None,
+    extractor: featureextractor.RadiomicsFeatureExtractor | None = None,
+) -> FeatureMapStore:
+    """
+    Compute voxel-based feature maps and save them in `save_dir`.
+    The maps are written tile by tile to a memory-mapped store in
+    `save_dir/feature_maps` and, optionally, exported as one NIfTI file per
+    feature, so that only about one map is held in memory at a time.
+    The ROI is split into tiles that are computed in parallel. Every kernel
+    is still evaluated on the whole preprocessed image, so the maps are the
+    same as the ones computed by pyradiomics in a single process (except
+    for glcm MCC, which in pyradiomics depends on how voxels are batched).
+
+    Finished maps are recorded in `save_dir/manifest.json`, together with
+    the inputs and parameters they were computed from. Running again with
+    the same inputs and parameters (e.g. after a crash) only computes the
+    maps that are missing.
+
+    Args:
+        image_path: path to the image
+        seg_path: path to the segmentation
+        save_dir: directory in which the maps are saved
+        extraction_params: pyradiomics parameters. Defaults to
+            CT_default_feature_map.yaml.
+        copy_inputs: copy the image and segmentation to `save_dir`
+        n_jobs: number of worker processes. Defaults to the number of CPUs.
+        tile_size: side of the tiles in voxels
+        export_nifti: save every map as `{feature_name}.nii.gz` in
+            `save_dir`. Otherwise, they can be exported later with
+            `FeatureMapStore.export_nifti`.
+        feature_names: maps to compute, named as by pyradiomics
+            (e.g. original_glcm_Contrast). If None, all the maps enabled
+            in `extraction_params` are computed.
+        extractor: extractor initialized with `extraction_params`, to reuse
+            it across cases
+
+    Returns:
+        the store with the computed maps
+    """
     save_dir = Path(save_dir)
     if copy_inputs:
         shutil.copyfile(image_path, save_dir / "image.nii.gz")
@@ -26,14 +100,693 @@ def extract_feature_maps(
             Path(config.PARAM_DIR) / "CT_default_feature_map.yaml"
         )
     radiomics.setVerbosity(logging.INFO)
-    extractor = radiomics.featureextractor.RadiomicsFeatureExtractor(
+    store = FeatureMapStore(save_dir / "feature_maps")
+    manifest_path = save_dir / "manifest.json"
+    manifest = _load_manifest(manifest_path)
+    job_key = _job_key(image_path, seg_path, extraction_params)
+    manifest["jobs"][job_key] = {
+        "image_path": str(image_path),
+        "seg_path": str(seg_path),
+        "extraction_params": extraction_params,
+    }
+    finished = {
+        name
+        for name, key in manifest["maps"].items()
+        if key == job_key and name in store
+    }
+    if finished:
+        log.info(f"Skipping {len(finished)} feature maps already computed")
+
+    def mark_finished(names: list[str]):
+        for name in names:
+            manifest["maps"][name] = job_key
+        _save_manifest(manifest_path, manifest)
+
+    computed = compute_feature_maps(
+        image_path,
+        seg_path,
+        extraction_params,
+        store,
+        n_jobs=n_jobs,
+        tile_size=tile_size,
+        feature_names=feature_names,
+        skip=finished,
+        on_finished=mark_finished,
+        extractor=extractor,
+    )
+    if feature_names is not None:
+        missing = set(feature_names) - finished - set(computed)
+        if missing:
+            log.warning(
+                f"Feature maps {sorted(missing)} are not enabled in the "
+                "extraction parameters"
+            )
+    if export_nifti:
+        to_export = [
+            name
+            for name in (feature_names or store.feature_names)
+            if name in computed
+            or (
+                name in finished and not (save_dir / f"{name}.nii.gz").exists()
+            )
+        ]
+        store.export_nifti(save_dir, to_export)
+    return store
+
+
+def extract_feature_map_preview(
+    image_path: PathLike,
+    seg_path: PathLike,
+    save_dir: PathLike,
+    extraction_params: dict | None = None,
+    stride: int = DEFAULT_PREVIEW_STRIDE,
+    kernel_radius: int | None = None,
+    n_jobs: int | None = None,
+    feature_names: list[str] | None = None,
+    refine: bool = False,
+) -> tuple[FeatureMapStore, Future | None]:
+    """
+    Quickly compute low-resolution previews of the feature maps and save
+    them as NIfTI files in `save_dir/preview`.
+    Features are only computed for one voxel in every block of
+    `stride`x`stride`x`stride` voxels of the ROI, and the whole block is
+    filled with its value.
+
+    Args:
+        image_path: path to the image
+        seg_path: path to the segmentation
+        save_dir: directory in which the maps are saved
+        extraction_params: pyradiomics parameters. Defaults to
+            CT_default_feature_map.yaml.
+        stride: side of the blocks in voxels of the preprocessed image
+        kernel_radius: kernel radius used for the previews. Defaults to
+            the one in `extraction_params`.
+        n_jobs: number of worker processes. Defaults to the number of CPUs.
+        feature_names: maps to compute. If None, all the enabled maps are
+            computed.
+        refine: compute the full-resolution maps in the background
+            afterwards, with `extract_feature_maps`
+
+    Returns:
+        the store with the previews, and the future of the full-resolution
+        run if `refine` is True (None otherwise)
+    """
+    save_dir = Path(save_dir)
+    preview_dir = save_dir / PREVIEW_DIRNAME
+    preview_dir.mkdir(parents=True, exist_ok=True)
+    shutil.copyfile(image_path, save_dir / "image.nii.gz")
+    shutil.copyfile(seg_path, save_dir / "segmentation.nii.gz")
+    if extraction_params is None:
+        extraction_params = io.load_yaml(
+            Path(config.PARAM_DIR) / "CT_default_feature_map.yaml"
+        )
+    preview_params = copy.deepcopy(extraction_params)
+    if kernel_radius is not None:
+        preview_params.setdefault("voxelSetting", {})[
+            "kernelRadius"
+        ] = kernel_radius
+    store = FeatureMapStore(preview_dir / "feature_maps")
+    computed = compute_feature_maps(
+        image_path,
+        seg_path,
+        preview_params,
+        store,
+        n_jobs=n_jobs,
+        feature_names=feature_names,
+        stride=stride,
+    )
+    store.export_nifti(preview_dir, computed)
+
+    refinement = None
+    if refine:
+        executor = ThreadPoolExecutor(1)
+        refinement = executor.submit(
+            extract_feature_maps,
+            image_path,
+            seg_path,
+            save_dir,
+            extraction_params,
+            copy_inputs=False,
+            n_jobs=n_jobs,
+            feature_names=feature_names,
+        )
+        # The thread keeps running until the maps are done
+        executor.shutdown(wait=False)
+    return store, refinement
+
+
+def extract_feature_maps_for_dataset(
+    dataset: ImageDataset,
+    save_dir: PathLike,
+    extraction_params: dict | None = None,
+    n_jobs: int | None = None,
+    tile_size: int = DEFAULT_TILE_SIZE,
+    export_nifti: bool = True,
+    feature_names: list[str] | None = None,
+) -> pd.DataFrame:
+    """
+    Compute voxel-based feature maps for every case of a dataset, with
+    `extract_feature_maps`. Cases are distributed over a pool of workers,
+    each of which initializes the extractor once. The maps of every case
+    are saved in `save_dir/{ID}`, and a summary of all the cases in
+    `save_dir/index.csv`. A case that fails is reported and skipped.
+
+    Args:
+        dataset: dataset with the images and segmentations
+        save_dir: directory in which the case directories are created
+        extraction_params: pyradiomics parameters. Defaults to
+            CT_default_feature_map.yaml.
+        n_jobs: number of worker processes. Defaults to the number of CPUs.
+        tile_size: side of the tiles in voxels
+        export_nifti: save every map as a NIfTI file in its case directory
+        feature_names: maps to compute. If None, all the enabled maps are
+            computed.
+
+    Returns:
+        the summary, with one row per case and its status, number of maps,
+        directory, computation time in seconds and error (if any)
+    """
+    save_dir = Path(save_dir)
+    save_dir.mkdir(parents=True, exist_ok=True)
+    if extraction_params is None:
+        extraction_params = io.load_yaml(
+            Path(config.PARAM_DIR) / "CT_default_feature_map.yaml"
+        )
+    cases = list(zip(dataset.ids, dataset.image_paths, dataset.mask_paths))
+    case_kwargs = {
+        "save_dir": save_dir,
+        "extraction_params": extraction_params,
+        "tile_size": tile_size,
+        "export_nifti": export_nifti,
+        "feature_names": feature_names,
+    }
+    n_jobs = utils.set_n_jobs(n_jobs) or os.cpu_count()
+    n_jobs = min(n_jobs, max(len(cases), 1))
+    log.info(f"Computing feature maps for {len(cases)} cases")
+    rows = {}
+    progress = tqdm(total=len(cases))
+    if n_jobs == 1:
+        _init_dataset_worker(extraction_params)
+        for ID, image_path, seg_path in cases:
+            rows[ID] = _extract_case_maps(
+                ID, image_path, seg_path, **case_kwargs
+            )
+            _report_case(rows[ID], progress)
+    else:
+        with ProcessPoolExecutor(
+            n_jobs,
+            initializer=_init_dataset_worker,
+            initargs=(extraction_params,),
+        ) as executor:
+            futures = {
+                executor.submit(_extract_case_maps, *case, **case_kwargs): case
+                for case in cases
+            }
+            for future in as_completed(futures):
+                ID, image_path, seg_path = futures[future]
+                try:
+                    rows[ID] = future.result()
+                except Exception as e:
+                    # e.g. the worker running the case crashed
+                    rows[ID] = _case_row(
+                        ID, image_path, seg_path, "failed", error=str(e)
+                    )
+                _report_case(rows[ID], progress)
+    progress.close()
+
+    index = pd.DataFrame([rows[ID] for ID, _, _ in cases])
+    index = index.rename(columns={"ID": dataset.ID_colname})
+    index.to_csv(save_dir / "index.csv", index=False)
+    n_failed = (index["status"] == "failed").sum()
+    if n_failed:
+        log.warning(f"Feature maps failed for {n_failed}/{len(cases)} cases")
+    return index
+
+
+def _init_dataset_worker(extraction_params: dict):
+    global _worker_extractor
+    _worker_extractor = featureextractor.RadiomicsFeatureExtractor(
         extraction_params
     )
-    feature_vector = extractor.execute(
-        str(image_path), str(seg_path), voxelBased=True
+
+
+def _extract_case_maps(
+    ID,
+    image_path: PathLike,
+    seg_path: PathLike,
+    save_dir: Path,
+    **kwargs,
+) -> dict:
+    """
+    Compute the feature maps of one case with the extractor of the worker.
+
+    Returns:
+        the summary row of the case
+    """
+    case_dir = save_dir / str(ID)
+    case_dir.mkdir(parents=True, exist_ok=True)
+    start = time.perf_counter()
+    try:
+        store = extract_feature_maps(
+            image_path,
+            seg_path,
+            case_dir,
+            n_jobs=1,
+            extractor=_worker_extractor,
+            **kwargs,
+        )
+    except Exception as e:
+        return _case_row(
+            ID,
+            image_path,
+            seg_path,
+            "failed",
+            elapsed=time.perf_counter() - start,
+            error=str(e),
+        )
+    return _case_row(
+        ID,
+        image_path,
+        seg_path,
+        "done",
+        maps_dir=case_dir,
+        n_maps=len(store.feature_names),
+        elapsed=time.perf_counter() - start,
+    )
+
+
+def _case_row(
+    ID,
+    image_path: PathLike,
+    seg_path: PathLike,
+    status: str,
+    maps_dir: Path | None = None,
+    n_maps: int = 0,
+    elapsed: float = 0.0,
+    error: str | None = None,
+) -> dict:
+    return {
+        "ID": ID,
+        "image_path": str(image_path),
+        "seg_path": str(seg_path),
+        "status": status,
+        "maps_dir": str(maps_dir) if maps_dir is not None else None,
+        "n_maps": n_maps,
+        "elapsed": elapsed,
+        "error": error,
+    }
+
+
+def _report_case(row: dict, progress: tqdm):
+    progress.update()
+    if row["status"] == "failed":
+        log.error(f"Feature maps failed for ID={row['ID']}: {row['error']}")
+    else:
+        log.info(
+            f"Computed {row['n_maps']} feature maps for ID={row['ID']} "
+            f"in {row['elapsed']:.1f}s"
+        )
+
+
+def compute_feature_maps(
+    image_path: PathLike,
+    seg_path: PathLike,
+    extraction_params: dict,
+    store: FeatureMapStore,
+    n_jobs: int | None = None,
+    tile_size: int = DEFAULT_TILE_SIZE,
+    feature_names: Collection[str] | None = None,
+    skip: Collection[str] = (),
+    on_finished: Callable[[list[str]], None] | None = None,
+    stride: int = 1,
+    extractor: featureextractor.RadiomicsFeatureExtractor | None = None,
+) -> list[str]:
+    """
+    Compute voxel-based feature maps tile by tile and write every tile to
+    `store` as soon as it is computed.
+
+    Args:
+        feature_names: maps to compute. If None, all the enabled maps are
+            computed.
+        skip: maps not to compute, e.g. because they are already in `store`
+        on_finished: called with the names of the maps of every filtered
+            image, once all of their tiles are written to `store`
+        stride: if > 1, compute only one voxel in every block of
+            `stride`x`stride`x`stride` voxels and fill the block with its
+            value (see `sample_blocks`)
+        extractor: extractor initialized with `extraction_params`. If None,
+            a new one is created.
+
+    Returns:
+        names of the computed maps, as given by pyradiomics
+        (e.g. original_firstorder_Mean)
+    """
+    if extractor is None:
+        extractor = featureextractor.RadiomicsFeatureExtractor(
+            extraction_params
+        )
+    inputs = _preprocess(extractor, image_path, seg_path)
+    tasks = []
+    # Number of tiles left and names of the maps of every filtered image
+    remaining = {}
+    for input_idx, (_, mask, image_type_name, kwargs) in enumerate(inputs):
+        enabled_features = _select_features(
+            extractor.enabledFeatures, image_type_name, feature_names, skip
+        )
+        if not enabled_features:
+            continue
+        roi_coords = np.array(
+            np.where(
+                sitk.GetArrayViewFromImage(mask) == kwargs.get("label", 1)
+            )
+        )
+        tiles = _plan_tiles(roi_coords, tile_size, stride)
+        # Largest tiles first, so that no worker is left with a big one at
+        # the end. Filtered images are processed one after the other, so
+        # that their maps are finished (and can be resumed) early.
+        tiles.sort(key=lambda tile: tile[0].shape[1], reverse=True)
+        for coords, targets in tiles:
+            tasks.append((input_idx, coords, enabled_features, targets))
+        remaining[input_idx] = [
+            len(tiles),
+            [
+                f"{image_type_name}_{class_name}_{feature_name}"
+                for class_name, names in enabled_features.items()
+                for feature_name in names
+            ],
+        ]
+
+    n_jobs = utils.set_n_jobs(n_jobs) or os.cpu_count()
+    n_jobs = min(n_jobs, max(len(tasks), 1))
+    log.info(
+        f"Computing feature maps in {len(tasks)} tiles on {n_jobs} workers"
+    )
+    computed: list[str] = []
+    created: set[str] = set()
+
+    def write(input_idx: int, targets: tuple, values: dict):
+        target_coords, value_idx = targets
+        if value_idx is not None:
+            values = {name: v[value_idx] for name, v in values.items()}
+        _write_tile(store, created, inputs[input_idx], target_coords, values)
+        remaining[input_idx][0] -= 1
+        if remaining[input_idx][0] == 0:
+            store.flush()
+            names = remaining[input_idx][1]
+            computed.extend(names)
+            if on_finished is not None:
+                on_finished(names)
+
+    if n_jobs == 1:
+        _init_map_worker(inputs)
+        for input_idx, coords, enabled_features, targets in tasks:
+            write(
+                input_idx,
+                targets,
+                _compute_tile(input_idx, coords, enabled_features),
+            )
+    else:
+        with ProcessPoolExecutor(
+            n_jobs, initializer=_init_map_worker, initargs=(inputs,)
+        ) as executor:
+            futures = {
+                executor.submit(
+                    _compute_tile, input_idx, coords, enabled_features
+                ): (input_idx, targets)
+                for input_idx, coords, enabled_features, targets in tasks
+            }
+            for future in as_completed(futures):
+                # Drop the future, so that its values can be freed once
+                # they are written
+                input_idx, targets = futures.pop(future)
+                write(input_idx, targets, future.result())
+    store.flush()
+    return computed
+
+
+def split_into_tiles(coords: np.ndarray, tile_size: int) -> list[np.ndarray]:
+    """
+    Split voxels into cubic tiles.
+
+    Args:
+        coords: (z, y, x) indices of the voxels, shape (3, n_voxels)
+        tile_size: side of the tiles in voxels
+
+    Returns:
+        for every non-empty tile, the indices of its voxels in `coords`,
+        in their original order
+    """
+    if coords.shape[1] == 0:
+        return []
+    tile_idx = coords // tile_size
+    n_tiles = tile_idx.max(axis=1) + 1
+    tile_keys = np.ravel_multi_index(tuple(tile_idx), tuple(n_tiles))
+    order = np.argsort(tile_keys, kind="stable")
+    boundaries = np.flatnonzero(np.diff(tile_keys[order])) + 1
+    return np.split(order, boundaries)
+
+
+def sample_blocks(
+    coords: np.ndarray, stride: int
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Group voxels into cubic blocks and pick the voxel closest to the center
+    of every block to represent it.
+
+    Args:
+        coords: (z, y, x) indices of the voxels, shape (3, n_voxels)
+        stride: side of the blocks in voxels
+
+    Returns:
+        the indices in `coords` of the representative voxels, and for every
+        voxel the index of its block (i.e. of its representative)
+    """
+    blocks = coords // stride
+    block_keys = np.ravel_multi_index(
+        tuple(blocks), tuple(blocks.max(axis=1) + 1)
     )
-    for feature_name, feature_value in feature_vector.items():
-        if isinstance(feature_value, sitk.Image):
-            save_path = save_dir / f"{feature_name}.nii.gz"
-            save_path = str(save_path)
-            sitk.WriteImage(feature_value, save_path)
+    centers = blocks * stride + (stride - 1) / 2
+    dist_to_center = ((coords - centers) ** 2).sum(axis=0)
+    order = np.lexsort((dist_to_center, block_keys))
+    unique_keys, first = np.unique(block_keys[order], return_index=True)
+    return order[first], np.searchsorted(unique_keys, block_keys)
+
+
+def _plan_tiles(
+    roi_coords: np.ndarray, tile_size: int, stride: int
+) -> list[tuple[np.ndarray, tuple[np.ndarray, np.ndarray | None]]]:
+    """
+    Returns:
+        for every tile, the coordinates of the voxels to compute, and the
+        coordinates of the voxels to write with the indices of the computed
+        values to write there (None if the same voxels are written)
+    """
+    if stride == 1:
+        return [
+            (roi_coords[:, idx], (roi_coords[:, idx], None))
+            for idx in split_into_tiles(roi_coords, tile_size)
+        ]
+    sample_idx, voxel_block = sample_blocks(roi_coords, stride)
+    samples = roi_coords[:, sample_idx]
+    tiles = split_into_tiles(samples, tile_size)
+    block_tile = np.empty(len(sample_idx), dtype=int)
+    block_position = np.empty(len(sample_idx), dtype=int)
+    for tile_idx, idx in enumerate(tiles):
+        block_tile[idx] = tile_idx
+        block_position[idx] = np.arange(len(idx))
+    # Every voxel is written with the value of its block's representative
+    voxel_tile = block_tile[voxel_block]
+    order = np.argsort(voxel_tile, kind="stable")
+    boundaries = np.flatnonzero(np.diff(voxel_tile[order])) + 1
+    return [
+        (
+            samples[:, idx],
+            (roi_coords[:, voxels], block_position[voxel_block[voxels]]),
+        )
+        for idx, voxels in zip(tiles, np.split(order, boundaries))
+    ]
+
+
+def _preprocess(
+    extractor: featureextractor.RadiomicsFeatureExtractor,
+    image_path: PathLike,
+    seg_path: PathLike,
+) -> list[tuple[sitk.Image, sitk.Image, str, dict]]:
+    """
+    Load, resample and filter the image the way
+    `RadiomicsFeatureExtractor.execute(voxelBased=True)` does.
+
+    Returns:
+        (image, mask, image type name, settings) for every filtered image,
+        cropped to the ROI padded by the kernel radius
+    """
+    settings = extractor.settings.copy()
+    settings["voxelBased"] = True
+    kernel_radius = settings.get("kernelRadius", 1)
+    image, mask = extractor.loadImage(
+        str(image_path), str(seg_path), None, **settings
+    )
+    bounding_box, corrected_mask = imageoperations.checkMask(
+        image, mask, **settings
+    )
+    if corrected_mask is not None:
+        mask = corrected_mask
+    if settings.get("resegmentRange") is not None:
+        mask = imageoperations.resegmentMask(image, mask, **settings)
+        bounding_box, _ = imageoperations.checkMask(image, mask, **settings)
+
+    inputs = []
+    for image_type, custom_kwargs in extractor.enabledImagetypes.items():
+        kwargs = {**settings, **custom_kwargs}
+        filtered_images = getattr(imageoperations, f"get{image_type}Image")(
+            image, mask, **kwargs
+        )
+        for filtered_image, image_type_name, input_kwargs in filtered_images:
+            filtered_image, cropped_mask = imageoperations.cropToTumorMask(
+                filtered_image, mask, bounding_box, padDistance=kernel_radius
+            )
+            inputs.append(
+                (filtered_image, cropped_mask, image_type_name, input_kwargs)
+            )
+    return inputs
+
+
+def _select_features(
+    enabled_features: dict,
+    image_type_name: str,
+    feature_names: Collection[str] | None,
+    skip: Collection[str],
+) -> dict[str, list[str]]:
+    """
+    Resolve the features enabled in the extraction parameters to the ones to
+    compute for a filtered image.
+
+    Returns:
+        names of the features to compute, by feature class
+    """
+    feature_classes = radiomics.getFeatureClasses()
+    selected = {}
+    for class_name, names in enabled_features.items():
+        if class_name.startswith("shape") or class_name not in feature_classes:
+            continue
+        if not names:
+            # Same as RadiomicsFeaturesBase.enableAllFeatures
+            names = [
+                name
+                for name, is_deprecated in feature_classes[class_name]
+                .getFeatureNames()
+                .items()
+                if not is_deprecated
+            ]
+        names = [
+            name
+            for name in names
+            if (
+                feature_names is None
+                or f"{image_type_name}_{class_name}_{name}" in feature_names
+            )
+            and f"{image_type_name}_{class_name}_{name}" not in skip
+        ]
+        if names:
+            selected[class_name] = names
+    return selected
+
+
+def _job_key(
+    image_path: PathLike, seg_path: PathLike, extraction_params: dict
+) -> str:
+    hasher = hashlib.sha256()
+    for part in (
+        hash_file_content(image_path),
+        hash_file_content(seg_path),
+        yaml.safe_dump(extraction_params, sort_keys=True),
+        radiomics.__version__,
+    ):
+        hasher.update(part.encode())
+        hasher.update(b"\0")
+    return hasher.hexdigest()
+
+
+def _load_manifest(manifest_path: Path) -> dict:
+    if not manifest_path.exists():
+        return {"jobs": {}, "maps": {}}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def _save_manifest(manifest_path: Path, manifest: dict):
+    tmp_path = manifest_path.with_name(f".{manifest_path.name}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, manifest_path)
+
+
+def _init_map_worker(inputs: list):
+    global _worker_inputs
+    _worker_inputs = inputs
+
+
+def _compute_tile(
+    input_idx: int, coords: np.ndarray, enabled_features: dict
+) -> dict[str, np.ndarray]:
+    """
+    Compute the features of the voxels at `coords` (one tile) of a
+    preprocessed image.
+
+    Args:
+        input_idx: index of the preprocessed image in the worker inputs
+        coords: (z, y, x) indices of the tile voxels
+        enabled_features: names of the features to compute, by class
+
+    Returns:
+        the feature values of the tile voxels, keyed by feature name
+    """
+    image, mask, image_type_name, kwargs = _worker_inputs[input_idx]
+    init_value = kwargs.get("initValue", 0)
+    voxel_batch = kwargs.get("voxelBatch", -1)
+    if voxel_batch < 0:
+        voxel_batch = coords.shape[1]
+    feature_classes = radiomics.getFeatureClasses()
+    values = {}
+    for class_name, feature_names in enabled_features.items():
+        feature_class = feature_classes[class_name](image, mask, **kwargs)
+        for feature_name in feature_names:
+            feature_class.enableFeatureByName(feature_name)
+        class_values = {
+            feature_name: np.full(coords.shape[1], init_value, dtype=float)
+            for feature_name in feature_names
+        }
+        # Same as RadiomicsFeaturesBase._calculateVoxels, but restricted to
+        # the tile and without allocating a full map per feature
+        for start in range(0, coords.shape[1], voxel_batch):
+            batch = slice(start, start + voxel_batch)
+            for (
+                success,
+                feature_name,
+                value,
+            ) in feature_class._calculateFeatures(coords[:, batch]):
+                if success:
+                    class_values[feature_name][batch] = value
+        for feature_name, feature_values in class_values.items():
+            name = f"{image_type_name}_{class_name}_{feature_name}"
+            values[name] = feature_values
+    return values
+
+
+def _write_tile(
+    store: FeatureMapStore,
+    created: set[str],
+    inputs: tuple[sitk.Image, sitk.Image, str, dict],
+    coords: np.ndarray,
+    values: dict[str, np.ndarray],
+):
+    """
+    Stitch the values of a tile into the maps in `store`, creating the maps
+    that are not in `created` yet.
+    """
+    image, _, _, kwargs = inputs
+    for feature_name, feature_values in values.items():
+        if feature_name not in created:
+            store.create(feature_name, image, kwargs.get("initValue", 0))
+            created.add(feature_name)
+        store.write(feature_name, coords, feature_values)
@@ -0,0 +1,98 @@
+import logging
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from autorad.config.type_definitions import PathLike
+
+log = logging.getLogger(__name__)
+
+
+def _to_scalar(value):
+    if isinstance(value, np.ndarray) and value.size == 1:
+        return value.item()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+class ParquetFeatureWriter:
+    """
+    Writes extracted features incrementally to a directory of Parquet
+    files (one file per chunk of cases), so that finished cases survive a
+    crash and an interrupted run can be resumed.
+    Requires pyarrow (or fastparquet) to be installed.
+    """
+
+    def __init__(
+        self,
+        output_dir: PathLike,
+        ID_colname: str,
+        chunk_size: int = 10,
+        resume: bool = False,
+    ):
+        """
+        Args:
+            output_dir: directory in which the Parquet parts are written
+            ID_colname: name of the ID column
+            chunk_size: number of feature rows buffered before a new part
+                is written
+            resume: keep the parts already in `output_dir`. Otherwise,
+                `output_dir` must not contain any parts.
+        """
+        self.output_dir = Path(output_dir)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.ID_colname = ID_colname
+        self.chunk_size = chunk_size
+        self._buffer: list[dict] = []
+        existing_parts = self._part_paths()
+        if existing_parts and not resume:
+            raise ValueError(
+                f"{self.output_dir} already contains extracted features. "
+                "Set resume=True to continue the extraction or choose "
+                "another directory."
+            )
+        self._next_part = len(existing_parts)
+
+    def _part_paths(self) -> list[Path]:
+        return sorted(self.output_dir.glob("part-*.parquet"))
+
+    def written_ids(self) -> set:
+        """IDs of the cases already written to disk."""
+        ids = set()
+        for part_path in self._part_paths():
+            part = pd.read_parquet(part_path, columns=[self.ID_colname])
+            ids.update(part[self.ID_colname].tolist())
+        return ids
+
+    def write(self, feature_dicts: list[dict]):
+        self._buffer.extend(feature_dicts)
+        if len(self._buffer) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if not self._buffer:
+            return
+        part_df = pd.DataFrame(
+            [
+                {name: _to_scalar(value) for name, value in row.items()}
+                for row in self._buffer
+            ]
+        )
+        part_path = self.output_dir / f"part-{self._next_part:05d}.parquet"
+        tmp_path = part_path.with_name(f".{part_path.name}.tmp")
+        part_df.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, part_path)
+        log.debug(f"Saved {len(part_df)} feature rows to {part_path}")
+        self._next_part += 1
+        self._buffer = []
+
+    def read(self) -> pd.DataFrame:
+        """Read all the features written so far."""
+        self.flush()
+        parts = [pd.read_parquet(p) for p in self._part_paths()]
+        if not parts:
+            return pd.DataFrame()
+        return pd.concat(parts, ignore_index=True)
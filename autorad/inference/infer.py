@@ -6,15 +6,33 @@ import pandas as pd
 
 from autorad.config.type_definitions import PathLike
 from autorad.data import FeatureDataset, ImageDataset, TrainingData
-from autorad.feature_extraction.extractor import FeatureExtractor
+from autorad.feature_extraction.extractor import (
+    ExtractionPool,
+    FeatureExtractor,
+)
 from autorad.utils import extraction_utils, io
 
 log = logging.getLogger(__name__)
 
 
 class Inferrer:
-    def __init__(self, model, extraction_config, preprocessor, result_dir):
+    def __init__(
+        self,
+        model,
+        extraction_config,
+        preprocessor,
+        result_dir,
+        pool: ExtractionPool | None = None,
+    ):
+        """
+        Args:
+            pool: ExtractionPool started with
+                `extraction_config["extraction_params"]`. If given, features
+                are extracted by its workers, which are initialized only once
+                for all the predictions.
+        """
         self.model = model
+        self.pool = pool
         self.preprocessor = preprocessor
         self.extraction_config = extraction_config
         self.result_dir = result_dir
@@ -23,7 +41,7 @@ class Inferrer:
         self, img_path: PathLike, mask_path: PathLike
     ) -> pd.DataFrame:
         feature_df = infer_radiomics_features(
-            img_path, mask_path, self.extraction_config
+            img_path, mask_path, self.extraction_config, pool=self.pool
         )
         return feature_df
 
@@ -109,11 +127,24 @@ class Inferrer:
         self.test_indices = dataset.X.test.index.values
 
 
-def infer_radiomics_features(img_path, mask_path, extraction_config):
+def infer_radiomics_features(
+    img_path, mask_path, extraction_config, pool: ExtractionPool | None = None
+):
     if not Path(img_path).exists():
         raise FileNotFoundError(f"Image {img_path} does not exist")
     if not Path(mask_path).exists():
         raise FileNotFoundError(f"Mask {mask_path} does not exist")
+    if pool is not None:
+        feature_dict = pool.extract(img_path, mask_path)
+        if feature_dict is None:
+            raise ValueError(
+                "No features extracted. Check the logs and your dataset."
+            )
+        feature_df = pd.DataFrame([feature_dict])
+        radiomics_features = extraction_utils.filter_pyradiomics_names(
+            list(feature_df.columns)
+        )
+        return feature_df[radiomics_features]
     path_df = pd.DataFrame(
         {
             "image_path": [str(img_path)],
@@ -1,10 +1,31 @@
 import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 
+import pandas as pd
 import SimpleITK as sitk
+from tqdm import tqdm
+
+from autorad.config.type_definitions import PathLike
+from autorad.utils import dicom, io, utils
 
 log = logging.getLogger(__name__)
 
+MANIFEST_COLUMNS = [
+    "ID",
+    "image_path",
+    "mask_path",
+    "source_path",
+    "series_uid",
+    "n_slices",
+    "status",
+    "mask_status",
+    "elapsed",
+    "error",
+]
+
 
 # def convert_dataset_to_nifti(data_dir: PathLike, save_dir: PathLike):
 #     """Convert from DICOM or nrrd to nifti"""
@@ -44,3 +65,256 @@ def nrrd_to_nifti(nrrd_path: str, output_path: str):
     img = sitk.ReadImage(nrrd_path)
     Path(output_path).parent.mkdir(exist_ok=True, parents=True)
     sitk.WriteImage(img, str(output_path))
+
+
+def find_dicom_series(
+    root_dir: PathLike, n_jobs: int | None = None
+) -> list[dict]:
+    """
+    Find all DICOM series under `root_dir`, including DICOM SEG files.
+    Series are named after the path of their directory relative to
+    `root_dir`, with a suffix if a directory holds several image series.
+
+    Args:
+        n_jobs: number of threads reading the headers of each directory
+
+    Returns:
+        for every series: its ID, UID, modality, sorted files and, for
+        a DICOM SEG, the UID of the series it was drawn on
+    """
+    root_dir = Path(root_dir)
+    if not root_dir.is_dir():
+        raise FileNotFoundError(f"Directory not found at {root_dir}")
+    found = []
+    for dir_path, _, file_names in sorted(os.walk(root_dir)):
+        if not file_names:
+            continue
+        dir_path = Path(dir_path)
+        rel_path = dir_path.relative_to(root_dir)
+        dir_id = "_".join(rel_path.parts) or root_dir.name
+        series = dicom.scan_dicom_dir(dir_path, n_jobs=n_jobs)
+        image_uids = sorted(
+            uid
+            for uid, slices in series.items()
+            if not dicom.is_segmentation(slices)
+        )
+        for uid, slices in sorted(series.items()):
+            headers = [header for _, header in slices]
+            if dicom.is_segmentation(slices):
+                ID = f"{dir_id}_seg_{uid}"
+            elif len(image_uids) > 1:
+                ID = f"{dir_id}_{image_uids.index(uid)}"
+            else:
+                ID = dir_id
+            found.append(
+                {
+                    "ID": ID,
+                    "series_uid": uid,
+                    "modality": headers[0]["modality"],
+                    "source_path": str(dir_path),
+                    "files": [file_path for file_path, _ in slices],
+                    "referenced_series_uid": headers[0][
+                        "referenced_series_uid"
+                    ],
+                }
+            )
+    return found
+
+
+def convert_dicom_dataset(
+    root_dir: PathLike,
+    save_dir: PathLike,
+    n_jobs: int | None = None,
+    image_filename: str = "image.nii.gz",
+    seg_filename: str = "segmentation.nii.gz",
+    layout: str = "nested",
+) -> pd.DataFrame:
+    """
+    Convert all DICOM series under `root_dir` to NIfTI in parallel
+    processes. Every image series is saved as
+    `save_dir/{ID}/{image_filename}`, and a DICOM SEG drawn on it as
+    `save_dir/{ID}/{seg_filename}`, resampled to the grid of the image.
+    With layout="flat", they are saved as `save_dir/{ID}.nii.gz` and
+    `save_dir/segmentations/{ID}.nii.gz` instead, so that `save_dir` only
+    holds the images (e.g. as input for nnU-Net).
+    Outputs newer than all of their source files are not converted again.
+    The manifest is saved as `save_dir/manifest.csv`; its done cases can
+    be loaded with
+    `ImageDataset(manifest, "image_path", "mask_path", "ID")`.
+
+    Args:
+        root_dir: directory searched recursively for DICOM series
+        save_dir: directory in which the NIfTI files are saved
+        n_jobs: number of conversion processes. If None, one per CPU.
+        layout: "nested" (one directory per ID) or "flat" (one file per
+            ID, `image_filename` and `seg_filename` are ignored)
+
+    Returns:
+        the manifest, with one row per image series
+    """
+    if layout not in ("nested", "flat"):
+        raise ValueError(f"Unknown layout {layout}")
+    save_dir = Path(save_dir)
+    series = find_dicom_series(root_dir)
+    images = [item for item in series if item["modality"] != "SEG"]
+    jobs = []
+    for item in series:
+        image = _find_referenced_image(item, images)
+        if item["modality"] != "SEG":
+            output_path = _output_path(
+                save_dir, item["ID"], image_filename, layout
+            )
+        elif image is not None:
+            if "mask_job" in image:
+                log.warning(
+                    f"Several DICOM SEGs found for ID={image['ID']}, "
+                    f"keeping {image['mask_job']['files'][0]}"
+                )
+                continue
+            output_path = _output_path(
+                save_dir, image["ID"], seg_filename, layout, is_seg=True
+            )
+            image["mask_job"] = item
+            item["reference_files"] = image["files"]
+        else:
+            log.warning(
+                f"DICOM SEG {item['files'][0]} does not reference any of "
+                "the converted series, saving it on its own"
+            )
+            output_path = _output_path(
+                save_dir, item["ID"], seg_filename, layout, is_seg=True
+            )
+        item["output_path"] = output_path
+        jobs.append(item)
+
+    n_jobs = utils.set_n_jobs(n_jobs) or os.cpu_count()
+    start = time.perf_counter()
+    results = {}
+    with tqdm(total=len(jobs), desc="Converting DICOM series") as progress:
+        if n_jobs == 1:
+            for item in jobs:
+                results[id(item)] = _convert_series(item)
+                progress.update()
+        else:
+            with ProcessPoolExecutor(n_jobs) as executor:
+                futures = {
+                    executor.submit(_convert_series, item): item
+                    for item in jobs
+                }
+                for future in as_completed(futures):
+                    results[id(futures[future])] = future.result()
+                    progress.update()
+    elapsed = time.perf_counter() - start
+
+    n_converted = n_slices = 0
+    for item in jobs:
+        status, _, error = results[id(item)]
+        if status == "converted":
+            n_converted += 1
+            n_slices += len(item["files"])
+        elif status == "failed":
+            log.error(f"Converting {item['source_path']} failed: {error}")
+    log.info(
+        f"Converted {n_converted} series ({n_slices} slices) in "
+        f"{elapsed:.1f}s ({n_slices / max(elapsed, 1e-9):.1f} slices/s), "
+        f"{len(jobs) - n_converted} skipped or failed"
+    )
+
+    rows = []
+    for image in images:
+        status, image_elapsed, error = results[id(image)]
+        row = {
+            "ID": image["ID"],
+            "image_path": None,
+            "mask_path": None,
+            "source_path": image["source_path"],
+            "series_uid": image["series_uid"],
+            "n_slices": len(image["files"]),
+            "status": "failed" if status == "failed" else "done",
+            "mask_status": None,
+            "elapsed": image_elapsed,
+            "error": error,
+        }
+        if status != "failed":
+            row["image_path"] = str(image["output_path"])
+        if "mask_job" in image:
+            mask_status, _, mask_error = results[id(image["mask_job"])]
+            row["mask_status"] = mask_status
+            if mask_status == "failed":
+                row["error"] = row["error"] or f"DICOM SEG: {mask_error}"
+            else:
+                row["mask_path"] = str(image["mask_job"]["output_path"])
+        rows.append(row)
+    manifest = pd.DataFrame(rows, columns=MANIFEST_COLUMNS)
+    save_dir.mkdir(parents=True, exist_ok=True)
+    manifest.to_csv(save_dir / "manifest.csv", index=False)
+    return manifest
+
+
+def _output_path(
+    save_dir: Path, ID: str, filename: str, layout: str, is_seg=False
+) -> Path:
+    if layout == "nested":
+        return save_dir / ID / filename
+    if is_seg:
+        return save_dir / "segmentations" / f"{ID}.nii.gz"
+    return save_dir / f"{ID}.nii.gz"
+
+
+def _find_referenced_image(item: dict, images: list[dict]) -> dict | None:
+    """
+    Image series a DICOM SEG was drawn on. Copies of the same series (e.g.
+    in several patient directories) are told apart by their location.
+    """
+    if item["modality"] != "SEG":
+        return None
+    candidates = [
+        image
+        for image in images
+        if image["series_uid"] == item["referenced_series_uid"]
+    ]
+    if not candidates:
+        return None
+    return max(
+        candidates,
+        key=lambda image: len(
+            os.path.commonpath([image["source_path"], item["source_path"]])
+        ),
+    )
+
+
+def _convert_series(item: dict) -> tuple[str, float, str | None]:
+    """
+    Returns:
+        status ("converted", "skipped" or "failed"), time taken and error
+    """
+    output_path = Path(item["output_path"])
+    source_mtime = max(os.stat(f).st_mtime_ns for f in item["files"])
+    if output_path.exists() and output_path.stat().st_mtime_ns >= (
+        source_mtime
+    ):
+        return "skipped", 0.0, None
+    start = time.perf_counter()
+    try:
+        if item["modality"] == "SEG":
+            image = io.read_dicom_seg_sitk(Path(item["files"][0]))
+            if "reference_files" in item:
+                # DICOM SEGs only cover the segmented slices
+                reference = io.read_dicom_files_sitk(item["reference_files"])
+                image = sitk.Resample(
+                    image,
+                    reference,
+                    sitk.Transform(),
+                    sitk.sitkNearestNeighbor,
+                    0,
+                    image.GetPixelID(),
+                )
+        else:
+            image = io.read_dicom_files_sitk(item["files"])
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = output_path.with_name(f".{output_path.name}")
+        sitk.WriteImage(image, str(tmp_path), useCompression=True)
+        os.replace(tmp_path, output_path)
+    except Exception as e:
+        return "failed", time.perf_counter() - start, str(e)
+    return "converted", time.perf_counter() - start, None
@@ -0,0 +1,295 @@
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pydicom
+import SimpleITK as sitk
+from pydicom.errors import InvalidDicomError
+
+from autorad.config.type_definitions import PathLike
+
+log = logging.getLogger(__name__)
+
+if "AUTORAD_DICOM_CACHE_DIR" in os.environ:
+    DICOM_CACHE_DIR = Path(os.environ["AUTORAD_DICOM_CACHE_DIR"])
+else:
+    DICOM_CACHE_DIR = Path(tempfile.gettempdir()) / "autorad_dicom_cache"
+
+# Tags needed to group the files into series and sort the slices
+_HEADER_TAGS = [
+    "SeriesInstanceUID",
+    "Modality",
+    "ImagePositionPatient",
+    "ImageOrientationPatient",
+    "InstanceNumber",
+    "ReferencedSeriesSequence",
+]
+
+
+def read_slice_header(file_path: PathLike) -> dict | None:
+    """
+    Read the tags used for sorting from a DICOM file, without its pixels.
+
+    Returns:
+        the series UID, modality, position, orientation and instance
+        number of the slice, and for a DICOM SEG the UID of the series it
+        was drawn on, or None if the file is not a DICOM image
+    """
+    try:
+        dcm = pydicom.dcmread(
+            str(file_path), stop_before_pixels=True, specific_tags=_HEADER_TAGS
+        )
+    except (InvalidDicomError, OSError):
+        return None
+    if "SeriesInstanceUID" not in dcm:
+        return None
+    referenced_series = dcm.get("ReferencedSeriesSequence")
+    return {
+        "series_uid": str(dcm.SeriesInstanceUID),
+        "modality": str(dcm.get("Modality", "")),
+        "position": _float_list(dcm.get("ImagePositionPatient")),
+        "orientation": _float_list(dcm.get("ImageOrientationPatient")),
+        "instance_number": _int_or_none(dcm.get("InstanceNumber")),
+        "referenced_series_uid": (
+            str(referenced_series[0].SeriesInstanceUID)
+            if referenced_series
+            else None
+        ),
+    }
+
+
+def _float_list(value) -> list[float] | None:
+    if value is None:
+        return None
+    return [float(v) for v in value]
+
+
+def _int_or_none(value) -> int | None:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def scan_dicom_dir(
+    input_dir: PathLike, n_jobs: int | None = None
+) -> dict[str, list[tuple[str, dict]]]:
+    """
+    Group the DICOM files in `input_dir` (not searched recursively) by
+    series, parsing their headers in parallel threads.
+
+    Args:
+        n_jobs: number of threads reading the headers. If None, one per
+            CPU plus four, up to 32.
+
+    Returns:
+        (file path, header) of the files of every series, by series UID,
+        with image slices sorted along the slice normal
+    """
+    file_paths = sorted(
+        entry.path for entry in os.scandir(input_dir) if entry.is_file()
+    )
+    if n_jobs is None:
+        n_jobs = min(32, (os.cpu_count() or 1) + 4)
+    with ThreadPoolExecutor(n_jobs) as executor:
+        headers = list(executor.map(read_slice_header, file_paths))
+
+    series: dict[str, list[tuple[str, dict]]] = {}
+    for file_path, header in zip(file_paths, headers):
+        if header is not None:
+            series.setdefault(header["series_uid"], []).append(
+                (file_path, header)
+            )
+    return {uid: sort_slices(slices) for uid, slices in series.items()}
+
+
+def sort_dicom_series(
+    input_dir: PathLike,
+    n_jobs: int | None = None,
+    series_uid: str | None = None,
+) -> list[str]:
+    """
+    List the files of the DICOM series in `input_dir`, sorted along the
+    slice normal as `sitk.ImageSeriesReader.GetGDCMSeriesFileNames` does.
+    DICOM SEG files are ignored.
+
+    Args:
+        input_dir: directory with the DICOM files (not searched recursively)
+        n_jobs: number of threads reading the headers
+        series_uid: UID of the series to list. If None and the directory
+            holds several series, the one GDCM reads by default (with the
+            lowest UID in string order) is used.
+
+    Returns:
+        paths to the sorted slices
+    """
+    series = {
+        uid: slices
+        for uid, slices in scan_dicom_dir(input_dir, n_jobs=n_jobs).items()
+        if not is_segmentation(slices)
+    }
+    if not series:
+        raise ValueError(f"No DICOM series found in {input_dir}")
+    if series_uid is None:
+        series_uid = min(series)
+        if len(series) > 1:
+            log.warning(
+                f"Found {len(series)} DICOM series in {input_dir}, "
+                f"using {series_uid}"
+            )
+    elif series_uid not in series:
+        raise ValueError(f"Series {series_uid} not found in {input_dir}")
+    return [file_path for file_path, _ in series[series_uid]]
+
+
+def is_segmentation(slices: list[tuple[str, dict]]) -> bool:
+    return slices[0][1]["modality"] == "SEG"
+
+
+def sort_slices(slices: list[tuple[str, dict]]) -> list[tuple[str, dict]]:
+    """
+    Sort (file path, header) pairs of one series along the slice normal,
+    or by instance number if the slice positions are missing.
+    """
+    headers = [header for _, header in slices]
+    if all(
+        header["position"] is not None and header["orientation"] is not None
+        for header in headers
+    ):
+        # Distance of every slice along the normal of the first one
+        row, col = np.reshape(headers[0]["orientation"], (2, 3))
+        normal = np.cross(row, col)
+        distances = [np.dot(normal, header["position"]) for header in headers]
+        order = np.argsort(distances, kind="stable")
+        return [slices[i] for i in order]
+    if len(slices) > 1:
+        log.warning("Slice positions missing, sorting by instance number")
+    return sorted(slices, key=lambda item: item[1]["instance_number"] or 0)
+
+
+class DicomSeriesCache:
+    """
+    Per-directory cache of the sorted slice order of DICOM series, and
+    optionally of the whole series converted to a compressed NIfTI file.
+    Entries are keyed by the directory path and invalidated when the
+    directory or any of its files is modified.
+    The cache is kept outside of the DICOM directories, which may be
+    read-only and whose content is hashed by the feature cache.
+    """
+
+    def __init__(self, cache_dir: PathLike | None = None):
+        """
+        Args:
+            cache_dir: directory in which the entries are stored. If None,
+                `DICOM_CACHE_DIR` (set by $AUTORAD_DICOM_CACHE_DIR) is used.
+        """
+        if cache_dir is None:
+            cache_dir = DICOM_CACHE_DIR
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def get_file_names(self, input_dir: PathLike) -> list[str] | None:
+        entry = self._load_entry(input_dir)
+        if entry is None:
+            return None
+        return entry["file_names"]
+
+    def set_file_names(self, input_dir: PathLike, file_names: list[str]):
+        self._save_entry(
+            input_dir,
+            {"stamp": _dir_stamp(input_dir), "file_names": file_names},
+        )
+
+    def get_nifti_path(self, input_dir: PathLike) -> Path | None:
+        """
+        Path to the NIfTI conversion of the series, or None if there is
+        none or the series changed since it was written.
+        """
+        if self._load_entry(input_dir) is None:
+            return None
+        nifti_path = self._nifti_path(input_dir)
+        return nifti_path if nifti_path.exists() else None
+
+    def set_nifti(self, input_dir: PathLike, image: sitk.Image):
+        nifti_path = self._nifti_path(input_dir)
+        with self._tmp_file(suffix=".nii.gz") as (fd, tmp_path):
+            os.close(fd)
+            sitk.WriteImage(image, tmp_path, useCompression=True)
+            os.replace(tmp_path, nifti_path)
+
+    def invalidate(self, input_dir: PathLike):
+        for path in (self._entry_path(input_dir), self._nifti_path(input_dir)):
+            path.unlink(missing_ok=True)
+
+    def _load_entry(self, input_dir: PathLike) -> dict | None:
+        entry_path = self._entry_path(input_dir)
+        if not entry_path.exists():
+            return None
+        try:
+            with open(entry_path) as f:
+                entry = json.load(f)
+        except (OSError, ValueError) as e:
+            log.warning(f"Dropping unreadable DICOM cache entry: {e}")
+            self.invalidate(input_dir)
+            return None
+        if entry["stamp"] != _dir_stamp(input_dir):
+            log.debug(f"DICOM series in {input_dir} changed")
+            self.invalidate(input_dir)
+            return None
+        return entry
+
+    def _save_entry(self, input_dir: PathLike, entry: dict):
+        entry_path = self._entry_path(input_dir)
+        with self._tmp_file(suffix=".json") as (fd, tmp_path):
+            with os.fdopen(fd, "w") as f:
+                json.dump(entry, f)
+            os.replace(tmp_path, entry_path)
+
+    @contextlib.contextmanager
+    def _tmp_file(self, suffix: str):
+        """
+        Unique temporary file in the cache directory, so that processes
+        writing the same entry at once do not clash. It is removed if it
+        was not moved into place.
+        """
+        fd, tmp_path = tempfile.mkstemp(
+            dir=self.cache_dir, prefix=".tmp_", suffix=suffix
+        )
+        try:
+            yield fd, tmp_path
+        finally:
+            Path(tmp_path).unlink(missing_ok=True)
+
+    def _key(self, input_dir: PathLike) -> str:
+        path = str(Path(input_dir).resolve())
+        return hashlib.sha256(path.encode()).hexdigest()
+
+    def _entry_path(self, input_dir: PathLike) -> Path:
+        return self.cache_dir / f"{self._key(input_dir)}.json"
+
+    def _nifti_path(self, input_dir: PathLike) -> Path:
+        return self.cache_dir / f"{self._key(input_dir)}.nii.gz"
+
+
+def _dir_stamp(input_dir: PathLike) -> list[int]:
+    """
+    Modification time of a directory, and number and latest modification
+    time of its files, which change whenever a file is added, removed or
+    rewritten.
+    """
+    mtimes = [
+        entry.stat().st_mtime_ns
+        for entry in os.scandir(input_dir)
+        if entry.is_file()
+    ]
+    return [
+        os.stat(input_dir).st_mtime_ns,
+        len(mtimes),
+        max(mtimes, default=0),
+    ]
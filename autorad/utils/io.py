@@ -13,22 +13,74 @@ import yaml
 import pydicom_seg
 import pydicom
 
+from autorad.utils import dicom
+
 log = logging.getLogger(__name__)
 
+# Formats of the intermediate images written by the spatial and
+# preprocessing utilities (border masks, split and resampled masks).
+# Uncompressed NIfTI is much faster to write than gzip-compressed NIfTI,
+# and its voxels can be memory-mapped (e.g. by nibabel).
+INTERMEDIATE_FORMATS = ("nii.gz", "nii")
+_intermediate_format = os.environ.get("AUTORAD_INTERMEDIATE_FORMAT", "nii.gz")
+
+
+def read_dicom_sitk(
+    input_dir: Path,
+    use_cache: bool = False,
+    write_nifti: bool = False,
+    n_jobs: int | None = None,
+) -> sitk.Image:
+    """
+    Read a DICOM series and orient it to LPS.
+
+    Args:
+        input_dir: directory with the DICOM files
+        use_cache: use and update the cached slice order of the series
+            (see `dicom.DicomSeriesCache`), so that the headers are only
+            parsed the first time a directory is read. The cache is not
+            evicted; clear $AUTORAD_DICOM_CACHE_DIR to free its space.
+        write_nifti: with `use_cache`, also cache the series as
+            compressed NIfTI, which is then read instead of the DICOM
+            files until they change
+        n_jobs: number of threads parsing the slice headers
+    """
+    cache = dicom.DicomSeriesCache() if use_cache else None
+    dicom_names = None
+    if cache is not None:
+        nifti_path = cache.get_nifti_path(input_dir)
+        if nifti_path is not None:
+            log.debug(f"Reading {input_dir} from {nifti_path}")
+            return sitk.ReadImage(str(nifti_path))
+        dicom_names = cache.get_file_names(input_dir)
+    if dicom_names is None:
+        dicom_names = dicom.sort_dicom_series(input_dir, n_jobs=n_jobs)
+        if cache is not None:
+            cache.set_file_names(input_dir, dicom_names)
+    image = read_dicom_files_sitk(dicom_names)
+    if cache is not None and write_nifti:
+        cache.set_nifti(input_dir, image)
+
+    return image
+
 
-def read_dicom_sitk(input_dir: Path) -> sitk.Image:
+def read_dicom_files_sitk(dicom_names: list[str]) -> sitk.Image:
+    """Read the sorted slices of a DICOM series and orient it to LPS."""
     reader = sitk.ImageSeriesReader()
-    dicom_names = reader.GetGDCMSeriesFileNames(str(input_dir))
     reader.SetFileNames(dicom_names)
     image = reader.Execute()
-    image = sitk.DICOMOrient(image, "LPS")
+    return sitk.DICOMOrient(image, "LPS")
 
-    return image
 
+def read_image_sitk(input_path: Path, **dicom_kwargs) -> sitk.Image:
+    """
+    Read an image file, or a DICOM series from a directory.
 
-def read_image_sitk(input_path: Path) -> sitk.Image:
+    Args:
+        dicom_kwargs: passed to `read_dicom_sitk`
+    """
     if input_path.is_dir():
-        vol = read_dicom_sitk(input_path)
+        vol = read_dicom_sitk(input_path, **dicom_kwargs)
     else:
         vol = sitk.ReadImage(str(input_path))
 
@@ -117,6 +169,65 @@ def load_sitk(img_path) -> sitk.Image:
     return img
 
 
+def set_intermediate_format(fmt: str):
+    """
+    Set the format of intermediate images, one of `INTERMEDIATE_FORMATS`.
+    The default can also be set with $AUTORAD_INTERMEDIATE_FORMAT.
+    """
+    global _intermediate_format
+    if fmt not in INTERMEDIATE_FORMATS:
+        raise ValueError(
+            f"Unknown intermediate format {fmt}, "
+            f"choose one of {INTERMEDIATE_FORMATS}"
+        )
+    _intermediate_format = fmt
+
+
+def get_intermediate_format() -> str:
+    if _intermediate_format not in INTERMEDIATE_FORMATS:
+        raise ValueError(
+            f"Unknown intermediate format {_intermediate_format}, "
+            f"choose one of {INTERMEDIATE_FORMATS}"
+        )
+    return _intermediate_format
+
+
+def intermediate_path(path: Path | str) -> Path:
+    """
+    Path with its NIfTI extension (if any) replaced by the one of the
+    intermediate format, e.g. mask.nii.gz -> mask.nii.
+    """
+    path = Path(path)
+    name = path.name
+    for suffix in (".nii.gz", ".nii"):
+        if name.endswith(suffix):
+            name = name[: -len(suffix)]
+            break
+    return path.with_name(f"{name}.{get_intermediate_format()}")
+
+
+def export_nifti_gz(
+    input_path: Path | str, output_path: Path | str | None = None
+) -> Path:
+    """
+    Save an intermediate image as gzip-compressed NIfTI, e.g. to export
+    final results.
+
+    Args:
+        input_path: path to the image
+        output_path: path to the .nii.gz file. If None, it is saved next
+            to the input.
+    """
+    input_path = Path(input_path)
+    if output_path is None:
+        name = input_path.name.removesuffix(".gz").removesuffix(".nii")
+        output_path = input_path.with_name(f"{name}.nii.gz")
+    output_path = Path(output_path)
+    if output_path != input_path:
+        save_sitk(load_sitk(input_path), output_path)
+    return output_path
+
+
 def save_sitk(img, output_path):
     Path(output_path).parent.mkdir(parents=True, exist_ok=True)
     sitk.WriteImage(img, str(output_path))
@@ -144,6 +255,26 @@ def load_array(img_path) -> np.ndarray:
     return arr
 
 
+def load_array_mmap(img_path) -> np.ndarray:
+    """
+    Load a volume as an (x, y, z) array like `load_array`, without
+    decoding it up front when possible. Uncompressed NIfTI files are
+    memory-mapped, so slicing and cropping the returned array only read
+    the voxels they need. Compressed NIfTI files are decompressed once,
+    and other formats are read with SimpleITK.
+    """
+    img_path = Path(img_path)
+    if not img_path.exists():
+        raise FileNotFoundError(f"File not found at {img_path}")
+    if not img_path.name.endswith((".nii", ".nii.gz")):
+        return load_array(img_path)
+    # NIfTI voxel axes are the (x, y, z) index axes of SimpleITK
+    arr = np.asanyarray(nib.load(str(img_path), mmap="r").dataobj)
+    if arr.ndim > 3 and all(n == 1 for n in arr.shape[3:]):
+        arr = arr.reshape(arr.shape[:3])
+    return arr
+
+
 def load_nibabel(img_path) -> nib.Nifti1Image:
     img_path = Path(img_path)
     if not img_path.exists():
@@ -181,8 +312,7 @@ def nifti_io(func):
         result = func(nifti, *args, **kwargs)
 
         # Save the nifti image
-        output_path.parent.mkdir(parents=True, exist_ok=True)
-        nib.save(result, output_path)
+        save_nibabel(result, output_path)
         log.info(f"Saved mask to {str(output_path)}.")
 
         return result
@@ -7,6 +7,7 @@ import webbrowser
 from pathlib import Path
 
 import mlflow
+import pandas as pd
 
 from autorad.config import config
 from autorad.utils import io
@@ -93,3 +94,10 @@ def log_dict_as_artifact(data: dict, artifact_name: str):
         tmp_path = Path(tmp_dir) / f"{artifact_name}.yaml"
         io.save_yaml(data, tmp_path)
         mlflow.log_artifact(str(tmp_path))
+
+
+def log_dataframe_as_artifact(df: pd.DataFrame, artifact_name: str):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_path = Path(tmp_dir) / f"{artifact_name}.csv"
+        df.to_csv(tmp_path, index=False)
+        mlflow.log_artifact(str(tmp_path))
@@ -4,11 +4,12 @@ from pathlib import Path
 from typing import List, Optional, Sequence
 
 import pandas as pd
+import SimpleITK as sitk
 from joblib import Parallel, delayed
 
 from autorad.config.type_definitions import PathLike
 from autorad.data import ImageDataset
-from autorad.utils import spatial
+from autorad.utils import io, spatial, utils
 
 log = logging.getLogger(__name__)
 
@@ -21,39 +22,168 @@ def generate_border_masks(
 ):
     """
     Generate a border mask (= mask with given margin around the original ROI)
-    for each mask in the dataset.
+    for each mask in the dataset, saved in the intermediate format
+    (see `io.set_intermediate_format`) as
+    "<output_dir>/<ID>_border_mask_<margin>mm_dilation.nii.gz". The margin
+    and method are part of the name so that borders of different margins
+    or methods written to the same directory do not overwrite each other.
     Returns a DataFrame extending ImageDataset.df with the additional column
-    "dilated_mask_path_<margin_in_mm>".
+    "border_mask_path_<margin_in_mm>mm", which is NaN for the cases whose
+    border mask could not be generated (these are logged).
     """
-    if n_jobs == -1:
-        n_jobs = os.cpu_count()
-    output_paths = [
-        os.path.join(output_dir, f"{id_}_border_mask.nii.gz")
-        for id_ in dataset.ids
+    border_df = generate_border_masks_for_margins(
+        dataset,
+        [margin_in_mm],
+        output_dir,
+        n_jobs=n_jobs,
+        method="dilation",
+    )
+    border_paths = border_df.set_index(dataset.ID_colname)["border_mask_path"]
+    result_df = dataset.df.copy()
+    result_df[f"border_mask_path_{margin_in_mm}mm"] = result_df[
+        dataset.ID_colname
+    ].map(border_paths)
+
+    return result_df
+
+
+def border_mask_path(
+    output_dir: PathLike,
+    id_,
+    margin_in_mm: float | Sequence[float],
+    method: str = "distance",
+) -> str:
+    """
+    Path of a border mask. The method is part of the name, as the borders
+    of both methods differ for the same margin.
+    """
+    margin_str = _margin_str(margin_in_mm)
+    return str(
+        io.intermediate_path(
+            os.path.join(
+                output_dir, f"{id_}_border_mask_{margin_str}_{method}.nii.gz"
+            )
+        )
+    )
+
+
+def _margin_str(margin_in_mm: float | Sequence[float]) -> str:
+    if isinstance(margin_in_mm, (int, float)):
+        return f"{margin_in_mm:g}mm"
+    return "_".join(f"{m:g}" for m in margin_in_mm) + "mm"
+
+
+def generate_border_masks_for_margins(
+    dataset: ImageDataset,
+    margins_in_mm: Sequence[float | Sequence[float]],
+    output_dir: PathLike,
+    n_jobs: int = -1,
+    method: str = "distance",
+) -> pd.DataFrame:
+    """
+    Generate border masks for several margins around each mask in the
+    dataset. Every mask is read once and all of its borders are computed
+    by the same worker. Borders newer than their mask are not generated
+    again.
+
+    Args:
+        margins_in_mm: margins of the borders. With method="distance",
+            a margin must be the same along all axes.
+        method: "distance" to derive all borders from one distance
+            transform, or "dilation" to dilate the mask for every margin
+            (see `spatial.get_border_outside_mask_mm`)
+
+    Returns:
+        a long DataFrame with one row per case and margin: the columns of
+        ImageDataset.df, "border_ID", "margin_mm" and "border_mask_path".
+        Load it with `ImageDataset(df, dataset.image_colname,
+        "border_mask_path", "border_ID")`.
+    """
+    if method not in ("distance", "dilation"):
+        raise ValueError(f"Unknown method {method}")
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    jobs = [
+        (
+            mask_path,
+            margins_in_mm,
+            [
+                border_mask_path(output_dir, id_, m, method)
+                for m in margins_in_mm
+            ],
+            method,
+        )
+        for id_, mask_path in zip(dataset.ids, dataset.mask_paths)
     ]
+    n_jobs = utils.set_n_jobs(n_jobs) or os.cpu_count()
     if n_jobs > 1:
         with Parallel(n_jobs) as parallel:
-            parallel(
-                delayed(spatial.get_border_outside_mask_mm)(
-                    mask_path=mask_path,
-                    margin=margin_in_mm,
-                    output_path=output_path,
-                )
-                for mask_path, output_path in zip(
-                    dataset.mask_paths, output_paths
-                )
+            results = parallel(
+                delayed(_generate_case_border_masks)(*job) for job in jobs
             )
     else:
-        for mask_path, output_path in zip(dataset.mask_paths, output_paths):
-            spatial.get_border_outside_mask_mm(
-                mask_path,
-                margin_in_mm,
-                output_path,
+        results = [_generate_case_border_masks(*job) for job in jobs]
+
+    rows = []
+    n_skipped = 0
+    for row, (_, _, output_paths, _), (status, error) in zip(
+        dataset.df.to_dict("records"), jobs, results
+    ):
+        id_ = row[dataset.ID_colname]
+        if status == "failed":
+            log.error(f"Generating border masks for ID={id_} failed: {error}")
+            continue
+        n_skipped += status == "skipped"
+        for margin, output_path in zip(margins_in_mm, output_paths):
+            rows.append(
+                {
+                    **row,
+                    "border_ID": f"{id_}_{_margin_str(margin)}",
+                    "margin_mm": margin,
+                    "border_mask_path": output_path,
+                }
             )
-    result_df = dataset.df.copy()
-    result_df[f"border_mask_path_{margin_in_mm}mm"] = output_paths
+    log.info(
+        f"Generated border masks for {len(jobs) - n_skipped} cases "
+        f"({n_skipped} up to date)"
+    )
+    columns = list(dataset.df.columns) + [
+        "border_ID",
+        "margin_mm",
+        "border_mask_path",
+    ]
+    return pd.DataFrame(rows, columns=columns)
 
-    return result_df
+
+def _generate_case_border_masks(
+    mask_path: PathLike,
+    margins_in_mm: Sequence[float | Sequence[float]],
+    output_paths: list[str],
+    method: str,
+) -> tuple[str, str | None]:
+    """
+    Returns:
+        status ("generated", "skipped" or "failed") and error
+    """
+    try:
+        mask_mtime = os.stat(mask_path).st_mtime_ns
+        if all(
+            os.path.exists(p) and os.stat(p).st_mtime_ns >= mask_mtime
+            for p in output_paths
+        ):
+            return "skipped", None
+        mask = sitk.ReadImage(str(mask_path))
+        if method == "distance":
+            borders = spatial.get_border_masks_mm_sitk(mask, margins_in_mm)
+        else:
+            borders = [
+                spatial.get_border_outside_mask_mm_sitk(mask, margin)
+                for margin in margins_in_mm
+            ]
+        for border, output_path in zip(borders, output_paths):
+            io.save_sitk(border, output_path)
+    except Exception as e:
+        return "failed", str(e)
+    return "generated", None
 
 
 def get_paths_with_separate_folder_per_case_loose(
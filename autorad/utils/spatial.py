@@ -1,5 +1,9 @@
+import functools
 import itertools
 import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from pathlib import Path
 from typing import Callable, Sequence
 
@@ -17,13 +21,23 @@ def get_border_outside_mask_mm(
     mask_path: PathLike,
     margin: float | Sequence[float],
     output_path: PathLike,
+    method: str = "dilation",
 ):
     """Wrapper that takes in paths
     instead of sitk.Image.
+    Args:
+        method: "dilation" to dilate with a box of whole voxels, or
+            "distance" to threshold the Euclidean distance to the mask
+            (see `get_border_masks_mm_sitk`)
     """
     mask = sitk.ReadImage(str(mask_path))
-    border_mask = get_border_outside_mask_mm_sitk(mask, margin=margin)
-    sitk.WriteImage(border_mask, str(output_path))
+    if method == "dilation":
+        border_mask = get_border_outside_mask_mm_sitk(mask, margin=margin)
+    elif method == "distance":
+        border_mask = get_border_masks_mm_sitk(mask, [margin])[0]
+    else:
+        raise ValueError(f"Unknown method {method}")
+    io.save_sitk(border_mask, output_path)
 
 
 def get_border_outside_mask_mm_sitk(mask, margin: float | Sequence[float]):
@@ -37,13 +51,23 @@ def dilate_mask_mm(
     mask_path: PathLike,
     margin: float | Sequence[float],
     output_path: PathLike,
+    method: str = "dilation",
 ):
     """Wrapper that takes in paths
     instead of sitk.Image.
+    Args:
+        method: "dilation" to dilate with a box of whole voxels, or
+            "distance" to threshold the Euclidean distance to the mask
+            (see `dilate_masks_mm_sitk`)
     """
     mask = sitk.ReadImage(str(mask_path))
-    dilated_mask = dilate_mask_mm_sitk(mask, margin=margin)
-    sitk.WriteImage(dilated_mask, str(output_path))
+    if method == "dilation":
+        dilated_mask = dilate_mask_mm_sitk(mask, margin=margin)
+    elif method == "distance":
+        dilated_mask = dilate_masks_mm_sitk(mask, [margin])[0]
+    else:
+        raise ValueError(f"Unknown method {method}")
+    io.save_sitk(dilated_mask, output_path)
 
 
 def dilate_mask_mm_sitk(mask, margin: float | Sequence[float]):
@@ -73,6 +97,104 @@ def dilate_mask_mm_sitk(mask, margin: float | Sequence[float]):
     return dilated_mask
 
 
+def _isotropic_margin(margin: float | Sequence[float]) -> float:
+    margins = np.unique(np.atleast_1d(margin))
+    if len(margins) != 1:
+        raise ValueError(
+            f"Margin = {margin} mm must be the same along all axes for "
+            "distance-based masks"
+        )
+    if margins[0] < 0:
+        raise ValueError(f"Margin = {margin} mm cannot be negative")
+    return float(margins[0])
+
+
+def distance_to_mask_mm(
+    mask: sitk.Image, max_distance: float
+) -> tuple[np.ndarray, tuple[slice, ...]]:
+    """
+    Euclidean distance in mm from every voxel to the nearest nonzero voxel
+    of the mask, taking the (anisotropic) spacing into account.
+    Only the bounding box of the mask grown by `max_distance` is computed.
+
+    Returns:
+        the (z, y, x) distance array of the region (0 inside the mask),
+        and the slices of the region in the full array
+    """
+    arr = sitk.GetArrayViewFromImage(mask) != 0
+    spacing_zyx = np.array(mask.GetSpacing())[::-1]
+    pad = np.ceil(max_distance / spacing_zyx).astype(int) + 1
+    region = []
+    for axis, size in enumerate(arr.shape):
+        other_axes = tuple(a for a in range(arr.ndim) if a != axis)
+        nonzero = np.flatnonzero(arr.any(axis=other_axes))
+        if not len(nonzero):
+            raise ValueError("Mask is empty")
+        start = max(0, nonzero[0] - pad[axis])
+        end = min(size, nonzero[-1] + 1 + pad[axis])
+        region.append(slice(int(start), int(end)))
+    region = tuple(region)
+    cropped = sitk.GetImageFromArray(arr[region].astype(np.uint8))
+    cropped.SetSpacing(mask.GetSpacing())
+    distance = sitk.SignedMaurerDistanceMap(
+        cropped,
+        insideIsPositive=False,
+        squaredDistance=False,
+        useImageSpacing=True,
+    )
+    distance_arr = sitk.GetArrayFromImage(distance)
+    np.maximum(distance_arr, 0, out=distance_arr)
+    return distance_arr, region
+
+
+def _masks_from_distance(
+    mask: sitk.Image,
+    margins: Sequence[float | Sequence[float]],
+    include_mask: bool,
+) -> list[sitk.Image]:
+    margins = [_isotropic_margin(margin) for margin in margins]
+    distance, region = distance_to_mask_mm(mask, max(margins))
+    results = []
+    for margin in margins:
+        ring = distance <= margin
+        if not include_mask:
+            ring &= distance > 0
+        arr = np.zeros(mask.GetSize()[::-1], dtype=np.uint8)
+        arr[region] = ring
+        result = sitk.GetImageFromArray(arr)
+        result.CopyInformation(mask)
+        results.append(result)
+    return results
+
+
+def dilate_masks_mm_sitk(
+    mask: sitk.Image, margins: Sequence[float | Sequence[float]]
+) -> list[sitk.Image]:
+    """
+    Dilate a mask by several margins in mm, from a single Euclidean
+    distance transform. Unlike `dilate_mask_mm_sitk`, margins are not
+    rounded to whole voxels, so they can be smaller than the spacing, and
+    the dilation is a ball rather than a box.
+
+    Returns:
+        a binary uint8 dilated mask for every margin
+    """
+    return _masks_from_distance(mask, margins, include_mask=True)
+
+
+def get_border_masks_mm_sitk(
+    mask: sitk.Image, margins: Sequence[float | Sequence[float]]
+) -> list[sitk.Image]:
+    """
+    Border masks (voxels outside the mask within a margin in mm) for
+    several margins, from a single Euclidean distance transform.
+
+    Returns:
+        a binary uint8 border mask for every margin
+    """
+    return _masks_from_distance(mask, margins, include_mask=False)
+
+
 def center_of_mass(array: np.ndarray) -> list[float]:
     total = array.sum()
     ndim = len(array.shape)
@@ -105,6 +227,74 @@ def generate_bbox_around_mask_center(mask, bbox_size):
     return result
 
 
+def is_positive(img):
+    return img > 0
+
+
+def generate_spatial_bounding_box(
+    img: np.ndarray,
+    select_fn: Callable = is_positive,
+    margin: Sequence[int] | int = 0,
+    allow_smaller: bool = True,
+) -> tuple[list[int], list[int]]:
+    """
+    Generate the spatial bounding box of foreground in the image with start-end positions (inclusive).
+    Users can define arbitrary function to select expected foreground from the whole image or specified channels.
+    And it can also add margin to every dim of the bounding box.
+    The output format of the coordinates is:
+
+        [1st_spatial_dim_start, 2nd_spatial_dim_start, ..., Nth_spatial_dim_start],
+        [1st_spatial_dim_end, 2nd_spatial_dim_end, ..., Nth_spatial_dim_end]
+
+    If `allow_smaller`, the bounding boxes edges are aligned with the input image edges.
+    This function returns [0, 0, ...], [0, 0, ...] if there's no positive intensity.
+
+    Args:
+        img: a "channel-first" image of shape (C, spatial_dim1[, spatial_dim2, ...]) to generate bounding box from.
+        select_fn: function to select expected foreground, default is to select values > 0.
+        channel_indices: if defined, select foreground only on the specified channels
+            of image. if None, select foreground on the whole image.
+        margin: add margin value to spatial dims of the bounding box, if only 1 value provided, use it for all dims.
+        allow_smaller: when computing box size with `margin`, whether allow the image size to be smaller
+            than box size, default to `True`.
+    """
+    spatial_size = img.shape[1:]
+    data = img
+    data = select_fn(data).any(0)
+    ndim = len(data.shape)
+    if isinstance(margin, int):
+        margin = [margin] * ndim
+    for m in margin:
+        if m < 0:
+            raise ValueError("margin value should not be negative number.")
+
+    box_start = [0] * ndim
+    box_end = [0] * ndim
+
+    for di, ax in enumerate(
+        itertools.combinations(reversed(range(ndim)), ndim - 1)
+    ):
+        dt = data
+        if len(ax) != 0:
+            dt = np.any(dt, ax)
+
+        if not dt.any():
+            # if no foreground, return all zero bounding box coords
+            return [0] * ndim, [0] * ndim
+
+        arg_max = np.where(dt == dt.max())[0]
+        min_d = arg_max[0] - margin[di]
+        max_d = arg_max[-1] + margin[di] + 1
+        if allow_smaller:
+            min_d = max(min_d, 0)
+            max_d = min(max_d, spatial_size[di])
+
+        box_start[di] = min_d
+        box_end[di] = max_d
+
+    return box_start, box_end
+
+
 # taken from
 # https://vincentblog.xyz/posts/medical-images-in-python-computed-tomography
 def get_window(
@@ -170,6 +360,179 @@ def get_sitk_interpolator(interpolation):
     return sitk_interpolator
 
 
+@dataclass(frozen=True)
+class Grid:
+    """Voxel grid (size, spacing, origin and direction) of an image."""
+
+    size: tuple[int, ...]
+    spacing: tuple[float, ...]
+    origin: tuple[float, ...]
+    direction: tuple[float, ...]
+
+    @classmethod
+    def from_image(cls, image: sitk.Image | sitk.ImageFileReader) -> "Grid":
+        return cls(
+            tuple(image.GetSize()),
+            tuple(image.GetSpacing()),
+            tuple(image.GetOrigin()),
+            tuple(image.GetDirection()),
+        )
+
+    def matches(self, image: sitk.Image, tolerance: float = 1e-6) -> bool:
+        """Whether the image lies on this grid."""
+        other = Grid.from_image(image)
+        return self.size == other.size and all(
+            np.allclose(a, b, atol=tolerance, rtol=0)
+            for a, b in (
+                (self.spacing, other.spacing),
+                (self.origin, other.origin),
+                (self.direction, other.direction),
+            )
+        )
+
+
+def read_grid(image_path: PathLike) -> Grid:
+    """
+    Read the grid of an image file from its header, without reading its
+    pixels. Grids are cached until the file is modified.
+    """
+    image_path = Path(image_path)
+    if not image_path.exists():
+        raise FileNotFoundError(f"File not found at {image_path}")
+    stat = image_path.stat()
+    return _read_grid(
+        str(image_path.resolve()), stat.st_mtime_ns, stat.st_size
+    )
+
+
+@functools.lru_cache(maxsize=256)
+def _read_grid(image_path: str, mtime: int, size: int) -> Grid:
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(image_path)
+    reader.ReadImageInformation()
+    return Grid.from_image(reader)
+
+
+@functools.lru_cache(maxsize=256)
+def isotropic_grid(
+    grid: Grid, spacing: float | None = None, standardize_axes=False
+) -> Grid:
+    """
+    Grid covering the same region as `grid` with isotropic voxels.
+
+    Args:
+        spacing: spacing of the new grid. If None, the smallest spacing of
+            the original grid.
+        standardize_axes: whether to align the new grid with the patient
+            axes, if the original one is not
+    """
+    if spacing is None:
+        spacing = min(grid.spacing)
+    dimension = len(grid.size)
+    new_size = tuple(
+        int(round(osz * ospc / spacing))
+        for osz, ospc in zip(grid.size, grid.spacing)
+    )
+    new_direction = grid.direction
+    new_origin = grid.origin
+    # Only need to standardize axes if user requested and the original
+    # axes were not standard.
+    identity = tuple(np.identity(dimension).ravel().tolist())
+    if standardize_axes and grid.direction != identity:
+        new_direction = identity
+        # Compute bounding box for the original, non standard axes image.
+        direction = np.reshape(grid.direction, (dimension, dimension))
+        boundary_points = [
+            np.array(grid.origin)
+            + direction @ (np.array(boundary_index) * grid.spacing)
+            for boundary_index in itertools.product(
+                *zip([0] * dimension, grid.size)
+            )
+        ]
+        max_coords = np.max(boundary_points, axis=0)
+        min_coords = np.min(boundary_points, axis=0)
+        new_origin = tuple(min_coords.tolist())
+        new_size = tuple(
+            ((max_coords - min_coords) / spacing).round().astype(int).tolist()
+        )
+    return Grid(new_size, (spacing,) * dimension, new_origin, new_direction)
+
+
+def resample_to_grid_sitk(
+    image: sitk.Image,
+    grid: Grid,
+    interpolation="nearest",
+    default_value=0,
+) -> sitk.Image:
+    """
+    Resample an image onto a grid, keeping its pixel type. Images already
+    on the grid are copied without interpolation.
+    """
+    if grid.matches(image):
+        resampled_img = sitk.Image(image)
+        resampled_img.SetSpacing(grid.spacing)
+        resampled_img.SetOrigin(grid.origin)
+        resampled_img.SetDirection(grid.direction)
+        return resampled_img
+    interpolator = get_sitk_interpolator(interpolation)
+    resampled_img = sitk.Resample(
+        image,
+        grid.size,
+        sitk.Transform(),
+        interpolator,
+        grid.origin,
+        grid.spacing,
+        grid.direction,
+        default_value,
+        image.GetPixelID(),
+    )
+    log.debug(
+        f"Resampled image from {image.GetSize()} to {resampled_img.GetSize()}"
+    )
+    return resampled_img
+
+
+def resample_to_grid(
+    images: Sequence[sitk.Image | PathLike],
+    reference: Grid | sitk.Image | PathLike,
+    interpolation="nearest",
+    n_jobs: int = 1,
+    as_array: bool = False,
+) -> list[sitk.Image] | list[np.ndarray]:
+    """
+    Resample several images (e.g. masks or feature maps) onto the grid of
+    the same reference, in memory.
+
+    Args:
+        images: images, or paths to them
+        reference: grid, image, or path to an image whose header is read
+        n_jobs: number of threads loading and resampling the images
+        as_array: return (x, y, z) arrays, like `io.load_array`
+
+    Returns:
+        the resampled images or arrays, in the order of `images`
+    """
+    if isinstance(reference, sitk.Image):
+        grid = Grid.from_image(reference)
+    elif isinstance(reference, Grid):
+        grid = reference
+    else:
+        grid = read_grid(reference)
+
+    def resample(image):
+        if not isinstance(image, sitk.Image):
+            image = io.load_sitk(image)
+        resampled = resample_to_grid_sitk(image, grid, interpolation)
+        if as_array:
+            return io.get_sitk_array(resampled)
+        return resampled
+
+    if n_jobs == 1 or len(images) <= 1:
+        return [resample(image) for image in images]
+    with ThreadPoolExecutor(n_jobs) as executor:
+        return list(executor.map(resample, images))
+
+
 def resample_to_isotropic_sitk(
     image,
     interpolation="nearest",
@@ -185,50 +548,14 @@ def resample_to_isotropic_sitk(
     # Image is already isotropic, just return a copy.
     if all(spc == original_spacing[0] for spc in original_spacing):
         return sitk.Image(image)
-    # Make image isotropic via resampling.
-    original_size = image.GetSize()
-    if spacing is None:
-        spacing = min(original_spacing)
-    new_spacing = [spacing] * image.GetDimension()
-    new_size = [
-        int(round(osz * ospc / spacing))
-        for osz, ospc in zip(original_size, original_spacing)
-    ]
-    interpolator = get_sitk_interpolator(interpolation)
-    new_direction = image.GetDirection()
-    new_origin = image.GetOrigin()
-    # Only need to standardize axes if user requested and the original
-    # axes were not standard.
-    if standardize_axes and not np.array_equal(
-        np.array(new_direction), np.identity(image.GetDimension()).ravel()
-    ):
-        new_direction = np.identity(image.GetDimension()).ravel()
-        # Compute bounding box for the original, non standard axes image.
-        boundary_points = []
-        for boundary_index in list(
-            itertools.product(*zip([0, 0, 0], image.GetSize()))
-        ):
-            boundary_points.append(
-                image.TransformIndexToPhysicalPoint(boundary_index)
-            )
-        max_coords = np.max(boundary_points, axis=0)
-        min_coords = np.min(boundary_points, axis=0)
-        new_origin = min_coords
-        new_size = (
-            ((max_coords - min_coords) / spacing).round().astype(int)
-        ).tolist()
-    isotropic_img = sitk.Resample(
-        image,
-        new_size,
-        sitk.Transform(),
-        interpolator,
-        new_origin,
-        new_spacing,
-        new_direction,
-        default_value,
-        image.GetPixelID(),
+    grid = isotropic_grid(
+        Grid.from_image(image),
+        spacing=spacing,
+        standardize_axes=standardize_axes,
+    )
+    return resample_to_grid_sitk(
+        image, grid, interpolation, default_value=default_value
     )
-    return isotropic_img
 
 
 def resample_to_isotropic(img_path, output_path, interpolation="nearest"):
@@ -261,19 +588,9 @@ def resample_to_img_sitk(
     Raises:
         ValueError: If the interpolation method is not valid.
     """
-    interpolator = get_sitk_interpolator(interpolation)
-    resampled_img = sitk.Resample(
-        img,
-        target_img,
-        sitk.Transform(),
-        interpolator,
-        0,
-        img.GetPixelID(),
-    )
-    log.debug(
-        f"Resampled image from {img.GetSize()} to {resampled_img.GetSize()}"
+    return resample_to_grid_sitk(
+        img, Grid.from_image(target_img), interpolation
     )
-    return resampled_img
 
 
 def resample_to_img(
@@ -284,20 +601,287 @@ def resample_to_img(
 ):
     """
     Wrapper for resample_to_img_sitk that takes in paths instead of
-    sitk.Image.
+    sitk.Image. Only the header of the reference is read.
     """
     log.debug(f"Resampling {to_resample} to match {reference}")
     if output_path is None:
         output_path = to_resample
     nifti = io.load_sitk(to_resample)
-    ref_nifti = io.load_sitk(reference)
-    nifti_resampled = resample_to_img_sitk(
-        img=nifti, target_img=ref_nifti, interpolation=interpolation
+    nifti_resampled = resample_to_grid_sitk(
+        nifti, read_grid(reference), interpolation=interpolation
     )
     io.save_sitk(nifti_resampled, output_path)
     log.debug(f"Resampled image saved to {output_path}")
 
 
+# Largest label for which masks are relabeled with a lookup table
+MAX_LUT_SIZE = 1 << 24
+
+
+def label_array(matrix: np.ndarray) -> np.ndarray:
+    """
+    Mask as an array of non-negative integer labels, without copying
+    integer arrays. Floating point masks (e.g. the data of a mask read
+    with `get_fdata()`) are converted to the smallest unsigned integer
+    dtype holding their labels.
+    """
+    matrix = np.asanyarray(matrix)
+    if matrix.dtype == bool:
+        return matrix.view(np.uint8)
+    if matrix.dtype.kind == "u":
+        return matrix
+    if matrix.size and matrix.min() < 0:
+        raise ValueError("Masks with negative labels are not supported")
+    if matrix.dtype.kind == "i":
+        return matrix
+    if matrix.dtype.kind != "f":
+        raise ValueError(f"Masks of dtype {matrix.dtype} are not supported")
+    max_value = matrix.max(initial=0)
+    if not np.isfinite(max_value):
+        raise ValueError("Masks with non-finite labels are not supported")
+    labels = matrix.astype(np.min_scalar_type(int(max_value)))
+    if not np.array_equal(labels, matrix):
+        raise ValueError("Masks with non-integer labels are not supported")
+    return labels
+
+
+def max_label(matrix: np.ndarray) -> int:
+    if matrix.dtype.itemsize == 1:
+        # Size of the lookup table is fixed, so finding the max is a waste
+        return int(np.iinfo(matrix.dtype).max)
+    return int(matrix.max(initial=0))
+
+
+def make_label_lut(
+    label_map: dict[int, int],
+    n_labels: int,
+    set_rest_to_zero: bool = False,
+    background_value: int = 0,
+    dtype=None,
+) -> np.ndarray:
+    """
+    Lookup table for relabeling masks with labels from 0 to
+    `n_labels` - 1, such that `lut[mask]` is the relabeled mask.
+
+    Args:
+        label_map: dictionary mapping old labels to new labels
+        set_rest_to_zero: set labels missing from `label_map` to
+            `background_value` instead of keeping them
+        dtype: dtype of the relabeled masks. If None, the smallest
+            unsigned integer dtype holding all the labels.
+    """
+    new_labels = [background_value, *label_map.values()]
+    if not set_rest_to_zero:
+        new_labels.append(n_labels - 1)
+    if dtype is None:
+        dtype = np.min_scalar_type(max(new_labels))
+    if set_rest_to_zero:
+        lut = np.full(n_labels, background_value, dtype=dtype)
+    else:
+        lut = np.arange(n_labels, dtype=dtype)
+    for old_label, new_label in label_map.items():
+        if 0 <= old_label < n_labels:
+            lut[old_label] = new_label
+    return lut
+
+
+def relabel_array(
+    matrix: np.ndarray,
+    label_map: dict[int, int],
+    set_rest_to_zero: bool = False,
+    background_value: int = 0,
+) -> np.ndarray:
+    """
+    Relabel a mask with a single lookup table gather, in place of one
+    full-volume comparison per label. Integer masks keep their dtype
+    unless the new labels do not fit in it.
+    """
+    return relabel_arrays(
+        [matrix],
+        label_map,
+        set_rest_to_zero=set_rest_to_zero,
+        background_value=background_value,
+    )[0]
+
+
+def relabel_arrays(
+    matrices: Sequence[np.ndarray],
+    label_map: dict[int, int],
+    set_rest_to_zero: bool = False,
+    background_value: int = 0,
+) -> list[np.ndarray]:
+    """Relabel a batch of masks with the same lookup table."""
+    matrices = [np.asanyarray(matrix) for matrix in matrices]
+    labels = [label_array(matrix) for matrix in matrices]
+    n_labels = max(max_label(matrix) for matrix in labels) + 1
+    new_labels = [background_value, *label_map.values()]
+    dtype = np.result_type(
+        *(matrix.dtype for matrix in matrices),
+        np.min_scalar_type(max(new_labels)),
+    )
+    if n_labels > MAX_LUT_SIZE:
+        log.debug(f"Labels up to {n_labels - 1}, relabeling label by label")
+        return [
+            _relabel_by_label(
+                matrix, label_map, set_rest_to_zero, background_value, dtype
+            )
+            for matrix in matrices
+        ]
+    lut = make_label_lut(
+        label_map,
+        n_labels,
+        set_rest_to_zero=set_rest_to_zero,
+        background_value=background_value,
+        dtype=dtype,
+    )
+    return [np.take(lut, matrix) for matrix in labels]
+
+
+def _relabel_by_label(
+    matrix: np.ndarray,
+    label_map: dict[int, int],
+    set_rest_to_zero: bool,
+    background_value: int,
+    dtype,
+) -> np.ndarray:
+    if set_rest_to_zero:
+        new_matrix = np.full(matrix.shape, background_value, dtype=dtype)
+    else:
+        new_matrix = matrix.astype(dtype)
+    for old_label, new_label in label_map.items():
+        new_matrix[matrix == old_label] = new_label
+    return new_matrix
+
+
+def _group_voxels_by_label(
+    matrix: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Returns:
+        number of voxels of every label, flat indices of the voxels sorted
+        by label, and end of every label in the sorted indices
+    """
+    flat = matrix.ravel()
+    counts = np.bincount(flat, minlength=max_label(matrix) + 1)
+    # Stable sort of small integers is a linear-time radix sort
+    if len(counts) <= np.iinfo(np.uint16).max + 1:
+        flat = flat.astype(np.min_scalar_type(len(counts) - 1), copy=False)
+    order = np.argsort(flat, kind="stable")
+    return counts, order, np.cumsum(counts)
+
+
+def _labels_to_split(counts, labels, ignore_background) -> list[int]:
+    if labels is None:
+        labels = np.flatnonzero(counts)
+        if ignore_background:
+            labels = labels[labels != 0]
+    return [int(label) for label in labels]
+
+
+def _label_voxels(counts, order, ends, label: int) -> np.ndarray:
+    if not 0 <= label < len(counts):
+        return order[:0]
+    return order[ends[label] - counts[label] : ends[label]]
+
+
+def split_label_array(
+    matrix: np.ndarray,
+    labels: Sequence[int] | None = None,
+    ignore_background: bool = True,
+) -> dict[int, np.ndarray]:
+    """
+    Split a multilabel mask into binary uint8 masks, grouping the voxels
+    by label in a single pass instead of comparing the whole volume with
+    every label.
+
+    Args:
+        labels: labels to split. If None, all labels present in the mask.
+        ignore_background: leave out label 0 when `labels` is None
+
+    Returns:
+        a binary mask for every label
+    """
+    matrix = label_array(matrix)
+    if max_label(matrix) >= MAX_LUT_SIZE:
+        if labels is None:
+            labels = np.unique(matrix)
+            if ignore_background:
+                labels = labels[labels != 0]
+        return {
+            int(label): (matrix == label).astype(np.uint8) for label in labels
+        }
+    counts, order, ends = _group_voxels_by_label(matrix)
+    binary_masks = {}
+    for label in _labels_to_split(counts, labels, ignore_background):
+        binary_mask = np.zeros(matrix.size, dtype=np.uint8)
+        binary_mask[_label_voxels(counts, order, ends, label)] = 1
+        binary_masks[label] = binary_mask.reshape(matrix.shape)
+    return binary_masks
+
+
+def split_label_array_cropped(
+    matrix: np.ndarray,
+    labels: Sequence[int] | None = None,
+    ignore_background: bool = True,
+    margin: int = 0,
+) -> dict[int, tuple[np.ndarray, list[int]]]:
+    """
+    Split a multilabel mask into binary uint8 masks cropped to the
+    bounding box of every label, computed in the same pass.
+
+    Args:
+        labels: labels to split. If None, all labels present in the mask.
+        ignore_background: leave out label 0 when `labels` is None
+        margin: number of voxels added around every bounding box
+
+    Returns:
+        for every label present in the mask, its cropped binary mask and
+        the index of the first voxel of the crop in `matrix`
+    """
+    matrix = label_array(matrix)
+    if max_label(matrix) >= MAX_LUT_SIZE:
+        raise ValueError(
+            f"Labels must be smaller than {MAX_LUT_SIZE} to be cropped"
+        )
+    counts, order, ends = _group_voxels_by_label(matrix)
+    cropped_masks = {}
+    for label in _labels_to_split(counts, labels, ignore_background):
+        voxels = _label_voxels(counts, order, ends, label)
+        if not len(voxels):
+            continue
+        coords = np.unravel_index(voxels, matrix.shape)
+        start = [max(0, int(c.min()) - margin) for c in coords]
+        end = [
+            min(size, int(c.max()) + 1 + margin)
+            for c, size in zip(coords, matrix.shape)
+        ]
+        cropped_mask = np.zeros(np.subtract(end, start), dtype=np.uint8)
+        cropped_mask[tuple(c - offset for c, offset in zip(coords, start))] = 1
+        cropped_masks[label] = (cropped_mask, start)
+    return cropped_masks
+
+
+def combine_label_arrays(
+    arrays: Sequence[np.ndarray], labels: Sequence[int] | None = None
+) -> np.ndarray:
+    """
+    Combine binary masks into a multilabel mask of the smallest unsigned
+    integer dtype, later masks overwriting earlier ones where they overlap.
+
+    Args:
+        labels: label of every mask. If None, masks are labeled 1, 2, ...
+    """
+    if labels is None:
+        labels = range(1, len(arrays) + 1)
+    labels = list(labels)
+    combined = np.zeros(
+        np.shape(arrays[0]), dtype=np.min_scalar_type(max(labels))
+    )
+    for array, label in zip(arrays, labels):
+        np.copyto(combined, label, where=np.asanyarray(array) != 0)
+    return combined
+
+
 def combine_nifti_masks(
     *masks: nib.Nifti1Image, use_separate_labels=True
 ) -> nib.Nifti1Image:
@@ -318,21 +902,18 @@ def combine_nifti_masks(
     if len(masks) < 2:
         raise ValueError("At least two masks must be provided")
 
-    arrays = [mask.get_fdata() for mask in masks]
     shapes = [mask.shape for mask in masks]
     if len(set(shapes)) != 1:
         raise ValueError(
             f"All masks must have the same shape and found shapes: {shapes}"
         )
-
-    new_matrix = np.zeros(shapes[0], dtype=int)
-
-    for i, array in enumerate(arrays):
-        if use_separate_labels:
-            new_label = i + 1
-        else:
-            new_label = 1
-        new_matrix[array != 0] = new_label
+    # Read the stored integers instead of float64 copies
+    arrays = [np.asanyarray(mask.dataobj) for mask in masks]
+    if use_separate_labels:
+        labels = range(1, len(masks) + 1)
+    else:
+        labels = [1] * len(masks)
+    new_matrix = combine_label_arrays(arrays, labels)
 
     return nib.Nifti1Image(new_matrix, affine=masks[0].affine)
 
@@ -358,13 +939,12 @@ def simple_relabel_fn(
     Returns:
         The relabeled mask.
     """
-    if set_rest_to_zero:
-        new_matrix = np.full_like(matrix, background_value)
-    else:
-        new_matrix = np.copy(matrix)
-    for old_label, new_label in label_map.items():
-        new_matrix[matrix == old_label] = new_label
-    return new_matrix
+    return relabel_array(
+        matrix,
+        label_map,
+        set_rest_to_zero=set_rest_to_zero,
+        background_value=background_value,
+    )
 
 
 def relabel_mask(
@@ -382,13 +962,37 @@ def relabel_mask(
     Returns:
         The relabeled mask.
     """
-    matrix = mask.get_fdata()
+    matrix = np.asanyarray(mask.dataobj)
     new_matrix = relabel_fn(matrix, background_value)
     return nib.Nifti1Image(
         new_matrix.astype(np.uint8), affine=mask.affine, header=mask.header
     )
 
 
+def relabel_mask_file(
+    mask_path: PathLike,
+    label_map: dict[int, int],
+    save_path: PathLike,
+    set_rest_to_zero: bool = False,
+    background_value: int = 0,
+):
+    """
+    Wrapper for relabel_array that takes in paths instead of arrays.
+    """
+    mask = io.load_nibabel(mask_path)
+    new_matrix = relabel_array(
+        np.asanyarray(mask.dataobj),
+        label_map,
+        set_rest_to_zero=set_rest_to_zero,
+        background_value=background_value,
+    )
+    new_mask = nib.Nifti1Image(
+        new_matrix, affine=mask.affine, header=mask.header
+    )
+    new_mask.set_data_dtype(new_matrix.dtype)
+    io.save_nibabel(new_mask, save_path)
+
+
 def create_binary_mask(mask, label):
     """
     Create a binary mask from a multilabel mask for the given label.
@@ -398,10 +1002,13 @@ def create_binary_mask(mask, label):
     Returns:
         The binary mask.
     """
-    matrix = mask.get_fdata()
-    new_matrix = np.zeros(matrix.shape)
-    new_matrix[matrix == label] = 1
-    return nib.Nifti1Image(new_matrix, affine=mask.affine, header=mask.header)
+    matrix = np.asanyarray(mask.dataobj)
+    new_matrix = (matrix == label).astype(np.uint8)
+    binary_mask = nib.Nifti1Image(
+        new_matrix, affine=mask.affine, header=mask.header
+    )
+    binary_mask.set_data_dtype(np.uint8)
+    return binary_mask
 
 
 def split_multilabel_nifti_masks(
@@ -410,6 +1017,9 @@ def split_multilabel_nifti_masks(
     label_dict: dict[int, str] | None = None,
     overwrite: bool = False,
     ignore_background: bool = True,
+    crop: bool = False,
+    margin: int = 0,
+    n_jobs: int | None = None,
 ):
     """
     Split multilabel nifti mask into separate binary nifti files.
@@ -421,39 +1031,83 @@ def split_multilabel_nifti_masks(
         overwrite: (optional) whether to overwrite existing files in the output directory
             with the same names as the separated masks.
         ignore_background: (optional) whether to ignore the background label, default True.
+        crop: (optional) crop every mask to the bounding box of its label, plus `margin`
+            voxels. The affine of the cropped masks keeps them in place, and the voxel
+            offsets of the crops are saved in `crop_offsets.json`. `resample_to_img`
+            puts a cropped mask back on the grid of the image.
+        n_jobs: (optional) number of threads writing the masks. If None, one per CPU.
     Returns:
         A list of paths to the saved separated masks.
     """
     mask = io.load_nibabel(combined_mask_path)
+    matrix = np.asanyarray(mask.dataobj)
+    labels = None if label_dict is None else list(label_dict)
 
-    labels = np.unique(mask.get_fdata()).astype(int)
-    if ignore_background:
-        labels = labels[labels != 0]
-
-    assert sorted(labels), sorted(list(label_dict.keys()))
-
+    if crop:
+        split_masks = split_label_array_cropped(
+            matrix,
+            labels=labels,
+            ignore_background=ignore_background,
+            margin=margin,
+        )
+    else:
+        split_masks = {
+            label: (binary_mask, [0, 0, 0])
+            for label, binary_mask in split_label_array(
+                matrix, labels=labels, ignore_background=ignore_background
+            ).items()
+            if labels is None or binary_mask.any()
+        }
     if label_dict is None:
-        label_dict = {label: f"label_{label}" for label in labels}
+        label_dict = {label: f"label_{label}" for label in split_masks}
     else:
         # Filter out any extra labels in label_dict that are not present in the combined mask
         label_dict = {
             label: label_name
             for label, label_name in label_dict.items()
-            if label in labels
+            if label in split_masks
         }
+    output_paths = {
+        label: io.intermediate_path(
+            Path(output_dir) / f"seg_{label_name}.nii.gz"
+        )
+        for label, label_name in label_dict.items()
+    }
 
     # Delete existing files in the output directory with the same names as the separated masks
     if overwrite:
-        for label, label_name in label_dict.items():
-            output_path = Path(output_dir) / f"seg_{label_name}.nii.gz"
+        for output_path in output_paths.values():
             if output_path.exists():
                 output_path.unlink()
 
-    saved_masks = []
-    for label, label_name in label_dict.items():
-        new_mask = create_binary_mask(mask, label)
-        output_path = Path(output_dir) / f"seg_{label_name}.nii.gz"
-        io.save_nibabel(new_mask, output_path)
-        saved_masks.append(output_path)
+    def save_mask(label: int) -> Path:
+        binary_mask, offset = split_masks[label]
+        affine = mask.affine.copy()
+        affine[:3, 3] += affine[:3, :3] @ offset
+        new_mask = nib.Nifti1Image(
+            binary_mask, affine=affine, header=mask.header
+        )
+        new_mask.set_data_dtype(np.uint8)
+        io.save_nibabel(new_mask, output_paths[label])
+        return output_paths[label]
+
+    if n_jobs is None:
+        n_jobs = os.cpu_count()
+    # Compression and writing release the GIL
+    with ThreadPoolExecutor(n_jobs) as executor:
+        saved_masks = list(executor.map(save_mask, label_dict))
 
+    if crop:
+        Path(output_dir).mkdir(parents=True, exist_ok=True)
+        io.save_json(
+            {
+                output_paths[label].name: {
+                    "label": label,
+                    "offset": split_masks[label][1],
+                    "source_shape": list(matrix.shape),
+                }
+                for label in label_dict
+            },
+            Path(output_dir) / "crop_offsets.json",
+        )
     return saved_masks
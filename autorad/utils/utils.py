@@ -1,6 +1,9 @@
+import contextlib
 import datetime
 import logging
 import os
+import signal
+import threading
 import time
 
 log = logging.getLogger(__name__)
@@ -21,6 +24,46 @@ def time_it(func):
     return wrapper
 
 
+class TimeLimitExceeded(BaseException):
+    """
+    Raised by `time_limit`. It derives from BaseException so that the
+    `except Exception` handlers of libraries such as pyradiomics (which
+    store NaN for a failing feature and carry on) do not swallow it.
+    """
+
+
+@contextlib.contextmanager
+def time_limit(seconds: float | None):
+    """
+    Raise TimeLimitExceeded if the block runs for longer than `seconds`.
+    Relies on SIGALRM, so it only works in the main thread on Unix;
+    elsewhere the block runs without a limit. The error is raised once
+    control returns to Python, so a long call into a C extension is not
+    interrupted midway.
+    """
+    if seconds is None:
+        yield
+        return
+    if (
+        not hasattr(signal, "SIGALRM")
+        or threading.current_thread() is not threading.main_thread()
+    ):
+        log.warning("Time limit not supported here, running without it.")
+        yield
+        return
+
+    def raise_timeout(signum, frame):
+        raise TimeLimitExceeded(f"Time limit of {seconds}s exceeded")
+
+    previous_handler = signal.signal(signal.SIGALRM, raise_timeout)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous_handler)
+
+
 def calculate_age(date_of_birth):
     """
     Calculate the age of a person from his date of birth.
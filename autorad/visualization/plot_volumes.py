@@ -1,10 +1,8 @@
 import functools
-import itertools
 import logging
-import tempfile
 import warnings
 from pathlib import Path
-from typing import Callable, List, Optional, Sequence, Tuple, Union
+from typing import Optional
 
 import numpy as np
 import plotly.express as px
@@ -14,6 +12,7 @@ from sklearn.pipeline import Pipeline
 
 from autorad.config.type_definitions import PathLike
 from autorad.utils import io, spatial
+from autorad.utils.spatial import generate_spatial_bounding_box, is_positive
 from autorad.visualization import plotly_utils
 
 # suppress skimage
@@ -22,72 +21,6 @@ warnings.filterwarnings(action="ignore", category=UserWarning)
 log = logging.getLogger(__name__)
 
 
-def is_positive(img):
-    return img > 0
-
-
-def generate_spatial_bounding_box(
-    img: np.ndarray,
-    select_fn: Callable = is_positive,
-    margin: Union[Sequence[int], int] = 0,
-    allow_smaller: bool = True,
-) -> Tuple[List[int], List[int]]:
-    """
-    Generate the spatial bounding box of foreground in the image with start-end positions (inclusive).
-    Users can define arbitrary function to select expected foreground from the whole image or specified channels.
-    And it can also add margin to every dim of the bounding box.
-    The output format of the coordinates is:
-
-        [1st_spatial_dim_start, 2nd_spatial_dim_start, ..., Nth_spatial_dim_start],
-        [1st_spatial_dim_end, 2nd_spatial_dim_end, ..., Nth_spatial_dim_end]
-
-    If `allow_smaller`, the bounding boxes edges are aligned with the input image edges.
-    This function returns [0, 0, ...], [0, 0, ...] if there's no positive intensity.
-
-    Args:
-        img: a "channel-first" image of shape (C, spatial_dim1[, spatial_dim2, ...]) to generate bounding box from.
-        select_fn: function to select expected foreground, default is to select values > 0.
-        channel_indices: if defined, select foreground only on the specified channels
-            of image. if None, select foreground on the whole image.
-        margin: add margin value to spatial dims of the bounding box, if only 1 value provided, use it for all dims.
-        allow_smaller: when computing box size with `margin`, whether allow the image size to be smaller
-            than box size, default to `True`.
-    """
-    spatial_size = img.shape[1:]
-    data = img
-    data = select_fn(data).any(0)
-    ndim = len(data.shape)
-    for m in margin:
-        if m < 0:
-            raise ValueError("margin value should not be negative number.")
-
-    box_start = [0] * ndim
-    box_end = [0] * ndim
-
-    for di, ax in enumerate(
-        itertools.combinations(reversed(range(ndim)), ndim - 1)
-    ):
-        dt = data
-        if len(ax) != 0:
-            dt = np.any(dt, ax)
-
-        if not dt.any():
-            # if no foreground, return all zero bounding box coords
-            return [0] * ndim, [0] * ndim
-
-        arg_max = np.where(dt == dt.max())[0]
-        min_d = arg_max[0] - margin[di]
-        max_d = arg_max[-1] + margin[di] + 1
-        if allow_smaller:
-            min_d = max(min_d, 0)
-            max_d = min(max_d, spatial_size[di])
-
-        box_start[di] = min_d
-        box_end[di] = max_d
-
-    return box_start, box_end
-
-
 class Cropper:
     """Performs non-zero cropping"""
 
@@ -222,7 +155,11 @@ def plot_roi(image_path, mask_path):
 
 
 class BaseVolumes:
-    """Loading and processing of image and mask volumes."""
+    """
+    Loading and processing of image and mask volumes.
+    The image is only windowed after cropping and slicing, so that a
+    memory-mapped image is never read or copied as a whole.
+    """
 
     def __init__(
         self,
@@ -234,16 +171,29 @@ class BaseVolumes:
         axis=2,
     ):
         self.image_raw = image
-        if window is None:
-            self.image = skimage.exposure.rescale_intensity(image)
-        else:
-            self.image = spatial.window_with_preset(
-                self.image_raw, window=window
-            )
+        self.window = window
         self.mask = mask == label
         self.axis = axis
         self.preprocessor = self.init_and_fit_preprocessor(constant_bbox)
 
+    @property
+    def image(self) -> np.ndarray:
+        """Windowed full image volume."""
+        return self.apply_window(self.image_raw)
+
+    @functools.cached_property
+    def _intensity_range(self) -> tuple[float, float]:
+        return np.min(self.image_raw), np.max(self.image_raw)
+
+    def apply_window(self, image: np.ndarray) -> np.ndarray:
+        """Window (part of) the image, or rescale it if window is None."""
+        if self.window is None:
+            # Rescale with the range of the whole volume, not of the part
+            return skimage.exposure.rescale_intensity(
+                np.asarray(image), in_range=self._intensity_range
+            )
+        return spatial.window_with_preset(np.asarray(image), self.window)
+
     def init_and_fit_preprocessor(self, constant_bbox=False):
         preprocessor = Pipeline(
             [
@@ -270,18 +220,13 @@ class BaseVolumes:
         mask_path = Path(mask_path)
 
         if resample:
-            with tempfile.TemporaryDirectory() as tmpdir:
-                tmpdir = Path(tmpdir)
-                resampled_mask_path = tmpdir / "resampled_mask.nii.gz"
-                spatial.resample_to_img(
-                    to_resample=mask_path,
-                    reference=image_path,
-                    output_path=resampled_mask_path,
-                )
-                mask = io.load_array(resampled_mask_path)
+            # Only the header of the image is read to get its grid
+            mask = spatial.resample_to_grid(
+                [mask_path], image_path, as_array=True
+            )[0]
         else:
-            mask = io.load_array(mask_path)
-        image = io.load_array(image_path)
+            mask = io.load_array_mmap(mask_path)
+        image = io.load_array_mmap(image_path)
 
         return cls(image, mask, *args, **kwargs)
 
@@ -290,7 +235,7 @@ class BaseVolumes:
         return result
 
     def get_slices(self):
-        image_2D = self.crop_and_slice(self.image)
+        image_2D = self.apply_window(self.crop_and_slice(self.image_raw))
         mask_2D = self.crop_and_slice(self.mask)
         return image_2D.T, mask_2D.T
 
@@ -304,36 +249,94 @@ class BaseVolumes:
 class FeaturePlotter:
     """Plotting of voxel-based radiomics features."""
 
-    def __init__(self, image_path, mask_path, feature_map: dict):
+    # Subdirectory with the low-resolution previews of the maps
+    preview_dirname = "preview"
+
+    def __init__(
+        self,
+        image_path,
+        mask_path,
+        feature_map: dict,
+        dir_path: Optional[PathLike] = None,
+        preview_names: Optional[list[str]] = None,
+    ):
         self.volumes = BaseVolumes.from_nifti(
             image_path, mask_path, constant_bbox=True
         )
         self.feature_map = feature_map
         self.feature_names = list(feature_map.keys())
+        self.dir_path = Path(dir_path) if dir_path is not None else None
+        self.preview_names = set(preview_names or [])
 
     @classmethod
-    def from_dir(cls, dir_path: str, feature_names: list[str]):
+    def from_dir(
+        cls, dir_path: str, feature_names: list[str], allow_preview=False
+    ):
+        """
+        Args:
+            dir_path: directory with the image, segmentation and maps, as
+                saved by `extract_feature_maps`
+            feature_names: names of the maps to load
+            allow_preview: if a full-resolution map is not available yet,
+                load its preview (see `extract_feature_map_preview`)
+        """
         dir_path_obj = Path(dir_path)
         image_path = dir_path_obj / "image.nii.gz"
-        mask_path = dir_path_obj / "segmentation.nii.gz"
-        feature_map = {}
+        nifti_paths = []
+        preview_names = []
         for name in feature_names:
             nifti_path = dir_path_obj / f"{name}.nii.gz"
-            try:
-                resampled_nifti_path = (
-                    dir_path_obj / f"resampled_{name}.nii.gz"
-                )
-                spatial.resample_to_img(
-                    to_resample=nifti_path,
-                    reference=image_path,
-                    output_path=resampled_nifti_path,
-                )
-                feature_map[name] = io.load_array(resampled_nifti_path)
-            except FileNotFoundError:
+            preview_dir = dir_path_obj / cls.preview_dirname
+            if allow_preview and not nifti_path.exists():
+                nifti_path = preview_dir / nifti_path.name
+                preview_names.append(name)
+            nifti_paths.append(nifti_path)
+        feature_map = dict(
+            zip(feature_names, cls._load_feature_maps(nifti_paths, image_path))
+        )
+        return cls(
+            image_path,
+            dir_path_obj / "segmentation.nii.gz",
+            feature_map,
+            dir_path=dir_path_obj,
+            preview_names=preview_names,
+        )
+
+    @staticmethod
+    def _load_feature_maps(
+        nifti_paths: list[Path], image_path: Path, n_jobs: int = 4
+    ) -> list[np.ndarray]:
+        """Load maps resampled in memory onto the grid of the image."""
+        for nifti_path in nifti_paths:
+            if not nifti_path.exists():
                 raise FileNotFoundError(
-                    f"Could not load feature map {name} in {dir_path}"
+                    f"Could not load feature map {nifti_path}"
                 )
-        return cls(image_path, mask_path, feature_map)
+        return spatial.resample_to_grid(
+            nifti_paths, image_path, n_jobs=n_jobs, as_array=True
+        )
+
+    def refresh(self) -> list[str]:
+        """
+        Swap in the full-resolution maps of the features shown as previews,
+        for the ones that have been computed since.
+
+        Returns:
+            names of the swapped maps
+        """
+        if self.dir_path is None:
+            return []
+        image_path = self.dir_path / "image.nii.gz"
+        swapped = []
+        for name in sorted(self.preview_names):
+            nifti_path = self.dir_path / f"{name}.nii.gz"
+            if nifti_path.exists():
+                self.feature_map[name] = self._load_feature_maps(
+                    [nifti_path], image_path
+                )[0]
+                swapped.append(name)
+        self.preview_names -= set(swapped)
+        return swapped
 
     def plot_single_feature(
         self,
@@ -341,8 +344,9 @@ class FeaturePlotter:
         feature_range: Optional[tuple[float, float]] = None,
     ):
         image_2D, mask_2D = self.volumes.get_slices()
-        feature_2D = self.volumes.crop_and_slice(
-            self.feature_map[feature_name]
+        feature_2D = np.array(
+            self.volumes.crop_and_slice(self.feature_map[feature_name]),
+            dtype=float,
         )
         feature_2D[mask_2D == 0] = np.nan
         fig = px.imshow(image_2D, color_continuous_scale="gray")
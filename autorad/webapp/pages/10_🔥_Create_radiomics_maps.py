@@ -3,8 +3,12 @@ from pathlib import Path
 import streamlit as st
 
 from autorad.config import config
-from autorad.feature_extraction.voxelbased import extract_feature_maps
+from autorad.feature_extraction.voxelbased import (
+    extract_feature_map_preview,
+    extract_feature_maps,
+)
 from autorad.utils import io
+from autorad.visualization.plot_volumes import FeaturePlotter
 from autorad.webapp import extraction_utils, st_read, st_utils
 
 
@@ -26,12 +30,19 @@ def show():
         else:
             maps_output_dir = result_dir / output_dirname
             if st_read.dir_nonempty(maps_output_dir):
-                st.warning("This ID already exists and has some data!")
+                st.warning(
+                    "This ID already exists and has some data! Maps already "
+                    "computed with the same parameters will be reused."
+                )
             else:
                 maps_output_dir.mkdir(parents=True, exist_ok=True)
                 st.success(f"Maps will be saved in {maps_output_dir}")
 
     extraction_params = extraction_utils.radiomics_params_voxelbased()
+    show_preview = st.checkbox(
+        "Show a low-resolution preview while the maps are computed",
+        value=True,
+    )
 
     start_extraction = st.button("Get feature maps!")
     if start_extraction:
@@ -41,10 +52,44 @@ def show():
         io.save_yaml(
             extraction_params, maps_output_dir / "extraction_params.yaml"
         )
-        with st.spinner("Extracting and saving feature maps..."):
-            extract_feature_maps(
-                image_path, seg_path, str(maps_output_dir), extraction_params
-            )
+        if show_preview:
+            with st.spinner("Computing a preview..."):
+                preview_store, refinement = extract_feature_map_preview(
+                    image_path,
+                    seg_path,
+                    maps_output_dir,
+                    extraction_params,
+                    refine=True,
+                )
+            if not preview_store.feature_names:
+                st.warning(
+                    "The preview produced no feature maps. Check that the "
+                    "segmentation is not empty."
+                )
+                with st.spinner("Extracting and saving feature maps..."):
+                    refinement.result()
+            else:
+                feature_name = preview_store.feature_names[0]
+                plotter = FeaturePlotter.from_dir(
+                    maps_output_dir, [feature_name], allow_preview=True
+                )
+                st.write(f"Preview of {feature_name}:")
+                figure = st.empty()
+                figure.plotly_chart(plotter.plot_single_feature(feature_name))
+                with st.spinner("Extracting and saving feature maps..."):
+                    refinement.result()
+                if plotter.refresh():
+                    figure.plotly_chart(
+                        plotter.plot_single_feature(feature_name)
+                    )
+        else:
+            with st.spinner("Extracting and saving feature maps..."):
+                extract_feature_maps(
+                    image_path,
+                    seg_path,
+                    str(maps_output_dir),
+                    extraction_params,
+                )
         st.success(
             f"Done! Feature maps and configuration saved in {maps_output_dir}"
         )
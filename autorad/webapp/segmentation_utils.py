@@ -62,21 +62,24 @@ def dicom_to_nifti_expander(data_dir):
         out_dir.mkdir(exist_ok=True)
         if len(os.listdir(out_dir)) > 0:
             st.warning(f"Output directory {out_dir} is not empty. ")
-        multiple_images = st.checkbox(
-            "I have multiple DICOM images per patient (will require manual renaming)",
-            value=False,
+        st.caption(
+            "Every DICOM series is saved as a separate file named after its "
+            "folder, so multiple images per patient need no renaming."
         )
-        if not multiple_images:
-            out_filename = "image"
-        else:
-            out_filename = dicom_dir.name + ".nii.gz"
         run_conversion = st.button("Convert")
         if run_conversion:
             with st.spinner("Converting DICOMs to NIFTI..."):
-                conversion.convert_to_nifti(
-                    dicom_dir, output_path=out_dir / out_filename
+                manifest = conversion.convert_dicom_dataset(
+                    dicom_dir, save_dir=out_dir, layout="flat"
                 )
-            st.success(f"Done! Nifties saved in {out_dir}")
+            failed = manifest[manifest["status"] == "failed"]
+            if not failed.empty:
+                st.error(f"Conversion failed for {len(failed)} series:")
+                st.dataframe(failed[["ID", "source_path", "error"]])
+            st.success(
+                f"Done! {len(manifest) - len(failed)} images saved in "
+                f"{out_dir}, listed in {out_dir / 'manifest.csv'}"
+            )
 
         return out_dir
 
@@ -93,11 +96,10 @@ def leave_only_organ_segmentation(
     label_map = {organ_label: 1}
     for mask_path in Path(seg_dir).glob("*.nii.gz"):
         save_path = Path(save_dir) / mask_path.name
-        spatial.relabel_mask(
+        spatial.relabel_mask_file(
             mask_path=mask_path,
             label_map=label_map,
             save_path=save_path,
-            strict=False,
             set_rest_to_zero=True,
         )
 
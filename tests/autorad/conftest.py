@@ -3,6 +3,7 @@ from pathlib import Path
 
 import pandas as pd
 import pytest
+import SimpleITK as sitk
 from hypothesis import settings
 
 from autorad.config import config
@@ -95,3 +96,43 @@ class Helpers:
 @pytest.fixture
 def helpers():
     return Helpers
+
+
+@pytest.fixture
+def dicom_series_dir(tmp_path):
+    """
+    DICOM series of the prostate test image, written with a z-flipped
+    slice order so that reading it involves reorientation.
+    """
+    image = sitk.ReadImage(str(prostate_data["img"]), sitk.sitkInt16)
+    image = sitk.Flip(image, [False, False, True])
+    direction = image.GetDirection()
+    series_dir = tmp_path / "dicom_series"
+    series_dir.mkdir()
+    writer = sitk.ImageFileWriter()
+    writer.KeepOriginalImageUIDOn()
+    for z in range(image.GetDepth()):
+        image_slice = image[:, :, z]
+        origin = image.TransformIndexToPhysicalPoint((0, 0, z))
+        tags = {
+            "0008|0060": "MR",
+            "0020|000d": "1.2.826.0.1.3680043.2.1125.1",
+            "0020|000e": "1.2.826.0.1.3680043.2.1125.1.1",
+            "0008|0018": f"1.2.826.0.1.3680043.2.1125.1.1.{z}",
+            "0020|0013": str(z),
+            "0020|0032": "\\".join(str(value) for value in origin),
+            "0020|0037": "\\".join(
+                str(value)
+                for value in (direction[0], direction[3], direction[6])
+                + (direction[1], direction[4], direction[7])
+            ),
+            "0028|0030": "\\".join(
+                str(value) for value in image.GetSpacing()[1::-1]
+            ),
+            "0018|0050": str(image.GetSpacing()[2]),
+        }
+        for tag, value in tags.items():
+            image_slice.SetMetaData(tag, value)
+        writer.SetFileName(str(series_dir / f"slice_{z:03d}.dcm"))
+        writer.Execute(image_slice)
+    return series_dir
@@ -1,11 +1,16 @@
 import os
+import shutil
 import tempfile
 from pathlib import Path
 
+import numpy as np
+import pydicom
+import pydicom_seg
 import pytest
+import SimpleITK as sitk
 
 from autorad.config import config
-from autorad.utils import conversion
+from autorad.utils import conversion, io
 
 
 @pytest.mark.skip(reason="requires external dependency")
@@ -14,3 +19,95 @@ def test_dicom_to_nifti():
     with tempfile.TemporaryDirectory() as tmp_dir:
         conversion.dicom_to_nifti(dicom_dir, tmp_dir)
         assert len(os.listdir(tmp_dir)) == 2
+
+
+def test_convert_dicom_dataset(dicom_series_dir, tmp_path):
+    root_dir = tmp_path / "dicom"
+    for patient in ("patient_1", "patient_2"):
+        shutil.copytree(dicom_series_dir, root_dir / patient / "T2")
+    # Slices with truncated pixel data
+    broken_dir = root_dir / "patient_3" / "T2"
+    shutil.copytree(dicom_series_dir, broken_dir)
+    for slice_path in broken_dir.glob("*.dcm"):
+        slice_path.write_bytes(slice_path.read_bytes()[:-1000])
+
+    save_dir = tmp_path / "nifti"
+    manifest = conversion.convert_dicom_dataset(root_dir, save_dir, n_jobs=2)
+    assert manifest["ID"].tolist() == [
+        "patient_1_T2",
+        "patient_2_T2",
+        "patient_3_T2",
+    ]
+    assert manifest["status"].tolist() == ["done", "done", "failed"]
+    assert manifest["error"].iloc[2]
+    assert (save_dir / "manifest.csv").exists()
+    image = sitk.ReadImage(manifest["image_path"].iloc[0])
+    expected = io.read_dicom_sitk(dicom_series_dir, use_cache=False)
+    np.testing.assert_array_equal(
+        sitk.GetArrayFromImage(image), sitk.GetArrayFromImage(expected)
+    )
+
+    # Up-to-date outputs are not converted again
+    mtime = Path(manifest["image_path"].iloc[0]).stat().st_mtime_ns
+    manifest = conversion.convert_dicom_dataset(root_dir, save_dir, n_jobs=1)
+    assert manifest["status"].tolist() == ["done", "done", "failed"]
+    assert Path(manifest["image_path"].iloc[0]).stat().st_mtime_ns == mtime
+
+    # The flat layout saves one file per image in the save dir
+    flat_dir = tmp_path / "flat"
+    manifest = conversion.convert_dicom_dataset(
+        root_dir, flat_dir, n_jobs=1, layout="flat"
+    )
+    assert sorted(p.name for p in flat_dir.glob("*.nii.gz")) == [
+        "patient_1_T2.nii.gz",
+        "patient_2_T2.nii.gz",
+    ]
+
+
+def test_convert_dicom_dataset_with_seg(dicom_series_dir, tmp_path):
+    root_dir = tmp_path / "dicom"
+    shutil.copytree(dicom_series_dir, root_dir / "patient_1" / "T2")
+    source_images = [
+        pydicom.dcmread(str(path))
+        for path in sorted((root_dir / "patient_1" / "T2").glob("*.dcm"))
+    ]
+    image = io.read_dicom_sitk(dicom_series_dir, use_cache=False)
+    arr = np.zeros(image.GetSize()[::-1], dtype=np.uint8)
+    arr[5:8, 30:50, 30:50] = 1
+    seg = sitk.GetImageFromArray(arr)
+    seg.CopyInformation(image)
+    code = {"CodingSchemeDesignator": "SCT"}
+    template = pydicom_seg.template.from_dcmqi_metainfo(
+        {
+            "segmentAttributes": [
+                [
+                    {
+                        "labelID": 1,
+                        "SegmentAlgorithmType": "MANUAL",
+                        "SegmentedPropertyCategoryCodeSequence": {
+                            **code,
+                            "CodeValue": "123037004",
+                            "CodeMeaning": "Anatomical Structure",
+                        },
+                        "SegmentedPropertyTypeCodeSequence": {
+                            **code,
+                            "CodeValue": "41216001",
+                            "CodeMeaning": "Prostate",
+                        },
+                    }
+                ]
+            ]
+        }
+    )
+    dcm = pydicom_seg.MultiClassWriter(template).write(seg, source_images)
+    (root_dir / "patient_1" / "SEG").mkdir()
+    dcm.save_as(str(root_dir / "patient_1" / "SEG" / "seg.dcm"))
+
+    manifest = conversion.convert_dicom_dataset(
+        root_dir, tmp_path / "nifti", n_jobs=1
+    )
+    assert manifest["ID"].tolist() == ["patient_1_T2"]
+    assert manifest["mask_status"].tolist() == ["converted"]
+    mask = sitk.ReadImage(manifest["mask_path"].iloc[0])
+    assert mask.GetSize() == image.GetSize()
+    np.testing.assert_array_equal(sitk.GetArrayFromImage(mask), arr)
@@ -1,10 +1,16 @@
 from pathlib import Path
 
 import hypothesis_utils
+import numpy as np
+import pandas as pd
+import SimpleITK as sitk
+from conftest import prostate_data
 from hypothesis import given, settings
 
 from autorad.config import config
-from autorad.data import FeatureDataset
+from autorad.data import FeatureDataset, ImageDataset
+from autorad.data.index import read_image_header
+from autorad.utils import io
 
 
 class TestFeatureDataset:
@@ -21,3 +27,64 @@ class TestFeatureDataset:
         assert dataset.y.name == "Label"
 
     test_data_path = Path(config.TEST_DATA_DIR) / "splits.yaml"
+
+
+class TestImageDataset:
+    def get_dataset(self, tmp_path):
+        shifted_seg = sitk.ReadImage(str(prostate_data["seg"]))
+        shifted_seg.SetOrigin([0.0, 0.0, 0.0])
+        shifted_seg_path = tmp_path / "seg_shifted.nii.gz"
+        sitk.WriteImage(shifted_seg, str(shifted_seg_path))
+        df = pd.DataFrame(
+            {
+                "ID": ["ok", "two_labels", "empty", "shifted", "missing"],
+                "img": [prostate_data["img"]] * 5,
+                "seg": [
+                    prostate_data["seg"],
+                    prostate_data["seg_two_labels"],
+                    prostate_data["empty_seg"],
+                    shifted_seg_path,
+                    tmp_path / "missing.nii.gz",
+                ],
+            }
+        )
+        return ImageDataset(df, "img", "seg", ID_colname="ID")
+
+    def test_build_index(self, tmp_path):
+        dataset = self.get_dataset(tmp_path)
+        index = dataset.build_index(n_jobs=1)
+        assert dataset.index is index
+        assert index["ID"].tolist() == dataset.ids
+        assert index["valid"].tolist() == [True, True, False, False, False]
+        assert index["mask_labels"].tolist()[:3] == [[1], [1, 2], []]
+        assert index["error"].iloc[2] == "Mask is empty"
+        assert not index["geometry_matches"].iloc[3]
+        assert "not found" in index["error"].iloc[4]
+
+        image = sitk.ReadImage(str(prostate_data["img"]))
+        ok = index.iloc[0]
+        assert ok["image_size"] == list(image.GetSize())
+        assert ok["mask_n_voxels"] > 0
+        assert ok["bbox_volume_mm3"] > 0
+
+    def test_build_index_uses_cache(self, tmp_path):
+        cache_path = tmp_path / "index.parquet"
+        dataset = self.get_dataset(tmp_path)
+        index = dataset.build_index(cache_path=cache_path, n_jobs=1)
+        assert cache_path.exists()
+
+        cached = dataset.build_index(cache_path=cache_path, n_jobs=1)
+        assert cached["ID"].tolist() == dataset.ids
+        assert cached["valid"].tolist() == index["valid"].tolist()
+        assert cached["image_spacing"].tolist() == (
+            index["image_spacing"].tolist()
+        )
+
+
+def test_read_dicom_header(dicom_series_dir):
+    header = read_image_header(dicom_series_dir)
+    image = io.read_image_sitk(dicom_series_dir)
+    assert header["size"] == list(image.GetSize())
+    np.testing.assert_allclose(header["spacing"], image.GetSpacing())
+    np.testing.assert_allclose(header["origin"], image.GetOrigin(), atol=1e-4)
+    np.testing.assert_allclose(header["direction"], image.GetDirection())
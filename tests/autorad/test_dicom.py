@@ -0,0 +1,115 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pydicom
+import pytest
+import SimpleITK as sitk
+
+from autorad.utils import dicom, io
+
+
+@pytest.fixture
+def dicom_cache_dir(tmp_path, monkeypatch):
+    cache_dir = tmp_path / "dicom_cache"
+    monkeypatch.setattr(dicom, "DICOM_CACHE_DIR", cache_dir)
+    return cache_dir
+
+
+def read_with_gdcm(input_dir):
+    reader = sitk.ImageSeriesReader()
+    reader.SetFileNames(reader.GetGDCMSeriesFileNames(str(input_dir)))
+    return sitk.DICOMOrient(reader.Execute(), "LPS")
+
+
+def test_sort_dicom_series(dicom_series_dir):
+    (dicom_series_dir / "notes.txt").write_text("not a DICOM file")
+    file_names = dicom.sort_dicom_series(dicom_series_dir, n_jobs=4)
+    expected = sitk.ImageSeriesReader.GetGDCMSeriesFileNames(
+        str(dicom_series_dir)
+    )
+    assert file_names == list(expected)
+
+
+def test_sort_dicom_series_picks_gdcm_series(dicom_series_dir):
+    # A shorter series whose UID sorts first, which GDCM reads by default
+    series_uid = "1.2.826.0.1.3680043.2.1125.1.0"
+    for i, slice_path in enumerate(sorted(dicom_series_dir.glob("*.dcm"))[:3]):
+        ds = pydicom.dcmread(slice_path)
+        ds.SeriesInstanceUID = series_uid
+        ds.SOPInstanceUID = f"{series_uid}.{i}"
+        ds.save_as(dicom_series_dir / f"other_{i}.dcm")
+
+    file_names = dicom.sort_dicom_series(dicom_series_dir)
+    expected = sitk.ImageSeriesReader.GetGDCMSeriesFileNames(
+        str(dicom_series_dir)
+    )
+    assert len(file_names) == 3
+    assert file_names == list(expected)
+
+    other_uid = "1.2.826.0.1.3680043.2.1125.1.1"
+    file_names = dicom.sort_dicom_series(
+        dicom_series_dir, series_uid=other_uid
+    )
+    expected = sitk.ImageSeriesReader.GetGDCMSeriesFileNames(
+        str(dicom_series_dir), other_uid
+    )
+    assert file_names == list(expected)
+    with pytest.raises(ValueError):
+        dicom.sort_dicom_series(dicom_series_dir, series_uid="1.2.3")
+
+
+def test_read_dicom_uses_cache(dicom_series_dir, dicom_cache_dir, monkeypatch):
+    expected = read_with_gdcm(dicom_series_dir)
+    assert io.read_dicom_sitk(dicom_series_dir) is not None
+    assert not dicom_cache_dir.exists()
+    image = io.read_dicom_sitk(dicom_series_dir, use_cache=True)
+    assert len(list(dicom_cache_dir.glob("*.json"))) == 1
+    np.testing.assert_array_equal(
+        sitk.GetArrayFromImage(image), sitk.GetArrayFromImage(expected)
+    )
+    assert image.GetOrigin() == expected.GetOrigin()
+    assert image.GetDirection() == expected.GetDirection()
+
+    # The slice order is taken from the cache
+    sort_dicom_series = dicom.sort_dicom_series
+
+    def fail(*args, **kwargs):
+        raise AssertionError("The series was sorted again")
+
+    monkeypatch.setattr(dicom, "sort_dicom_series", fail)
+    io.read_dicom_sitk(dicom_series_dir, use_cache=True, write_nifti=True)
+    assert len(list(dicom_cache_dir.glob("*.nii.gz"))) == 1
+    cached = io.read_dicom_sitk(dicom_series_dir, use_cache=True)
+    np.testing.assert_array_equal(
+        sitk.GetArrayFromImage(cached), sitk.GetArrayFromImage(expected)
+    )
+    np.testing.assert_allclose(
+        cached.GetOrigin(), expected.GetOrigin(), atol=1e-4
+    )
+
+    # Modifying a slice invalidates the entry
+    slice_path = next(dicom_series_dir.glob("*.dcm"))
+    stat = slice_path.stat()
+    os.utime(slice_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    with pytest.raises(AssertionError):
+        io.read_dicom_sitk(dicom_series_dir, use_cache=True)
+    assert not list(dicom_cache_dir.glob("*.nii.gz"))
+    monkeypatch.setattr(dicom, "sort_dicom_series", sort_dicom_series)
+    io.read_dicom_sitk(dicom_series_dir, use_cache=True)
+
+
+def test_cache_concurrent_writers(dicom_series_dir, dicom_cache_dir):
+    cache = dicom.DicomSeriesCache()
+    file_names = dicom.sort_dicom_series(dicom_series_dir)
+    image = read_with_gdcm(dicom_series_dir)
+
+    def write(_):
+        cache.set_file_names(dicom_series_dir, file_names)
+        cache.set_nifti(dicom_series_dir, image)
+
+    with ThreadPoolExecutor(8) as executor:
+        list(executor.map(write, range(16)))
+    assert cache.get_file_names(dicom_series_dir) == file_names
+    assert cache.get_nifti_path(dicom_series_dir) is not None
+    assert not list(dicom_cache_dir.glob(".*"))
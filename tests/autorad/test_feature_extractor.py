@@ -1,8 +1,27 @@
+import time
+from concurrent.futures import Future
+from pathlib import Path
+
 import pytest
+import SimpleITK as sitk
 from conftest import prostate_data
+from radiomics import featureextractor, glcm
 
+from autorad.config import config
 from autorad.data import ImageDataset
-from autorad.feature_extraction import FeatureExtractor
+from autorad.feature_extraction import ExtractionPool, FeatureExtractor
+from autorad.feature_extraction import cache as cache_module
+from autorad.feature_extraction.cache import (
+    DiskCache,
+    FeatureCache,
+    FilteredImageCache,
+)
+from autorad.feature_extraction.extractor import (
+    PyRadiomicsExtractorWrapper,
+    estimate_case_cost,
+)
+from autorad.feature_extraction.prefetch import PrefetchingLoader
+from autorad.utils import io
 
 
 @pytest.fixture
@@ -29,6 +48,223 @@ def test_run(feature_extractor):
     assert len(result_df) == 2
 
 
+def test_get_features_reads_shared_image_once(feature_extractor, monkeypatch):
+    n_reads = 0
+    read_image_sitk = io.read_image_sitk
+
+    def counting_read_image_sitk(*args, **kwargs):
+        nonlocal n_reads
+        n_reads += 1
+        return read_image_sitk(*args, **kwargs)
+
+    monkeypatch.setattr(io, "read_image_sitk", counting_read_image_sitk)
+    feature_df = feature_extractor.get_features()
+    assert len(feature_df) == 2
+    assert feature_df["ID"].tolist() == feature_extractor.dataset.ids
+    assert n_reads == 1
+
+
+def test_extraction_pool_is_reused_across_runs(image_dataset):
+    serial_df = FeatureExtractor(image_dataset).get_features()
+    with ExtractionPool(
+        Path(config.PARAM_DIR) / "CT_Baessler.yaml", n_jobs=2
+    ) as pool:
+        with FeatureExtractor(image_dataset, pool=pool) as feature_extractor:
+            first_df = feature_extractor.get_features_parallel()
+        # A pool passed to the extractor is left running
+        second_df = feature_extractor.get_features_parallel()
+        single_case = pool.extract(
+            image_dataset.image_paths[0], image_dataset.mask_paths[0]
+        )
+    assert feature_extractor.pool is pool
+    for feature_df in (first_df, second_df):
+        assert feature_df["ID"].tolist() == image_dataset.ids
+        assert (
+            feature_df["original_firstorder_Mean"].tolist()
+            == serial_df["original_firstorder_Mean"].tolist()
+        )
+    assert (
+        single_case["original_firstorder_Mean"]
+        == serial_df["original_firstorder_Mean"][0]
+    )
+
+
+def test_extraction_pool_params_must_match(image_dataset):
+    with ExtractionPool(
+        Path(config.PARAM_DIR) / "MR_default.yaml", n_jobs=1
+    ) as pool:
+        with pytest.raises(ValueError):
+            FeatureExtractor(image_dataset, pool=pool)
+
+
+def test_parallel_run_schedules_largest_cases_first(image_dataset):
+    feature_extractor = FeatureExtractor(image_dataset, n_jobs=2)
+    groups = [
+        (image_path, [mask_path], [id_])
+        for image_path, mask_path, id_ in feature_extractor._get_cases()
+    ]
+    costs = [
+        estimate_case_cost(mask_path) for mask_path in image_dataset.mask_paths
+    ]
+    assert all(cost > 0 for cost in costs)
+    sorted_groups = feature_extractor._sort_groups_by_cost(groups, None)
+    assert [g[2][0] for g in sorted_groups] == [
+        id_ for _, id_ in sorted(zip(costs, image_dataset.ids), reverse=True)
+    ]
+    with feature_extractor:
+        feature_df = feature_extractor.get_features_parallel()
+        assert feature_extractor.pool is not None
+    # The pool started by the extractor is shut down on exit
+    assert feature_extractor.pool is None
+    assert feature_df["ID"].tolist() == image_dataset.ids
+    assert 0 < feature_extractor.core_utilization <= 1
+
+
+def test_parallel_tasks_spread_the_largest_cases(image_dataset):
+    class RecordingPool:
+        n_jobs = 2
+
+        def __init__(self):
+            self.tasks = []
+
+        def submit_prefetching(self, groups, **kwargs):
+            self.tasks.append([group[2][0] for group in groups])
+            future = Future()
+            future.set_result([([None], 0.0, [])] * len(groups))
+            return future
+
+    feature_extractor = FeatureExtractor(image_dataset, prefetch=1)
+    feature_extractor.schedule_by_size = False
+    feature_extractor.pool = RecordingPool()
+    # Groups ordered from the largest to the smallest
+    groups = [("img", ["seg"], [i]) for i in range(5)]
+    list(feature_extractor._extract_groups_parallel(groups, None))
+    assert feature_extractor.pool.tasks == [[0, 3], [1, 4], [2]]
+
+
+def test_case_timeout_skips_slow_cases(image_dataset):
+    feature_extractor = FeatureExtractor(image_dataset, case_timeout=1e-4)
+    feature_df = feature_extractor.get_features()
+    assert feature_df.empty
+
+
+def test_case_timeout_during_feature_computation(image_dataset, monkeypatch):
+    # pyradiomics catches the errors of every feature and stores NaN, so
+    # the timeout must not be swallowed there
+    def slow_contrast(self):
+        time.sleep(5)
+
+    monkeypatch.setattr(
+        glcm.RadiomicsGLCM, "getContrastFeatureValue", slow_contrast
+    )
+    feature_extractor = FeatureExtractor(image_dataset, case_timeout=1.0)
+    start = time.perf_counter()
+    feature_df = feature_extractor.get_features()
+    assert feature_df.empty
+    assert time.perf_counter() - start < 2 * 5
+
+
+def test_run_collects_stage_timings(feature_extractor):
+    feature_extractor.run(log_timings=True)
+    timings = feature_extractor.timings
+    assert timings["ID"].tolist() == feature_extractor.dataset.ids
+    for stage in (
+        "read_image",
+        "read_mask",
+        "preprocess",
+        "filter_Original",
+        "features_shape",
+        "features_firstorder",
+        "features_glcm",
+    ):
+        assert (timings[stage] > 0).all()
+
+
+def test_prefetching_loader_yields_cases_in_order(image_dataset, helpers):
+    missing_image = str(Path(helpers.tmp_dir()) / "missing.nii.gz")
+    groups = [
+        (image_path, [mask_path], [id_])
+        for image_path, mask_path, id_ in zip(
+            image_dataset.image_paths,
+            image_dataset.mask_paths,
+            image_dataset.ids,
+        )
+    ]
+    groups.insert(1, (missing_image, [image_dataset.mask_paths[0]], ["x"]))
+    loaded = list(PrefetchingLoader(groups, n_prefetch=2, max_memory=1))
+    assert [group for group, _, _ in loaded] == groups
+    assert loaded[1][1] is None
+    assert all(image is not None for _, image, _ in loaded[::2])
+    assert all(
+        len(masks) == 1 and masks[0] is not None for _, _, masks in loaded
+    )
+
+
+@pytest.mark.parametrize("n_jobs", [None, 2])
+def test_get_features_with_prefetching(image_dataset, n_jobs):
+    expected_df = FeatureExtractor(image_dataset).get_features()
+    feature_extractor = FeatureExtractor(
+        image_dataset, n_jobs=n_jobs, prefetch=2
+    )
+    if n_jobs is None:
+        feature_df = feature_extractor.get_features()
+    else:
+        feature_df = feature_extractor.get_features_parallel()
+        feature_extractor.close()
+    assert feature_df["ID"].tolist() == image_dataset.ids
+    assert (
+        feature_df["original_firstorder_Mean"].tolist()
+        == expected_df["original_firstorder_Mean"].tolist()
+    )
+
+
+def test_run_multilabel(image_dataset):
+    feature_extractor = FeatureExtractor(
+        dataset=image_dataset,
+    )
+    result_df = feature_extractor.run(mask_label=[1, 2])
+    # case_1 has only label 1, case_2 has labels 1 and 2
+    assert len(result_df) == 3
+    assert sorted(result_df["mask_label"].tolist()) == [1, 1, 2]
+
+    # for a mask with a single label, features match the single-label mode
+    single_label_df = feature_extractor.run(mask_label=1)
+    multilabel_row = result_df[result_df["ID"] == "case_1_single_label"]
+    single_label_row = single_label_df[
+        single_label_df["ID"] == "case_1_single_label"
+    ]
+    for feature_name in ["original_shape_VoxelVolume", "original_glcm_Idm"]:
+        assert float(multilabel_row[feature_name].iloc[0]) == float(
+            single_label_row[feature_name].iloc[0]
+        )
+
+
+def test_run_multilabel_with_resampling_matches_single_label(small_paths_df):
+    # With resampling, the grid is cropped around each label, so the
+    # filtered images (LoG, Wavelet) differ between labels
+    dataset = ImageDataset(
+        small_paths_df.iloc[[1]], "img", "seg", ID_colname="ID"
+    )
+    feature_extractor = FeatureExtractor(
+        dataset, extraction_params="MR_default.yaml"
+    )
+    result_df = feature_extractor.run(mask_label=[1, 2])
+    single_label_df = feature_extractor.run(mask_label=2)
+    multilabel_row = result_df[result_df["mask_label"] == 2].iloc[0]
+    single_label_row = single_label_df.iloc[0]
+    feature_names = [
+        name
+        for name in single_label_df.columns
+        if name.startswith(("original_", "log-", "wavelet-"))
+        and not name.startswith("original_diagnostics")
+    ]
+    assert any(name.startswith("wavelet-") for name in feature_names)
+    for feature_name in feature_names:
+        assert float(multilabel_row[feature_name]) == pytest.approx(
+            float(single_label_row[feature_name]), rel=1e-6, abs=1e-9
+        ), feature_name
+
+
 @pytest.mark.skip(reason="needs first to provide new API for extractor")
 def test_get_features_for_single_case(feature_extractor):
     image_path = prostate_data["img"]
@@ -50,3 +286,190 @@ def test_get_features_for_single_case(feature_extractor):
 def test_get_pyradiomics_feature_names(feature_extractor):
     feature_names = feature_extractor.get_pyradiomics_feature_names()
     assert len(feature_names) == 127
+
+
+def test_run_with_cache(image_dataset, helpers):
+    cache_dir = helpers.tmp_dir()
+    feature_extractor = FeatureExtractor(
+        dataset=image_dataset,
+        cache_dir=cache_dir,
+    )
+    first_df = feature_extractor.run()
+    assert feature_extractor.cache.misses == 2
+    assert len(feature_extractor.cache) == 2
+
+    second_df = feature_extractor.run()
+    assert feature_extractor.cache.hits == 2
+    assert second_df.shape == first_df.shape
+
+    feature_extractor.cache.invalidate()
+    assert len(feature_extractor.cache) == 0
+
+
+def test_file_hashes_are_reused_across_runs(helpers, monkeypatch):
+    cache = FeatureCache(helpers.tmp_dir())
+    params = {"setting": {"binWidth": 25}}
+    key = cache.make_key(prostate_data["img"], prostate_data["seg"], 1, params)
+    assert len(list((cache.cache_dir / cache.hash_dirname).iterdir())) == 2
+
+    # A new process has an empty in-memory memo, but reads the saved hashes
+    def fail(*args):
+        raise AssertionError("The file was hashed again")
+
+    monkeypatch.setattr(cache_module, "_hash_files", fail)
+    reopened = FeatureCache(cache.cache_dir)
+    assert (
+        reopened.make_key(
+            prostate_data["img"], prostate_data["seg"], 1, params
+        )
+        == key
+    )
+    assert len(reopened) == 0
+
+
+def test_file_hashes_count_towards_cache_size(helpers):
+    cache = FeatureCache(helpers.tmp_dir())
+    params = {"setting": {"binWidth": 25}}
+    cache.make_key(prostate_data["img"], prostate_data["seg"], 1, params)
+    hash_dir = cache.cache_dir / cache.hash_dirname
+    assert len(cache) == 0
+    assert cache.size() == 2 * 64
+
+    cache.max_size = 64
+    cache.evict()
+    assert len(list(hash_dir.iterdir())) == 1
+    cache.invalidate()
+    assert not list(hash_dir.iterdir())
+    assert cache.size() == 0
+
+
+def test_disk_cache_is_abstract(helpers):
+    with pytest.raises(TypeError):
+        DiskCache(helpers.tmp_dir())
+
+
+def test_feature_cache_evicts_least_recently_used(helpers):
+    cache = FeatureCache(helpers.tmp_dir())
+    cache.set("a", {"feature": 1.0})
+    entry_size = cache.size()
+    cache.max_size = 2 * entry_size
+    cache.set("b", {"feature": 2.0})
+    assert cache.get("a") == {"feature": 1.0}
+    cache.set("c", {"feature": 3.0})
+    assert "a" in cache
+    assert "b" not in cache
+    assert "c" in cache
+
+
+def test_cache_tolerates_entries_removed_by_other_processes(helpers):
+    cache = FilteredImageCache(helpers.tmp_dir())
+    image = sitk.ReadImage(str(prostate_data["img"]))
+    cache.set("a", [(image, "original", "Original")])
+    # The entry is removed between listing and reading it
+    vanished = cache._entry_path("a")
+    listed = cache._entry_paths()
+    cache._remove(vanished)
+    cache._entry_paths = lambda: listed
+    assert cache.size() == 0
+    cache.max_size = 0
+    cache.evict()
+    assert cache.get("a") is None
+    assert cache.misses == 1
+
+
+def test_filtered_image_key_depends_on_mask_only_if_used(helpers):
+    cache = FilteredImageCache(helpers.tmp_dir())
+    image = sitk.ReadImage(str(prostate_data["img"]))
+    mask = sitk.ReadImage(str(prostate_data["seg"]))
+    other_mask = sitk.ReadImage(str(prostate_data["seg_two_labels"]))
+    for image_types, mask_dependent in (
+        ({"Original": {}, "LoG": {"sigma": [1.0]}}, False),
+        ({"Original": {}, "LBP3D": {}}, True),
+    ):
+        keys = {
+            cache.make_key(image, m, image_types, {"binWidth": 25})
+            for m in (mask, other_mask)
+        }
+        assert len(keys) == (2 if mask_dependent else 1)
+
+
+def test_pyradiomics_wrapper_matches_pyradiomics():
+    params_path = Path(config.PARAM_DIR) / "CT_Baessler.yaml"
+    wrapper = PyRadiomicsExtractorWrapper(params_path)
+    reference = featureextractor.RadiomicsFeatureExtractor(str(params_path))
+    feature_dict = wrapper.execute(
+        prostate_data["img"], prostate_data["seg_two_labels"], label=2
+    )
+    reference_dict = reference.execute(
+        str(prostate_data["img"]),
+        str(prostate_data["seg_two_labels"]),
+        label=2,
+    )
+    for feature_name, value in feature_dict.items():
+        assert float(value) == float(reference_dict[feature_name])
+
+
+@pytest.mark.parametrize("resample", [True, False])
+def test_crop_to_roi_gives_same_features(resample):
+    params = io.load_yaml(Path(config.PARAM_DIR) / "MR_default.yaml")
+    if not resample:
+        del params["setting"]["resampledPixelSpacing"]
+        del params["setting"]["interpolator"]
+        params["imageType"]["LoG"]["sigma"] = [1.0]
+    # Embed the case in a larger volume, so that cropping has an effect
+    padding = [40, 40, 4]
+    image = sitk.ConstantPad(
+        io.read_image_sitk(Path(prostate_data["img"])), padding, padding, 100
+    )
+    mask = sitk.ConstantPad(
+        io.read_segmentation_sitk(Path(prostate_data["seg"])),
+        padding,
+        padding,
+    )
+    extractor = PyRadiomicsExtractorWrapper(params)
+    cropping_extractor = PyRadiomicsExtractorWrapper(params, crop_to_roi=True)
+    cropped_image, *_ = cropping_extractor._crop_to_roi(
+        image, mask, mask, cropping_extractor.settings
+    )
+    assert cropped_image.GetNumberOfPixels() < image.GetNumberOfPixels()
+
+    expected = extractor.execute(image, mask)
+    result = cropping_extractor.execute(image, mask)
+    assert result.keys() == expected.keys()
+    for name, value in expected.items():
+        assert float(result[name]) == pytest.approx(float(value), rel=1e-3)
+
+
+def test_filtered_image_cache_skips_filtering(helpers):
+    cache = FilteredImageCache(helpers.tmp_dir())
+    wrapper = PyRadiomicsExtractorWrapper(
+        Path(config.PARAM_DIR) / "MR_default.yaml",
+        filtered_image_cache=cache,
+    )
+    feature_dict = wrapper.execute(prostate_data["img"], prostate_data["seg"])
+    assert cache.misses == 1
+    cached_feature_dict = wrapper.execute(
+        prostate_data["img"], prostate_data["seg"]
+    )
+    assert cache.hits == 1
+    for feature_name, value in feature_dict.items():
+        assert float(cached_feature_dict[feature_name]) == float(value)
+
+    # changing feature-only settings reuses the filtered images
+    wrapper.settings["binWidth"] = 10
+    wrapper.execute(prostate_data["img"], prostate_data["seg"])
+    assert cache.hits == 2
+
+
+def test_run_streaming_and_resume(image_dataset, helpers):
+    output_dir = helpers.tmp_dir()
+    feature_extractor = FeatureExtractor(dataset=image_dataset)
+    result_df = feature_extractor.run(output_dir=output_dir)
+    assert len(result_df) == 2
+    assert len(list(output_dir.glob("*.parquet"))) > 0
+
+    with pytest.raises(ValueError):
+        feature_extractor.run(output_dir=output_dir)
+
+    resumed_df = feature_extractor.run(output_dir=output_dir, resume=True)
+    assert resumed_df["ID"].tolist() == result_df["ID"].tolist()
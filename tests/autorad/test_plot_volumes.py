@@ -1,7 +1,10 @@
+from pathlib import Path
+
 import numpy as np
 import pytest
 from conftest import prostate_data
 import plotly
+from autorad.utils import io
 from autorad.visualization.plot_volumes import BaseVolumes, plot_roi
 
 image_path = prostate_data["img"]
@@ -34,3 +37,22 @@ def test_plot_roi():
     # Test with invalid image file path
     with pytest.raises(FileNotFoundError) as err:
         plot_roi('invalid_image.nii.gz', mask_path)
+
+
+def test_from_uncompressed_nifti_is_memory_mapped(tmp_path):
+    uncompressed_paths = []
+    for path in (image_path, mask_path):
+        uncompressed_path = tmp_path / Path(path).name.replace(".gz", "")
+        io.save_sitk(io.load_sitk(path), uncompressed_path)
+        uncompressed_paths.append(uncompressed_path)
+    volumes = BaseVolumes.from_nifti(*uncompressed_paths)
+    assert isinstance(volumes.image_raw, np.memmap)
+    np.testing.assert_array_equal(
+        volumes.image_raw, io.load_array(image_path)
+    )
+
+    expected = BaseVolumes.from_nifti(image_path, mask_path)
+    for slice_2D, expected_slice_2D in zip(
+        volumes.get_slices(), expected.get_slices()
+    ):
+        np.testing.assert_array_equal(slice_2D, expected_slice_2D)
@@ -0,0 +1,86 @@
+import os
+
+import numpy as np
+import pandas as pd
+import SimpleITK as sitk
+from conftest import prostate_data
+
+from autorad.data import ImageDataset
+from autorad.utils import preprocessing
+
+
+def test_generate_border_masks_for_margins(tmp_path):
+    dataset = ImageDataset(
+        pd.DataFrame(
+            {
+                "ID": ["case_1", "case_2"],
+                "img": [prostate_data["img"]] * 2,
+                "seg": [prostate_data["seg"], prostate_data["seg_two_labels"]],
+            }
+        ),
+        image_colname="img",
+        mask_colname="seg",
+        ID_colname="ID",
+    )
+    border_df = preprocessing.generate_border_masks_for_margins(
+        dataset, [3, 5], tmp_path, n_jobs=1
+    )
+    assert len(border_df) == 4
+    assert border_df["ID"].tolist() == ["case_1", "case_1", "case_2", "case_2"]
+    assert border_df["margin_mm"].tolist() == [3, 5, 3, 5]
+    assert border_df["border_mask_path"].nunique() == 4
+    for row in border_df.itertuples():
+        mask = sitk.GetArrayFromImage(sitk.ReadImage(row.seg))
+        border = sitk.GetArrayFromImage(sitk.ReadImage(row.border_mask_path))
+        assert border.any()
+        assert not (border & (mask != 0)).any()
+    border_dataset = ImageDataset(
+        border_df, "img", "border_mask_path", "border_ID"
+    )
+    assert border_dataset.ids[0] == "case_1_3mm"
+
+    # Up-to-date borders are not generated again
+    mtimes = [os.stat(p).st_mtime_ns for p in border_df["border_mask_path"]]
+    border_df = preprocessing.generate_border_masks_for_margins(
+        dataset, [3, 5], tmp_path, n_jobs=1
+    )
+    np.testing.assert_array_equal(
+        [os.stat(p).st_mtime_ns for p in border_df["border_mask_path"]],
+        mtimes,
+    )
+
+
+def test_border_masks_of_both_methods_do_not_collide(tmp_path):
+    dataset = ImageDataset(
+        pd.DataFrame(
+            {
+                "ID": ["case_1", "missing"],
+                "img": [prostate_data["img"]] * 2,
+                "seg": [prostate_data["seg"], tmp_path / "missing.nii.gz"],
+            }
+        ),
+        image_colname="img",
+        mask_colname="seg",
+        ID_colname="ID",
+    )
+    dilation_df = preprocessing.generate_border_masks(
+        dataset, 5, tmp_path, n_jobs=1
+    )
+    # All cases are returned, without a path where the border failed
+    assert dilation_df["ID"].tolist() == ["case_1", "missing"]
+    assert dilation_df["border_mask_path_5mm"].isna().tolist() == [
+        False,
+        True,
+    ]
+    dilation_path = dilation_df["border_mask_path_5mm"].iloc[0]
+    assert dilation_path.endswith("case_1_border_mask_5mm_dilation.nii.gz")
+    assert os.path.exists(dilation_path)
+
+    distance_df = preprocessing.generate_border_masks_for_margins(
+        dataset, [5], tmp_path, n_jobs=1
+    )
+    distance_path = distance_df["border_mask_path"].iloc[0]
+    assert distance_path != dilation_path
+    dilation = sitk.GetArrayFromImage(sitk.ReadImage(dilation_path))
+    distance = sitk.GetArrayFromImage(sitk.ReadImage(distance_path))
+    assert (dilation != distance).any()
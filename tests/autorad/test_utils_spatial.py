@@ -3,10 +3,12 @@ from pathlib import Path
 
 import nibabel as nib
 import numpy as np
+import pytest
 import SimpleITK as sitk
 from conftest import prostate_data
+from scipy import ndimage
 
-from autorad.utils import spatial
+from autorad.utils import io, spatial
 
 
 def test_get_border_outside_mask_mm():
@@ -30,6 +32,36 @@ def test_dilate_mask_by_10mm():
     assert abs(diff) / ref_dilated_arr.size < 0.05
 
 
+def test_border_masks_from_distance():
+    seg = sitk.ReadImage(str(prostate_data["seg"]))
+    seg_arr = sitk.GetArrayFromImage(seg) != 0
+    borders = spatial.get_border_masks_mm_sitk(seg, [1, 3, 10])
+    border_arrs = [sitk.GetArrayFromImage(border) for border in borders]
+    for border, border_arr in zip(borders, border_arrs):
+        assert border.GetOrigin() == seg.GetOrigin()
+        assert border_arr.dtype == np.uint8
+        assert border_arr.any()
+        assert not (border_arr & seg_arr).any()
+    # Rings grow with the margin
+    for inner, outer in zip(border_arrs, border_arrs[1:]):
+        assert (outer >= inner).all()
+        assert outer.sum() > inner.sum()
+
+    # The distance is measured with the spacing, as scipy does
+    distance = ndimage.distance_transform_edt(
+        ~seg_arr, sampling=seg.GetSpacing()[::-1]
+    )
+    expected = (distance > 0) & (distance <= 10)
+    assert (border_arrs[2] != expected).sum() / expected.sum() < 0.01
+
+    dilated = spatial.dilate_masks_mm_sitk(seg, [10])[0]
+    np.testing.assert_array_equal(
+        sitk.GetArrayFromImage(dilated), border_arrs[2] | seg_arr
+    )
+    with pytest.raises(ValueError):
+        spatial.get_border_masks_mm_sitk(seg, [(10, 10, 0)])
+
+
 def test_center_of_mass():
     arr = np.zeros((10, 10, 10))
     arr[0, 0, 0] = 1
@@ -198,3 +230,154 @@ def test_split_multilabel_nifti_masks():
             nib.load(expected_path_two).get_fdata().all()
             == expected_data_2.all()
         )
+
+
+def test_intermediate_format(tmp_path, monkeypatch):
+    monkeypatch.setattr(io, "_intermediate_format", "nii.gz")
+    io.set_intermediate_format("nii")
+    mask_path = io.intermediate_path(tmp_path / "border.nii.gz")
+    assert mask_path == tmp_path / "border.nii"
+    spatial.get_border_outside_mask_mm(
+        prostate_data["seg"], (10, 10, 0), mask_path
+    )
+    # Uncompressed voxels can be memory-mapped
+    assert isinstance(np.asanyarray(nib.load(mask_path).dataobj), np.memmap)
+
+    final_path = io.export_nifti_gz(mask_path)
+    assert final_path == tmp_path / "border.nii.gz"
+    np.testing.assert_array_equal(
+        io.load_array(final_path), io.load_array(mask_path)
+    )
+    with pytest.raises(ValueError):
+        io.set_intermediate_format("zip")
+
+
+def test_relabel_array_keeps_dtype():
+    rng = np.random.default_rng(0)
+    matrix = rng.integers(0, 100, size=(20, 20, 10)).astype(np.uint8)
+    label_map = {label: label % 3 for label in range(1, 90)}
+    expected = matrix.copy()
+    for old_label, new_label in label_map.items():
+        expected[matrix == old_label] = new_label
+
+    result = spatial.relabel_array(matrix, label_map)
+    assert result.dtype == np.uint8
+    np.testing.assert_array_equal(result, expected)
+
+    # Same lookup table for a batch of masks
+    results = spatial.relabel_arrays(
+        [matrix, matrix.astype(np.uint16)], {1: 300}, set_rest_to_zero=True
+    )
+    assert all(result.dtype == np.uint16 for result in results)
+    np.testing.assert_array_equal(results[0], np.where(matrix == 1, 300, 0))
+    np.testing.assert_array_equal(results[0], results[1])
+
+    # Masks stored as floats, as NIfTI masks often are
+    for dtype in (np.float32, np.float64):
+        result = spatial.relabel_array(matrix.astype(dtype), label_map)
+        assert result.dtype == dtype
+        np.testing.assert_array_equal(result, expected)
+    with pytest.raises(ValueError):
+        spatial.relabel_array(matrix + 0.5, label_map)
+
+
+def test_split_and_combine_label_arrays():
+    matrix = np.array([[[1, 1, 2], [1, 2, 5], [0, 5, 0]]], dtype=np.uint16)
+    binary_masks = spatial.split_label_array(matrix)
+    assert list(binary_masks) == [1, 2, 5]
+    for label, binary_mask in binary_masks.items():
+        assert binary_mask.dtype == np.uint8
+        np.testing.assert_array_equal(binary_mask, matrix == label)
+    assert not spatial.split_label_array(matrix, labels=[3])[3].any()
+
+    combined = spatial.combine_label_arrays(
+        list(binary_masks.values()), labels=list(binary_masks)
+    )
+    assert combined.dtype == np.uint8
+    np.testing.assert_array_equal(combined, matrix)
+
+    float_masks = spatial.split_label_array(matrix.astype(np.float32))
+    assert list(float_masks) == [1, 2, 5]
+    for label, binary_mask in float_masks.items():
+        np.testing.assert_array_equal(binary_mask, binary_masks[label])
+
+
+def test_split_multilabel_nifti_masks_cropped(tmp_path):
+    mask_path = prostate_data["seg_two_labels"]
+    mask = sitk.ReadImage(str(mask_path))
+    output_paths = spatial.split_multilabel_nifti_masks(
+        mask_path, tmp_path, crop=True, margin=2, n_jobs=2
+    )
+    offsets = io.load_json(tmp_path / "crop_offsets.json")
+    assert [offsets[p.name]["label"] for p in output_paths] == [1, 2]
+    for output_path in output_paths:
+        label = offsets[output_path.name]["label"]
+        cropped = sitk.ReadImage(str(output_path))
+        assert cropped.GetPixelID() == sitk.sitkUInt8
+        assert np.prod(cropped.GetSize()) < np.prod(mask.GetSize())
+        # Back on the original grid, the cropped mask is the binary mask
+        restored = spatial.resample_to_img_sitk(cropped, mask)
+        np.testing.assert_array_equal(
+            sitk.GetArrayFromImage(restored),
+            sitk.GetArrayFromImage(mask) == label,
+        )
+        offset = offsets[output_path.name]["offset"]
+        assert cropped.GetOrigin() == pytest.approx(
+            mask.TransformIndexToPhysicalPoint(offset), abs=1e-4
+        )
+
+
+def test_resample_to_grid(tmp_path):
+    image = sitk.ReadImage(str(prostate_data["img"]))
+    mask = sitk.ReadImage(str(prostate_data["seg"]))
+    isotropic_mask = spatial.resample_to_isotropic_sitk(mask)
+    mask_path = tmp_path / "isotropic_mask.nii.gz"
+    sitk.WriteImage(isotropic_mask, str(mask_path))
+
+    expected = sitk.Resample(
+        isotropic_mask, image, sitk.Transform(), sitk.sitkNearestNeighbor
+    )
+    arrays = spatial.resample_to_grid(
+        [mask_path, isotropic_mask, mask],
+        prostate_data["img"],
+        n_jobs=2,
+        as_array=True,
+    )
+    for arr in arrays[:2]:
+        np.testing.assert_array_equal(arr, io.get_sitk_array(expected))
+    np.testing.assert_array_equal(arrays[2], io.get_sitk_array(mask))
+
+    # The grid of the reference is read from its header once
+    grid = spatial.read_grid(prostate_data["img"])
+    assert grid == spatial.Grid.from_image(image)
+    assert spatial.read_grid(prostate_data["img"]) is grid
+    assert grid.matches(mask)
+    assert not grid.matches(isotropic_mask)
+
+
+@pytest.mark.parametrize("crop", [False, True])
+def test_split_float_multilabel_nifti_mask(tmp_path, crop):
+    mask = nib.load(str(prostate_data["seg_two_labels"]))
+    labels = np.asanyarray(mask.dataobj)
+    float_mask_path = tmp_path / "seg_float.nii.gz"
+    nib.save(
+        nib.Nifti1Image(labels.astype(np.float32), mask.affine),
+        str(float_mask_path),
+    )
+    output_dir = tmp_path / "split"
+    output_paths = spatial.split_multilabel_nifti_masks(
+        float_mask_path, output_dir, crop=crop
+    )
+    assert sorted(p.name for p in output_paths) == [
+        "seg_label_1.nii.gz",
+        "seg_label_2.nii.gz",
+    ]
+    reference = sitk.ReadImage(str(prostate_data["seg_two_labels"]))
+    for label, output_path in zip([1, 2], sorted(output_paths)):
+        binary_mask = sitk.ReadImage(str(output_path))
+        assert binary_mask.GetPixelID() == sitk.sitkUInt8
+        restored = spatial.resample_to_img_sitk(binary_mask, reference)
+        np.testing.assert_array_equal(
+            sitk.GetArrayFromImage(restored),
+            sitk.GetArrayFromImage(reference) == label,
+        )
@@ -0,0 +1,255 @@
+import numpy as np
+import pandas as pd
+import pytest
+import SimpleITK as sitk
+from conftest import prostate_data
+from radiomics import featureextractor
+
+from autorad.data import ImageDataset
+from autorad.feature_extraction.map_store import FeatureMapStore
+from autorad.feature_extraction.voxelbased import (
+    compute_feature_maps,
+    extract_feature_map_preview,
+    extract_feature_maps,
+    extract_feature_maps_for_dataset,
+    sample_blocks,
+    split_into_tiles,
+)
+from autorad.utils import io
+from autorad.visualization.plot_volumes import FeaturePlotter
+
+
+@pytest.fixture
+def map_params():
+    return {
+        "imageType": {"Original": {}},
+        "featureClass": {
+            "firstorder": ["Mean", "Entropy"],
+            "glcm": ["Contrast", "JointAverage"],
+            "glszm": ["ZonePercentage", "GrayLevelNonUniformity"],
+        },
+        "setting": {"binWidth": 25},
+        "voxelSetting": {"kernelRadius": 1, "voxelBatch": 500},
+    }
+
+
+def test_split_into_tiles():
+    mask = sitk.ReadImage(str(prostate_data["seg"]))
+    coords = np.array(np.where(sitk.GetArrayViewFromImage(mask) == 1))
+    tiles = split_into_tiles(coords, tile_size=8)
+    assert len(tiles) > 1
+    assert sorted(np.concatenate(tiles)) == list(range(coords.shape[1]))
+    for idx in tiles:
+        assert (np.ptp(coords[:, idx], axis=1) < 8).all()
+
+
+def test_sample_blocks():
+    coords = np.array(np.where(np.ones((4, 4, 2), dtype=bool)))
+    sample_idx, voxel_block = sample_blocks(coords, stride=2)
+    assert len(sample_idx) == 4
+    assert np.bincount(voxel_block).tolist() == [8, 8, 8, 8]
+    # Every voxel is represented by a voxel of its own block
+    np.testing.assert_array_equal(
+        coords[:, sample_idx][:, voxel_block] // 2, coords // 2
+    )
+
+
+@pytest.mark.parametrize("n_jobs", [1, 2])
+def test_tiled_feature_maps_match_pyradiomics(map_params, n_jobs, tmp_path):
+    extractor = featureextractor.RadiomicsFeatureExtractor(map_params)
+    expected = extractor.execute(
+        str(prostate_data["img"]), str(prostate_data["seg"]), voxelBased=True
+    )
+    expected = {
+        name: value
+        for name, value in expected.items()
+        if isinstance(value, sitk.Image)
+    }
+    store = FeatureMapStore(tmp_path)
+    feature_names = compute_feature_maps(
+        prostate_data["img"],
+        prostate_data["seg"],
+        map_params,
+        store,
+        n_jobs=n_jobs,
+        tile_size=8,
+    )
+    assert set(feature_names) == expected.keys()
+    for name in feature_names:
+        feature_map = store.to_image(name)
+        assert feature_map.GetOrigin() == expected[name].GetOrigin()
+        np.testing.assert_allclose(
+            sitk.GetArrayFromImage(feature_map),
+            sitk.GetArrayFromImage(expected[name]),
+            err_msg=name,
+        )
+
+
+def test_extract_feature_maps(map_params, tmp_path):
+    store = extract_feature_maps(
+        prostate_data["img"],
+        prostate_data["seg"],
+        tmp_path,
+        extraction_params=map_params,
+        n_jobs=2,
+    )
+    assert (tmp_path / "image.nii.gz").exists()
+    assert (tmp_path / "original_glszm_ZonePercentage.nii.gz").exists()
+    assert len(list(tmp_path.glob("original_*.nii.gz"))) == 6
+    assert (
+        tmp_path / "feature_maps" / "original_glszm_ZonePercentage.npy"
+    ).exists()
+    mean_map = sitk.ReadImage(
+        str(tmp_path / "original_firstorder_Mean.nii.gz")
+    )
+    np.testing.assert_array_equal(
+        sitk.GetArrayFromImage(mean_map),
+        store.read("original_firstorder_Mean"),
+    )
+
+
+def test_feature_map_store(tmp_path):
+    reference = sitk.Image(4, 3, 2, sitk.sitkFloat32)
+    reference.SetSpacing((0.5, 0.5, 2.0))
+    store = FeatureMapStore(tmp_path)
+    store.create("feature", reference, fill_value=np.nan)
+    store.write("feature", np.array([[0, 1], [0, 2], [0, 3]]), [1.0, 2.0])
+    store.flush()
+
+    reopened = FeatureMapStore(tmp_path)
+    assert reopened.feature_names == ["feature"]
+    arr = reopened.read("feature")
+    assert arr.shape == (2, 3, 4)
+    assert arr[0, 0, 0] == 1.0 and arr[1, 2, 3] == 2.0
+    assert np.isnan(arr).sum() == arr.size - 2
+    assert reopened.to_image("feature").GetSpacing() == (0.5, 0.5, 2.0)
+    with pytest.raises(KeyError):
+        reopened.read("missing")
+
+
+def test_export_nifti_moves_complete_files_into_place(tmp_path, monkeypatch):
+    reference = sitk.Image(4, 3, 2, sitk.sitkFloat32)
+    store = FeatureMapStore(tmp_path / "feature_maps")
+    store.create("feature", reference, fill_value=1.0)
+    save_path = tmp_path / "feature.nii.gz"
+    write_image = sitk.WriteImage
+
+    def check_not_visible(image, path, *args):
+        assert not save_path.exists()
+        write_image(image, path, *args)
+
+    monkeypatch.setattr(sitk, "WriteImage", check_not_visible)
+    assert store.export_nifti(tmp_path) == [save_path]
+    assert sorted(p.name for p in tmp_path.glob("*.nii.gz")) == [
+        "feature.nii.gz"
+    ]
+    assert not list(tmp_path.glob(".tmp_*"))
+    arr = sitk.GetArrayFromImage(sitk.ReadImage(str(save_path)))
+    assert (arr == 1.0).all()
+
+
+def test_extract_feature_maps_resumes(map_params, tmp_path):
+    mean_name = "original_firstorder_Mean"
+    extract_feature_maps(
+        prostate_data["img"],
+        prostate_data["seg"],
+        tmp_path,
+        extraction_params=map_params,
+        n_jobs=1,
+        feature_names=[mean_name],
+    )
+    assert [p.name for p in tmp_path.glob("original_*.nii.gz")] == [
+        f"{mean_name}.nii.gz"
+    ]
+    mean_path = tmp_path / "feature_maps" / f"{mean_name}.npy"
+    mean_mtime = mean_path.stat().st_mtime_ns
+
+    extract_feature_maps(
+        prostate_data["img"],
+        prostate_data["seg"],
+        tmp_path,
+        extraction_params=map_params,
+        n_jobs=1,
+    )
+    assert len(list(tmp_path.glob("original_*.nii.gz"))) == 6
+    assert mean_path.stat().st_mtime_ns == mean_mtime
+    manifest = io.load_json(tmp_path / "manifest.json")
+    assert len(manifest["maps"]) == 6
+    assert len(manifest["jobs"]) == 1
+
+    # Changing the parameters invalidates the finished maps
+    map_params["setting"]["binWidth"] = 10
+    extract_feature_maps(
+        prostate_data["img"],
+        prostate_data["seg"],
+        tmp_path,
+        extraction_params=map_params,
+        n_jobs=1,
+        feature_names=[mean_name],
+    )
+    assert mean_path.stat().st_mtime_ns != mean_mtime
+
+
+def test_preview_is_refined(map_params, tmp_path):
+    mean_name = "original_firstorder_Mean"
+    store, refinement = extract_feature_map_preview(
+        prostate_data["img"],
+        prostate_data["seg"],
+        tmp_path,
+        extraction_params=map_params,
+        stride=2,
+        n_jobs=2,
+        feature_names=[mean_name],
+        refine=True,
+    )
+    assert (tmp_path / "preview" / f"{mean_name}.nii.gz").exists()
+    plotter = FeaturePlotter.from_dir(
+        tmp_path, [mean_name], allow_preview=True
+    )
+    refinement.result()
+    if plotter.preview_names:
+        assert plotter.refresh() == [mean_name]
+    assert not plotter.preview_names
+    assert (tmp_path / f"{mean_name}.nii.gz").exists()
+
+    # The preview takes the full-resolution value of one voxel per block
+    preview = store.read(mean_name)
+    full = sitk.GetArrayFromImage(
+        sitk.ReadImage(str(tmp_path / f"{mean_name}.nii.gz"))
+    )
+    roi = full != 0
+    assert np.isclose(preview, full)[roi].sum() >= roi.sum() / 8
+
+
+def test_extract_feature_maps_for_dataset(map_params, tmp_path):
+    dataset = ImageDataset(
+        pd.DataFrame(
+            {
+                "ID": ["case_1", "case_2", "empty"],
+                "img": [prostate_data["img"]] * 3,
+                "seg": [
+                    prostate_data["seg"],
+                    prostate_data["seg_two_labels"],
+                    prostate_data["empty_seg"],
+                ],
+            }
+        ),
+        image_colname="img",
+        mask_colname="seg",
+        ID_colname="ID",
+    )
+    index = extract_feature_maps_for_dataset(
+        dataset,
+        tmp_path,
+        extraction_params=map_params,
+        n_jobs=2,
+        feature_names=["original_firstorder_Mean"],
+    )
+    assert index["ID"].tolist() == ["case_1", "case_2", "empty"]
+    assert index["status"].tolist() == ["done", "done", "failed"]
+    assert index["n_maps"].tolist() == [1, 1, 0]
+    assert index["error"].iloc[2]
+    assert (tmp_path / "case_1" / "original_firstorder_Mean.nii.gz").exists()
+    assert (tmp_path / "case_2" / "manifest.json").exists()
+    saved_index = pd.read_csv(tmp_path / "index.csv")
+    assert saved_index["status"].tolist() == index["status"].tolist()